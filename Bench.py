@@ -0,0 +1,704 @@
+# Benchmarks and test harnesses for the Communicator server. Nothing in here
+# is needed to run the server or the client.
+#
+#   python Bench.py cluster [--nodes 3] [--clients 3] [--messages 300] [--rate 100]
+#   python Bench.py recvbuf [--megabytes 64] [--line-bytes 80]
+#   python Bench.py load [--scenario room|rooms|dm|files] [--clients 1000] [--rate 200] [--duration 20]
+#                        [--save-trace FILE | --replay FILE --speed N]
+#   python Bench.py record --listen 4000 [--host HOST] [--port 3256] --trace FILE
+
+import argparse
+import asyncio
+import base64
+import itertools
+import json
+import os
+import random
+import secrets
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+from CServer import encode_frame, parse_frames, raise_fd_limit, FRAME_MAGIC, FRAME_VERSION, FRAME_TEXT, FRAME_FILE_CHUNK, FRAME_CHAT, CHAT_ID
+from Client import RecvBuffer, parse_frames as client_parse_frames, FRAME_HEADER
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "CServer.py")
+BENCH_LINE = re.compile(r"> bench (\d+) ([\d.]+)$")
+
+# --- Helpers ---
+class BenchClient:
+    # A framed client that records when every line arrives
+    def __init__(self, port, nickname):
+        self.nickname = nickname
+        self.sock = socket.create_connection(("127.0.0.1", port), timeout=10)
+        prompt = b""
+        while b"nickname: " not in prompt:
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError(f"server closed the connection: {prompt!r}")
+            prompt += data
+        self.sock.sendall(FRAME_MAGIC + bytes([FRAME_VERSION]) + encode_frame(FRAME_TEXT, nickname.encode('utf-8')))
+        self.sock.settimeout(None)
+        self.lines = []  # (arrival time, line)
+        threading.Thread(target=self.reader, daemon=True).start()
+
+    def reader(self):
+        buf = bytearray()
+        try:
+            while True:
+                data = self.sock.recv(65536)
+                if not data:
+                    break
+                now = time.time()
+                buf += data
+                for frame_type, payload in parse_frames(buf):
+                    if frame_type == FRAME_CHAT:
+                        frame_type, payload = FRAME_TEXT, payload[CHAT_ID.size:]
+                    if frame_type == FRAME_TEXT:
+                        for line in payload.decode('utf-8', errors='replace').splitlines():
+                            self.lines.append((now, line))
+        except OSError:
+            pass
+
+    def send(self, text):
+        self.sock.sendall(encode_frame(FRAME_TEXT, text.encode('utf-8')))
+
+    def wait_for(self, pattern, timeout=10):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            for _, line in list(self.lines):
+                if re.search(pattern, line):
+                    return line
+            time.sleep(0.05)
+        return None
+
+    def close(self):
+        try:
+            self.sock.close()
+        except OSError:
+            pass
+
+def cpu_seconds(pid):
+    # User + system CPU time of a process; None where /proc is not available
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+def percentile(values, pct):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+# --- Cluster harness ---
+# Starts --nodes servers on this machine, links each one to every node started
+# before it (a full mesh), puts --clients clients on every node into one room
+# and has the first client of node0 send --messages lines. Reports delivery,
+# latency (node0 is local to the sender, the others are one cluster hop away)
+# and each server's CPU time per message sent.
+def start_node(index, args, workdir):
+    port = args.base_port + 2 * index
+    command = [sys.executable, SERVER, "--port", str(port), "--cluster-port", str(port + 1),
+               "--node-name", f"node{index}", "--no-discovery", "--history-db", os.path.join(workdir, f"node{index}.db"),
+               "--cluster-secret", args.secret]
+    for other in range(index):
+        command += ["--peer", f"127.0.0.1:{args.base_port + 2 * other + 1}"]
+    log = open(os.path.join(workdir, f"node{index}.log"), "w")
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT)
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return process, port
+
+def run_cluster(args):
+    workdir = tempfile.mkdtemp(prefix="communicator_bench_")
+    print(f"[INFO] Starting {args.nodes} nodes (logs in {workdir})")
+    nodes = [start_node(i, args, workdir) for i in range(args.nodes)]
+    clients = []
+    try:
+        for i, (_, port) in enumerate(nodes):
+            for j in range(args.clients):
+                client = BenchClient(port, f"n{i}c{j}")
+                client.node = i
+                clients.append(client)
+        # Wait until node0 sees every client of the cluster
+        sender = clients[0]
+        everyone = [c.nickname for c in clients]
+        deadline = time.time() + 15
+        while time.time() < deadline:
+            sender.send("/list")
+            line = sender.wait_for(r"SERVER> LIST: ", 1)
+            if line and all(n in line for n in everyone):
+                break
+            sender.lines.clear()
+        else:
+            print("[ERROR] The nodes did not link up, see the node logs")
+            return
+        for client in clients:
+            client.send("/join bench")
+        for client in clients:
+            client.wait_for(r"Joined room 'bench'")
+        time.sleep(0.5)  # let the room changes reach every node
+        for client in clients:
+            client.lines.clear()
+
+        cpu_before = [cpu_seconds(p.pid) for p, _ in nodes]
+        started = time.time()
+        for seq in range(args.messages):
+            sender.send(f"bench {seq} {time.time():.6f}")
+            time.sleep(max(0.0, started + (seq + 1) / args.rate - time.time()))
+        deadline = time.time() + 10
+        receivers = clients[1:]
+        while time.time() < deadline:
+            if all(sum(1 for _, l in c.lines if BENCH_LINE.search(l)) >= args.messages for c in receivers):
+                break
+            time.sleep(0.05)
+        elapsed = time.time() - started
+        cpu_after = [cpu_seconds(p.pid) for p, _ in nodes]
+
+        print(f"[INFO] {args.messages} messages at {args.rate}/s from n0c0 to {len(receivers)} clients on {args.nodes} nodes ({elapsed:.1f} s)")
+        for i in range(args.nodes):
+            latencies = []
+            delivered = 0
+            for client in receivers:
+                if client.node != i:
+                    continue
+                for arrived, line in client.lines:
+                    m = BENCH_LINE.search(line)
+                    if m:
+                        delivered += 1
+                        latencies.append((arrived - float(m.group(2))) * 1000)
+            expected = args.messages * sum(1 for c in receivers if c.node == i)
+            cpu = "n/a"
+            if cpu_before[i] is not None and cpu_after[i] is not None:
+                cpu = f"{(cpu_after[i] - cpu_before[i]) * 1000 / args.messages:.3f} ms/message"
+            print(f"[INFO] node{i} ({'local' if i == 0 else 'remote'}): {delivered}/{expected} delivered, latency "
+                  f"p50 {percentile(latencies, 50):.2f} ms, p99 {percentile(latencies, 99):.2f} ms, "
+                  f"max {max(latencies, default=float('nan')):.2f} ms, server CPU {cpu}")
+    finally:
+        for client in clients:
+            client.close()
+        for process, _ in nodes:
+            process.terminate()
+        for process, _ in nodes:
+            process.wait()
+
+# --- Receive buffer micro-benchmark ---
+# Streams --megabytes of chat lines, then of file chunk frames, through a
+# socket pair and parses them the way Client.receive() used to (recv(4096)
+# appended to a bytearray, every message sliced off the front) and with
+# RecvBuffer. Both parsers decode every line and touch every chunk.
+def old_lines(sock):
+    buffer = bytearray()
+    count = 0
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            break
+        buffer += data
+        while True:
+            msg_end = buffer.find(b'\n')
+            if msg_end == -1:
+                break
+            buffer[:msg_end].decode('utf-8', errors='replace').strip()
+            buffer = buffer[msg_end+1:]
+            count += 1
+    return count
+
+def new_lines(sock):
+    buffer = RecvBuffer()
+    count = 0
+    scanned = 0
+    while buffer.recv_from(sock):
+        end = buffer.find(b"\n/sendfile ", scanned)
+        if end == -1:
+            end = buffer.rfind(b'\n', scanned)
+        if end == -1:
+            scanned = len(buffer)
+            continue
+        scanned = 0
+        for msg in str(buffer.take(end + 1), 'utf-8', errors='replace').split('\n'):
+            if msg.strip():
+                count += 1
+    return count
+
+def old_frames(sock):
+    buffer = bytearray()
+    count = 0
+    while True:
+        data = sock.recv(4096)
+        if not data:
+            break
+        buffer += data
+        pos = 0
+        while len(buffer) - pos >= FRAME_HEADER.size:
+            version, frame_type, length = FRAME_HEADER.unpack_from(buffer, pos)
+            if len(buffer) < pos + FRAME_HEADER.size + length:
+                break
+            bytes(buffer[pos + FRAME_HEADER.size:pos + FRAME_HEADER.size + length])
+            pos += FRAME_HEADER.size + length
+            count += 1
+        del buffer[:pos]
+    return count
+
+def new_frames(sock):
+    buffer = RecvBuffer()
+    count = 0
+    while buffer.recv_from(sock):
+        for frame_type, payload in client_parse_frames(buffer):
+            count += 1
+    return count
+
+def time_parser(parser, data):
+    reader, writer = socket.socketpair()
+    def write():
+        writer.sendall(data)
+        writer.shutdown(socket.SHUT_WR)
+    feeder = threading.Thread(target=write)
+    started = time.perf_counter()
+    feeder.start()
+    count = parser(reader)
+    elapsed = time.perf_counter() - started
+    feeder.join()
+    reader.close()
+    writer.close()
+    return count, elapsed
+
+def run_recvbuf(args):
+    size = args.megabytes * 1024 * 1024
+    line = b"12:00:00 somebody> " + b"x" * max(0, args.line_bytes - 20) + b"\n"
+    chunk = encode_frame(FRAME_FILE_CHUNK, b"\0" * (64 * 1024 + 4))
+    workloads = [("chat lines", line * (size // len(line)), old_lines, new_lines),
+                 ("file chunks", chunk * (size // len(chunk)), old_frames, new_frames)]
+    for name, data, old, new in workloads:
+        old_count, old_time = time_parser(old, data)
+        new_count, new_time = time_parser(new, data)
+        if old_count != new_count:
+            print(f"[ERROR] {name}: parsers disagree ({old_count} vs {new_count} messages)")
+        mb = len(data) / 1024 / 1024
+        print(f"[INFO] {name}: {mb:.0f} MB, {new_count} messages, old {mb / old_time:.0f} MB/s, "
+              f"RecvBuffer {mb / new_time:.0f} MB/s ({old_time / new_time:.1f}x)")
+
+# --- Load generator ---
+# Runs --clients simulated clients on one asyncio loop against a server
+# (started here, or the one at --host/--port). Every client logs in the way
+# Client.py does: it answers the PROTO advert and "Enter your nickname: ",
+# gives --admin-password when the server asks for one, then joins its room.
+# Once everyone is in, the clients send --rate lines per second in total for
+# --duration seconds:
+#   room    everyone in one room, chat lines
+#   rooms   rooms of --room-size, chat lines
+#   dm      /msg to another client
+#   files   /sendfile of --file-bytes to another client
+# plus a /typing before every --typing-every-th line. Each line carries a tag
+# ("bench <seq> <sent at>") that receivers time, so the report gives delivery
+# latency percentiles, throughput and the server's resident memory.
+#
+# The lines to send are a trace: --save-trace writes it as JSON lines, and
+# --replay sends a saved one again, --speed times faster. `record` writes the
+# same format by sitting between real clients and a server, so real sessions
+# can be replayed too. Logins happen up front; every other line is sent at its
+# time. TAG_MARK in a line is replaced with a fresh tag when it is sent.
+TAG_MARK = "{bench}"
+BENCH_TAG = re.compile(r"bench (\d+) (\d+\.\d+)")
+
+def tag_template(line):
+    # Where a recorded line gets its latency tag when replayed
+    if not line.startswith("/"):
+        return f"{TAG_MARK} {line}"
+    if line.startswith("/msg "):
+        parts = line.split(" ", 2)
+        if len(parts) == 3:
+            return f"/msg {parts[1]} {TAG_MARK} {parts[2]}"
+    return line
+
+def rss_megabytes(pid):
+    # Resident memory of a process and its children (workers); None where
+    # /proc is not available
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            rss = next(int(l.split()[1]) for l in f if l.startswith("VmRSS:")) / 1024
+    except (OSError, StopIteration, ValueError):
+        return None
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            children = f.read().split()
+    except OSError:
+        children = []
+    return rss + sum(rss_megabytes(int(child)) or 0 for child in children)
+
+def generate_trace(args):
+    rng = random.Random(args.seed)
+    count = args.clients
+    nicknames = [f"load{i}" for i in range(count)]
+    if args.admin:
+        nicknames[0] = args.admin
+    if args.scenario == "room":
+        rooms = ["bench"] * count
+    elif args.scenario == "rooms":
+        rooms = [f"bench{i // args.room_size}" for i in range(count)]
+    else:
+        rooms = [None] * count
+    members = Counter(rooms)
+    trace = [{"client": i, "login": nicknames[i], "admin": bool(args.admin) and i == 0, "room": rooms[i]}
+             for i in range(count)]
+    padding = "x" * args.message_bytes
+    data = base64.b64encode(rng.randbytes(args.file_bytes)).decode('ascii') if args.scenario == "files" else ""
+    for seq in range(int(args.duration * args.rate)):
+        at = seq / args.rate
+        sender = rng.randrange(count)
+        target = (sender + rng.randrange(1, count)) % count if count > 1 else sender
+        if args.typing_every and seq % args.typing_every == 0:
+            trace.append({"t": at, "client": sender, "line": "/typing"})
+        if args.scenario in ("room", "rooms"):
+            trace.append({"t": at, "client": sender, "line": f"{TAG_MARK} {padding}", "expect": members[rooms[sender]] - 1})
+        elif args.scenario == "dm":
+            trace.append({"t": at, "client": sender, "line": f"/msg {nicknames[target]} {TAG_MARK} {padding}", "expect": 1})
+        else:
+            trace.append({"t": at, "client": sender, "line": f"/sendfile {nicknames[target]} {TAG_MARK}:::{data}", "expect": 1})
+    return trace
+
+def load_trace(path):
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+class LoadClient:
+    def __init__(self, run, index, login):
+        self.run = run
+        self.index = index
+        self.nickname = login["login"]
+        self.admin = login.get("admin", False)
+        self.room = login.get("room")
+        self.logged_in = asyncio.Event()
+        self.joined = asyncio.Event()
+        self.writer = None
+
+    async def connect(self):
+        args = self.run.args
+        reader, self.writer = await asyncio.open_connection(args.host, args.port)
+        prompt = b""
+        while b"nickname: " not in prompt:
+            data = await reader.read(4096)
+            if not data:
+                raise ConnectionError(f"server closed the connection: {prompt!r}")
+            prompt += data
+        nickname = self.nickname.encode('utf-8')
+        self.writer.write(FRAME_MAGIC + bytes([args.proto]) + encode_frame(FRAME_TEXT, nickname, args.proto))
+        self.reader_task = asyncio.create_task(self.read_loop(reader))
+        await asyncio.wait_for(self.logged_in.wait(), 30)
+        if self.room:
+            self.send(f"/join {self.room}")
+            await asyncio.wait_for(self.joined.wait(), 30)
+
+    def send(self, line):
+        # Always framed: a plain text server takes whatever one recv() returns
+        # as one line, so lines sent back to back would run together
+        self.writer.write(encode_frame(FRAME_TEXT, line.encode('utf-8'), self.run.args.proto))
+
+    async def read_loop(self, reader):
+        buf = bytearray()
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                buf += data
+                for frame_type, payload in parse_frames(buf):
+                    if frame_type == FRAME_CHAT:
+                        frame_type, payload = FRAME_TEXT, payload[CHAT_ID.size:]
+                    if frame_type == FRAME_TEXT:
+                        self.received(payload.decode('utf-8', errors='replace'))
+        except (OSError, ValueError):
+            pass
+        self.run.closed += 1
+
+    def received(self, text):
+        run = self.run
+        now = time.time()
+        for line in text.splitlines():
+            m = BENCH_TAG.search(line)
+            if m:
+                if run.senders.get(int(m.group(1))) != self.index:
+                    run.delivered += 1
+                    run.latencies.append((now - float(m.group(2))) * 1000)
+            elif line.startswith("Enter admin password"):
+                self.send(run.args.admin_password)
+            elif line in ("Welcome.", "Admin access granted."):
+                self.logged_in.set()
+            elif "Joined room '" in line:
+                self.joined.set()
+
+class LoadRun:
+    def __init__(self, args, trace, server_pid):
+        self.args = args
+        self.logins = [e for e in trace if "login" in e]
+        admins = {e["client"] for e in trace if e.get("admin")}
+        for login in self.logins:
+            login["admin"] = login["client"] in admins
+        self.events = sorted((e for e in trace if "line" in e), key=lambda e: e["t"])
+        self.server_pid = server_pid
+        self.clients = {}
+        self.senders = {}     # tag seq: sending client
+        self.latencies = []
+        self.delivered = 0
+        self.expected = 0
+        self.closed = 0
+        self.rss = []
+
+    async def login(self, login, slots):
+        client = LoadClient(self, login["client"], login)
+        async with slots:
+            try:
+                await client.connect()
+                self.clients[client.index] = client
+            except (OSError, ConnectionError, asyncio.TimeoutError) as e:
+                print(f"[ERROR] {client.nickname} could not log in: {e or type(e).__name__}")
+                if client.writer:
+                    client.writer.close()
+
+    async def sample_rss(self):
+        while self.server_pid:
+            rss = rss_megabytes(self.server_pid)
+            if rss is None:
+                return
+            self.rss.append(rss)
+            await asyncio.sleep(0.5)
+
+    async def main(self):
+        args = self.args
+        slots = asyncio.Semaphore(args.connect_concurrency)
+        started = time.time()
+        sampler = asyncio.create_task(self.sample_rss())
+        await asyncio.gather(*(self.login(login, slots) for login in self.logins))
+        print(f"[INFO] {len(self.clients)}/{len(self.logins)} clients logged in ({time.time() - started:.1f} s)")
+        rss_idle = self.rss[-1] if self.rss else None
+        seqs = itertools.count()
+        sent = 0
+        cpu_before = cpu_seconds(os.getpid())
+        started = time.time()
+        origin = self.events[0]["t"] if self.events else 0  # a recording starts before the first line
+        for event in self.events:
+            delay = started + (event["t"] - origin) / args.speed - time.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            client = self.clients.get(event["client"])
+            if client is None:
+                continue
+            line = event["line"]
+            if TAG_MARK in line:
+                seq = next(seqs)
+                self.senders[seq] = client.index
+                self.expected += event.get("expect") or 0
+                line = line.replace(TAG_MARK, f"bench {seq} {time.time():.6f}")
+                sent += 1
+            client.send(line)
+            if client.writer.transport.get_write_buffer_size() > 1024 * 1024:
+                await client.writer.drain()
+        send_time = time.time() - started
+        # Wait for the stragglers until nothing arrives for a while
+        last, idle = self.delivered, time.time()
+        while time.time() - idle < args.drain and (not self.expected or self.delivered < self.expected):
+            await asyncio.sleep(0.1)
+            if self.delivered != last:
+                last, idle = self.delivered, time.time()
+        elapsed = time.time() - started
+        cpu_after = cpu_seconds(os.getpid())
+        sampler.cancel()
+        for client in self.clients.values():
+            client.writer.close()
+
+        name = f"replay of {args.replay} at {args.speed}x" if args.replay else args.scenario
+        expected = f"/{self.expected}" if self.expected else ""
+        print(f"[INFO] {name}: {len(self.clients)} clients, {sent} tagged lines sent in {send_time:.1f} s "
+              f"({sent / max(send_time, 1e-9):.1f}/s), {self.delivered}{expected} delivered "
+              f"({self.delivered / max(elapsed, 1e-9):.0f}/s)")
+        print(f"[INFO] latency p50 {percentile(self.latencies, 50):.2f} ms, p99 {percentile(self.latencies, 99):.2f} ms, "
+              f"p99.9 {percentile(self.latencies, 99.9):.2f} ms, max {max(self.latencies, default=float('nan')):.2f} ms")
+        if self.rss:
+            print(f"[INFO] server RSS: {rss_idle:.1f} MB with everyone logged in, peak {max(self.rss):.1f} MB")
+        if cpu_before is not None and cpu_after is not None:
+            busy = (cpu_after - cpu_before) / max(elapsed, 1e-9) * 100
+            print(f"[INFO] load generator CPU {busy:.0f}%" + (" (saturated, the numbers include its own delays)" if busy > 90 else ""))
+        if self.closed:
+            print(f"[INFO] {self.closed} clients were disconnected by the server")
+
+def start_server(args, workdir):
+    command = [sys.executable, SERVER, "--port", str(args.port), "--mode", args.mode, "--workers", str(args.workers),
+               "--no-discovery", "--resume-grace", "0", "--history-db", os.path.join(workdir, "load.db")]
+    log = open(os.path.join(workdir, "server.log"), "w")
+    process = subprocess.Popen(command, stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT)
+    for _ in range(50):
+        try:
+            socket.create_connection(("127.0.0.1", args.port), timeout=1).close()
+            break
+        except OSError:
+            time.sleep(0.1)
+    return process
+
+def run_load(args):
+    raise_fd_limit()
+    trace = load_trace(args.replay) if args.replay else generate_trace(args)
+    if args.save_trace:
+        with open(args.save_trace, "w", encoding="utf-8") as f:
+            for event in trace:
+                f.write(json.dumps(event) + "\n")
+        print(f"[INFO] Trace written to {args.save_trace}")
+    process = None
+    server_pid = args.server_pid
+    if args.host is None:
+        workdir = tempfile.mkdtemp(prefix="communicator_load_")
+        print(f"[INFO] Starting a {args.mode} server (log in {workdir})")
+        args.host = "127.0.0.1"
+        process = start_server(args, workdir)
+        server_pid = process.pid
+    try:
+        asyncio.run(LoadRun(args, trace, server_pid).main())
+    finally:
+        if process:
+            process.terminate()
+            process.wait()
+
+# --- Session recorder ---
+# Listens on --listen and passes every connection through to the server at
+# --host/--port, writing what the clients send to --trace in the format
+# `load --replay` reads. Admin passwords are not written (replay uses
+# --admin-password), and neither are file chunk frames.
+def record_connection(client_sock, index, args, trace):
+    server_sock = socket.create_connection((args.host, args.port))
+    password_asked = threading.Event()
+    def downstream():
+        try:
+            while True:
+                data = server_sock.recv(65536)
+                if not data:
+                    break
+                if b"Enter admin password" in data:
+                    password_asked.set()
+                client_sock.sendall(data)
+        except OSError:
+            pass
+        client_sock.close()
+    threading.Thread(target=downstream, daemon=True).start()
+    buf = bytearray()
+    framed = None
+    try:
+        while True:
+            data = client_sock.recv(65536)
+            if not data:
+                break
+            server_sock.sendall(data)
+            buf += data
+            if framed is None:
+                if len(buf) <= len(FRAME_MAGIC) and FRAME_MAGIC.startswith(bytes(buf)):
+                    continue
+                framed = buf.startswith(FRAME_MAGIC)
+                if framed:
+                    del buf[:len(FRAME_MAGIC) + 1]
+            if framed:
+                lines = [bytes(p).decode('utf-8', errors='replace') for t, p in parse_frames(buf) if t == FRAME_TEXT]
+            else:
+                end = buf.rfind(b"\n")
+                lines = buf[:end].decode('utf-8', errors='replace').split("\n") if end != -1 else []
+                del buf[:end + 1]
+            for line in lines:
+                line = line.strip()
+                if "login" not in trace.clients.get(index, ()):
+                    trace.write({"client": index, "login": line, "room": None})
+                    trace.clients[index] = {"login"}
+                elif password_asked.is_set() and "password" not in trace.clients[index]:
+                    trace.write({"client": index, "admin": True})
+                    trace.clients[index].add("password")
+                elif line:
+                    trace.write({"t": round(time.time() - trace.started, 6), "client": index, "line": tag_template(line)})
+    except OSError:
+        pass
+    server_sock.close()
+
+class TraceWriter:
+    def __init__(self, path):
+        self.file = open(path, "w", encoding="utf-8")
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.clients = {}   # client: handshake lines seen
+
+    def write(self, event):
+        with self.lock:
+            self.file.write(json.dumps(event) + "\n")
+            self.file.flush()
+
+def run_record(args):
+    trace = TraceWriter(args.trace)
+    listener = socket.create_server(("0.0.0.0", args.listen))
+    print(f"[INFO] Recording sessions on port {args.listen} -> {args.host}:{args.port} into {args.trace} (Ctrl+C stops)")
+    try:
+        for index in itertools.count():
+            client_sock, address = listener.accept()
+            threading.Thread(target=record_connection, args=(client_sock, index, args, trace), daemon=True).start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        listener.close()
+        trace.file.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Communicator benchmarks")
+    commands = parser.add_subparsers(dest="command", required=True)
+    cluster = commands.add_parser("cluster", help="cross-node latency and fan-out cost of a local cluster")
+    cluster.add_argument("--nodes", type=int, default=3)
+    cluster.add_argument("--clients", type=int, default=3, help="clients per node")
+    cluster.add_argument("--messages", type=int, default=300)
+    cluster.add_argument("--rate", type=float, default=100, help="messages per second")
+    cluster.add_argument("--base-port", type=int, default=41000)
+    cluster.add_argument("--secret", default=secrets.token_hex(16), help="cluster secret of the nodes")
+    recvbuf = commands.add_parser("recvbuf", help="client receive buffer throughput, old parser vs RecvBuffer")
+    recvbuf.add_argument("--megabytes", type=int, default=64)
+    recvbuf.add_argument("--line-bytes", type=int, default=80)
+    load = commands.add_parser("load", help="delivery latency and throughput with many simulated clients")
+    load.add_argument("--scenario", choices=["room", "rooms", "dm", "files"], default="room")
+    load.add_argument("--clients", type=int, default=1000)
+    load.add_argument("--rate", type=float, default=200, help="tagged lines per second, all clients together")
+    load.add_argument("--duration", type=float, default=20, help="seconds of traffic")
+    load.add_argument("--room-size", type=int, default=10, help="clients per room (rooms scenario)")
+    load.add_argument("--message-bytes", type=int, default=64)
+    load.add_argument("--file-bytes", type=int, default=16 * 1024, help="file size (files scenario)")
+    load.add_argument("--typing-every", type=int, default=10, help="send /typing before every Nth line (0: never)")
+    load.add_argument("--seed", type=int, default=1, help="seed for the generated trace")
+    load.add_argument("--admin", metavar="NICKNAME", help="log the first client in as this admin")
+    load.add_argument("--admin-password", default="password")
+    load.add_argument("--proto", type=int, choices=range(1, FRAME_VERSION + 1), default=FRAME_VERSION,
+                      help="frame version to speak")
+    load.add_argument("--connect-concurrency", type=int, default=100, help="logins in progress at once")
+    load.add_argument("--drain", type=float, default=5, help="seconds to wait for late deliveries")
+    load.add_argument("--save-trace", metavar="FILE", help="write the generated trace to FILE")
+    load.add_argument("--replay", metavar="FILE", help="send a saved or recorded trace instead of generating one")
+    load.add_argument("--speed", type=float, default=1, help="replay this many times faster")
+    load.add_argument("--host", help="load this server instead of starting one")
+    load.add_argument("--port", type=int, default=42000)
+    load.add_argument("--server-pid", type=int, help="pid of the --host server, for its RSS")
+    load.add_argument("--mode", choices=["threaded", "async"], default="threaded", help="mode of the started server")
+    load.add_argument("--workers", type=int, default=0, help="workers of the started server")
+    record = commands.add_parser("record", help="record real client sessions as a trace for load --replay")
+    record.add_argument("--listen", type=int, required=True, help="port the clients connect to")
+    record.add_argument("--host", default="127.0.0.1")
+    record.add_argument("--port", type=int, default=3256)
+    record.add_argument("--trace", required=True)
+    args = parser.parse_args()
+    if args.command == "cluster":
+        run_cluster(args)
+    elif args.command == "recvbuf":
+        run_recvbuf(args)
+    elif args.command == "load":
+        run_load(args)
+    elif args.command == "record":
+        run_record(args)
@@ -4,33 +4,701 @@ import http.server
 import socketserver
 import socket
 import threading
-import http.server
-import socketserver
-from collections import defaultdict
+import abc
+from collections import defaultdict, deque
 import time
 import base64
 import os
+import sys
+import asyncio
+import argparse
+import struct
+import itertools
+import sqlite3
+import pickle
+import multiprocessing
+import json
+import secrets
+import hmac
+import hashlib
+import select
+import selectors
+import tempfile
+import types
 
 HOST = '0.0.0.0'
 PORT = 3256
+SERVER_MODE = "threaded"  # "threaded" (one thread per client) or "async" (single event loop)
+WORKERS = 0               # worker processes sharing the listening socket (0: serve in this process)
+CLUSTER_PORT = 0          # port other servers link to (0: accept no links)
+PEERS = []                # host:cluster_port of servers to link to
+CLUSTER_SECRET = None     # shared by the servers of a cluster (None: only --peer hosts may link)
+NODE_NAME = None          # this server's name in the cluster (default hostname:port)
+PEER_RETRY = 5            # seconds between attempts to reach a peer
+DISCOVERY = True          # announce this server on the LAN and answer discovery queries
+DISCOVERY_GROUP = "239.255.32.56"
+DISCOVERY_PORT = 3257
+DISCOVERY_SERVICE = "lan-communicator"
+ANNOUNCE_INTERVAL = 5     # seconds between multicast announcements
+QUERY_REPLY_RATE = 20     # discovery replies per second, at most
+QUERY_REPLY_INTERVAL = 1  # seconds between two replies to the same address
+OUTBOUND_QUEUE_SIZE = 256       # messages buffered per client before OVERFLOW_POLICY applies
+OVERFLOW_POLICY = "drop_oldest"  # "drop_oldest" or "disconnect" the slow consumer
+WRITE_BATCH = 64                 # queued messages coalesced into one vectored write
+HISTORY_DB = "chat_history.db"   # SQLite file holding every room's chat log
+HISTORY_REPLAY = 50              # messages replayed on join and per /history page
+HISTORY_TAIL = 500               # newest messages per room kept in memory
+HISTORY_FLUSH_INTERVAL = 0.2     # seconds the history writer waits to batch inserts
+SEARCH_PAGE = 10                 # /search results per page
+SEARCH_MAX_PAGE = 1000           # highest page:<n> /search accepts
+SYNC_LIMIT = 500                 # messages /sync sends at most
+RESUME_GRACE = 60                # seconds a dropped client's session is kept for it to resume
+TYPING_TTL = 6                   # seconds a /typing counts for unless the client repeats it
+TYPING_INTERVAL = 1.0            # seconds between two typing updates to the same room, at least
+TYPING_NAMES = 20                # typers named in an update, the others are only counted
+METRICS_PORT = 0                 # side port serving GET /metrics (0: no endpoint)
+METRICS_ROOMS = 32               # rooms labelled by name in /metrics; later ones count as "other"
+PROFILE_HZ = 100                 # stack samples per second of /profile start
+PROFILE_MAX_HZ = 1000            # /profile start asks for more than this: clamped
+PROFILE_DIR = "."                # where /profile dump writes, unless given a directory
 
 clients = []
-nicknames = {}
 blocked_nicknames = set()
 banned_ips = set()
 ADMINS = {"username"}
 ADMIN_PASSWORD = "password"
-admin_clients = set()
 vote_kick_votes = defaultdict(set)
 reports = defaultdict(set)
 reputation = defaultdict(int)
 user_rep_votes = defaultdict(set)  # {target_nick: set(voter_nick)}
 client_versions = {}  # Add at the top with other globals
-user_status = defaultdict(lambda: "online")  # New: user status
-user_rooms = defaultdict(lambda: "main")     # New: user chat room
 chat_rooms = defaultdict(set)                # room_name: set of client sockets
 last_messages = {}                           # client_socket: (timestamp, msg)
-typing_users = defaultdict(set)              # room_name: set of nicknames typing
+typing_users = None                          # TypingTracker, started with the server
+outbound_stats = {"dropped": 0, "disconnected": 0}  # overflow counters for /queues
+# Fan-out counters for /fanout. Writers count into their own connection and
+# hand the totals over here when the connection goes away. Broadcasts are
+# counted lock-free in the messages_total metric (per-thread shards).
+fanout_stats = {"deliveries": 0, "writes": 0, "bytes": 0}
+fanout_stats_lock = threading.Lock()
+fanout_mark = {"time": time.time(), "messages": 0}
+
+# --- Sessions ---
+# One Session per logged-in client. The registry indexes them by connection,
+# nickname and IP so every lookup is O(1), and it updates all indexes (plus
+# chat_rooms membership) under a single lock on join, rename, room change
+# and leave.
+#
+# It also keeps the presence version: every join, leave, rename and status
+# change bumps it. Version 4 clients keep their own user list, a snapshot at
+# login followed by one numbered FRAME_PRESENCE per change; a client that
+# sees a gap in the numbers asks for a new snapshot with /roster.
+class Session:
+    def __init__(self, conn, nickname):
+        self.conn = conn
+        self.nickname = nickname
+        self.ip = conn.address[0]
+        self.room = "main"
+        self.status = "online"
+        self.is_admin = False
+        self.key = None        # (worker, n): names the session across workers
+        self.remote = False    # connected to another worker
+        self.token = None      # lets the client resume the session after a dropped connection
+
+class SessionRegistry:
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.by_conn = {}
+        self.by_nick = {}
+        self.by_ip = defaultdict(set)
+        self.by_key = {}
+        self.by_token = {}
+        self.keys = itertools.count()
+        self.version = 0          # presence version
+        self.watchers = set()     # local connections that keep a user list
+        self.list_cache = (-1, "")  # (version, /list reply) for older clients
+
+    def __len__(self):
+        return len(self.by_conn)
+
+    def __contains__(self, conn):
+        return conn in self.by_conn
+
+    def get(self, conn):
+        return self.by_conn.get(conn)
+
+    def find(self, nickname):
+        return self.by_nick.get(nickname)
+
+    def from_key(self, key):
+        return self.by_key.get(key)
+
+    def from_token(self, token):
+        return self.by_token.get(token)
+
+    def from_ip(self, ip):
+        return list(self.by_ip.get(ip, ()))
+
+    def all(self):
+        return list(self.by_conn.values())
+
+    def unique_nickname(self, nickname):
+        # Nicknames are the key for /msg and friends, so they must be unique
+        with self.lock:
+            candidate, n = nickname, 1
+            while candidate in self.by_nick:
+                n += 1
+                candidate = f"{nickname}_{n}"
+            return candidate
+
+    def add(self, conn, nickname, room="main"):
+        with self.lock:
+            session = Session(conn, self.unique_nickname(nickname))
+            session.key = (worker_id, next(self.keys))
+            session.room = room
+            self.index(session)
+            self.publish(session, "join", session.nickname, session.ip, room, session.status, conn.framed)
+            self.announce("join", session, status=session.status)
+            return session
+
+    # A client of another worker, announced over the bus, or of a cluster
+    # peer. A peer's keys are prefixed with its node name.
+    def add_remote(self, key, nickname, ip, room, status, framed, link=None):
+        with self.lock:
+            local_key = key if link is None else (link.node,) + key
+            if local_key in self.by_key:
+                return self.by_key[local_key]
+            holder = self.by_nick.get(nickname)
+            session = Session(RemoteConnection(key, (ip, 0), framed, link or bus), nickname)
+            session.key, session.room, session.status, session.remote = local_key, room, status, True
+            self.index(session)
+            self.announce("join", session, status=status)
+            if holder is not None:
+                self.settle_clash(session, holder)
+            return session
+
+    # Two servers gave out the same nickname at the same moment. Every server
+    # sees both claims and keeps the same one, the older by claim_order();
+    # whoever owns the other session renames it, which reaches everyone as
+    # an ordinary rename. Called with lock held.
+    def settle_clash(self, arrived, holder):
+        if self.claim_order(arrived) < self.claim_order(holder):
+            winner, loser = arrived, holder
+        else:
+            winner, loser = holder, arrived
+        self.by_nick[winner.nickname] = winner
+        if loser.remote:
+            return
+        old, new = loser.nickname, self.unique_nickname(loser.nickname)
+        print(f"[INFO] Nickname {old} was taken elsewhere in the cluster, renaming it to {new}")
+        self.rename(loser, new)
+        try:
+            loser.conn.sendall(f"{timestamp()} SERVER> Nickname {old} was taken at the same moment elsewhere, you are now {new}.\n".encode('utf-8'))
+        except Exception:
+            pass
+
+    # The same on every server: a session's node, then its key there
+    @staticmethod
+    def claim_order(session):
+        if session.remote and isinstance(session.conn.link, PeerLink):
+            return (session.conn.link.node, repr(session.conn.key))
+        return (NODE_NAME or "", repr(session.conn.key if session.remote else session.key))
+
+    # A session handed over by the process this one replaced (see hot
+    # restart). To everyone else it never left, so nothing is published.
+    def restore(self, conn, state):
+        with self.lock:
+            session = Session(conn, state["nickname"])
+            session.key = (worker_id, next(self.keys))
+            session.room, session.status, session.is_admin = state["room"], state["status"], state["is_admin"]
+            session.token = state["token"]
+            if session.token:
+                self.by_token[session.token] = session
+            self.index(session)
+            if state["watcher"]:
+                self.watchers.add(conn)
+            return session
+
+    # The worker number leads the token, so a worker that gets a client
+    # back knows which worker to ask for its session
+    def issue_token(self, session):
+        with self.lock:
+            session.token = f"{worker_id or 0}.{secrets.token_urlsafe(16)}"
+            self.by_token[session.token] = session
+            return session.token
+
+    # Hand a session over to another connection: the stand-in that holds it
+    # while the client is away, or the client's new connection. Nothing is
+    # published, to everyone else the session never left. Returns the old
+    # connection.
+    def replace_conn(self, session, conn):
+        with self.lock:
+            old = session.conn
+            del self.by_conn[old]
+            self.by_conn[conn] = session
+            chat_rooms[session.room].discard(old)
+            chat_rooms[session.room].add(conn)
+            self.watchers.discard(old)  # a resumed client gets a new snapshot
+            if conn.address[0] != session.ip:
+                self.by_ip[session.ip].discard(session)
+                if not self.by_ip[session.ip]:
+                    del self.by_ip[session.ip]
+                session.ip = conn.address[0]
+                self.by_ip[session.ip].add(session)
+            session.conn = conn
+            return old
+
+    # A session resumed on another worker (see hand_over_session) moves there
+    # without a leave or a join: the old worker drops it without telling
+    # anyone, the new one indexes it under a key of its own and publishes
+    # "handover", and every worker swaps the key of its copy. To the users
+    # it never left.
+    def hand_over(self, conn):
+        with self.lock:
+            session = self.by_conn.get(conn)
+            if session is not None:
+                self.unindex(session)
+            return session
+
+    def take_over(self, conn, old_key, nickname, room, status):
+        with self.lock:
+            known = self.by_key.get(old_key)
+            if known is not None:
+                self.unindex(known)  # our copy of it, as a client of the old worker
+            session = Session(conn, nickname)
+            session.key = (worker_id, next(self.keys))
+            session.room, session.status = room, status
+            self.index(session)
+            self.publish(session, "handover", old_key, nickname, session.ip, room, status, conn.framed)
+            return session
+
+    def handed_over(self, key, old_key, nickname, ip, room, status, framed):
+        with self.lock:
+            known = self.by_key.get(old_key)
+            if known is not None:
+                self.unindex(known)
+            session = Session(RemoteConnection(key, (ip, 0), framed, bus), nickname)
+            session.key, session.room, session.status, session.remote = key, room, status, True
+            self.index(session)
+            return session
+
+    # Called with lock held. Only local clients are members of chat_rooms,
+    # other workers deliver to their own.
+    def index(self, session):
+        self.by_conn[session.conn] = session
+        self.by_nick.setdefault(session.nickname, session)
+        self.by_key[session.key] = session
+        self.by_ip[session.ip].add(session)
+        if not session.remote:
+            chat_rooms[session.room].add(session.conn)
+
+    # Tell the other workers and cluster peers about a change to one of our
+    # sessions
+    def publish(self, session, kind, *args):
+        if session.remote:
+            return
+        if bus:
+            bus.publish((kind, session.key) + args)
+        if peer_links:
+            publish_to_peers((kind, session.key) + args)
+
+    # Called with lock held: the frames go out in version order
+    def announce(self, op, session, **fields):
+        self.version += 1
+        change = dict(v=self.version, op=op, nick=session.nickname, **fields)
+        frame = encode_frame(FRAME_PRESENCE, json.dumps(change).encode('utf-8'))
+        for conn in list(self.watchers):
+            try:
+                conn.enqueue(frame)
+            except Exception:
+                pass
+        if op in ("join", "leave"):
+            # Older clients only get the count, and only in the main room
+            count = Payload(f"{timestamp()} SERVER> Users connected: {len(self.by_conn)}\n".encode('utf-8'))
+            for conn in list(chat_rooms.get("main", ())):
+                if conn.proto_version < 4:
+                    try:
+                        conn.sendall(count)
+                    except Exception:
+                        pass
+
+    def roster(self, conn):
+        # Send a version 4 client the whole user list; it follows the changes
+        # from there
+        with self.lock:
+            users = [[s.nickname, s.status] for s in self.by_conn.values()]
+            snapshot = {"v": self.version, "op": "snapshot", "users": users}
+            conn.send_frame(FRAME_PRESENCE, json.dumps(snapshot).encode('utf-8'))
+            self.watchers.add(conn)
+
+    def list_line(self):
+        # The /list reply, built again only after the user list changed
+        with self.lock:
+            if self.list_cache[0] != self.version:
+                userlist = ",".join(f"{s.nickname} [{reputation[s.nickname]}] ({s.status})" for s in self.by_conn.values())
+                self.list_cache = (self.version, userlist)
+            return self.list_cache[1]
+
+    def rename(self, session, new_nickname):
+        with self.lock:
+            holder = self.by_nick.get(new_nickname)
+            if holder is not None and not session.remote:
+                return False
+            self.announce("rename", session, new=new_nickname)
+            if self.by_nick.get(session.nickname) is session:
+                del self.by_nick[session.nickname]
+            session.nickname = new_nickname
+            self.publish(session, "rename", new_nickname)
+            if holder is None:
+                self.by_nick[new_nickname] = session
+            else:
+                self.settle_clash(session, holder)  # renamed elsewhere to a name taken here
+            return True
+
+    def set_status(self, session, status):
+        with self.lock:
+            session.status = status
+            self.publish(session, "status", status)
+            self.announce("status", session, status=status)
+
+    def move(self, session, new_room):
+        with self.lock:
+            if not session.remote:
+                chat_rooms[session.room].discard(session.conn)
+                if not chat_rooms[session.room]:
+                    del chat_rooms[session.room]
+                chat_rooms[new_room].add(session.conn)
+            session.room = new_room
+            self.publish(session, "move", new_room)
+
+    def remove(self, conn):
+        with self.lock:
+            session = self.by_conn.get(conn)
+            if session is None:
+                return None
+            self.unindex(session)
+            self.publish(session, "leave")
+            self.announce("leave", session)
+            return session
+
+    # Called with lock held
+    def unindex(self, session):
+        conn = session.conn
+        del self.by_conn[conn]
+        if self.by_nick.get(session.nickname) is session:
+            del self.by_nick[session.nickname]
+        del self.by_key[session.key]
+        self.by_token.pop(session.token, None)
+        self.by_ip[session.ip].discard(session)
+        if not self.by_ip[session.ip]:
+            del self.by_ip[session.ip]
+        if not session.remote:
+            chat_rooms[session.room].discard(conn)
+            if not chat_rooms[session.room]:
+                del chat_rooms[session.room]
+        self.watchers.discard(conn)
+
+sessions = SessionRegistry()
+
+# --- Chat history ---
+# An append-only log of chat lines per room, stored in SQLite in WAL mode.
+# append() only assigns the next id and queues the row; a writer thread
+# inserts queued rows in batches, so logging never waits on the disk. The
+# newest HISTORY_TAIL rows of each room also stay in memory, which makes the
+# replay on join a deque slice. Rows are (id, time, nickname, text).
+class HistoryStore:
+    # Worker processes share one database; worker n of N hands out the ids
+    # that are n modulo N so their ids never collide, and skips ahead past
+    # the ids of the others (see remember()) so ids keep growing over time.
+    def __init__(self, path, id_offset=0, id_step=1):
+        self.lock = threading.Lock()
+        self.pending_ready = threading.Condition(self.lock)
+        self.pending = []    # queued rows, (id, room, time, nickname, text)
+        self.inflight = []   # rows the writer is inserting right now
+        self.tails = {}
+        self.closing = False
+        self.db = sqlite3.connect(path, check_same_thread=False)  # used by the writer only
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS messages (id INTEGER PRIMARY KEY, room TEXT NOT NULL, "
+                        "time REAL NOT NULL, nickname TEXT NOT NULL, text TEXT NOT NULL)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS messages_room ON messages (room, id)")
+        self.search_enabled = self.create_search_index()
+        self.db.commit()
+        last_id = self.db.execute("SELECT MAX(id) FROM messages").fetchone()[0] or 0
+        self.id_step = id_step
+        self.next_id = (last_id // id_step + 1) * id_step + id_offset
+        self.reader = sqlite3.connect(path, check_same_thread=False)
+        self.reader_lock = threading.Lock()
+        self.writer = threading.Thread(target=self.writer_loop, daemon=True)
+        self.writer.start()
+
+    # Full-text index over the log for /search. FTS5 keeps an inverted index
+    # that the insert trigger updates in the writer's batch transaction.
+    def create_search_index(self):
+        try:
+            exists = self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'messages_fts'").fetchone()
+            self.db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text, content='messages', content_rowid='id')")
+            self.db.execute("CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN "
+                            "INSERT INTO messages_fts (rowid, text) VALUES (new.id, new.text); END")
+            if not exists:
+                # Index whatever was logged before the index existed
+                self.db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('rebuild')")
+            return True
+        except sqlite3.OperationalError as e:
+            print(f"[ERROR] Chat search disabled, SQLite has no FTS5: {e}")
+            return False
+
+    # Best matches first (bm25, then newest). Returns rows of
+    # (id, room, time, nickname, text) and whether there is another page.
+    def search(self, terms, room=None, nickname=None, since=None, page=1):
+        # Quote every term so user input is never parsed as FTS syntax; a
+        # trailing * still makes a prefix search.
+        match = " ".join('"' + t.rstrip("*").replace('"', '""') + '"' + ("*" if t.endswith("*") else "") for t in terms)
+        sql = ("SELECT m.id, m.room, m.time, m.nickname, m.text FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid "
+               "WHERE messages_fts MATCH ?")
+        params = [match]
+        for column, value in (("m.room = ?", room), ("m.nickname = ?", nickname), ("m.time >= ?", since)):
+            if value is not None:
+                sql += " AND " + column
+                params.append(value)
+        sql += " ORDER BY rank, m.id DESC LIMIT ? OFFSET ?"
+        page = max(1, min(page, SEARCH_MAX_PAGE))  # SQLite takes 64-bit integers only
+        params += [SEARCH_PAGE + 1, (page - 1) * SEARCH_PAGE]
+        with self.reader_lock:
+            rows = self.reader.execute(sql, params).fetchall()
+        return rows[:SEARCH_PAGE], len(rows) > SEARCH_PAGE
+
+    def query(self, room, before_id, limit):
+        with self.reader_lock:
+            rows = self.reader.execute("SELECT id, time, nickname, text FROM messages WHERE room = ? AND id < ? "
+                                       "ORDER BY id DESC LIMIT ?", (room, before_id, limit)).fetchall()
+        rows.reverse()
+        return rows
+
+    # Called with lock held. A room's tail is loaded from disk the first time
+    # the room is used, before anything is appended to it in this run.
+    def tail(self, room):
+        tail = self.tails.get(room)
+        if tail is None:
+            tail = self.tails[room] = deque(self.query(room, 2 ** 63 - 1, HISTORY_TAIL), maxlen=HISTORY_TAIL)
+        return tail
+
+    def append(self, room, nickname, text):
+        with self.lock:
+            msg_id = self.next_id
+            self.next_id += self.id_step
+            now = time.time()
+            self.tail(room).append((msg_id, now, nickname, text))
+            self.pending.append((msg_id, room, now, nickname, text))
+            self.pending_ready.notify()
+        return (msg_id, now, nickname, text)
+
+    # A message another worker logged: keep our copy of the tail current,
+    # writing the row is that worker's job.
+    def remember(self, room, row):
+        with self.lock:
+            if row[0] >= self.next_id:
+                self.next_id += ((row[0] - self.next_id) // self.id_step + 1) * self.id_step
+            if room in self.tails:
+                self.tails[room].append(row)
+
+    # The newest `limit` messages of a room, or those older than before_id.
+    def recent(self, room, limit=HISTORY_REPLAY, before_id=None):
+        with self.lock:
+            tail = self.tail(room)
+            rows = [row for row in tail if before_id is None or row[0] < before_id]
+            if len(rows) >= limit or len(tail) < tail.maxlen:
+                return rows[-limit:]  # the tail holds everything that is needed
+            # Older rows may still be waiting for the writer; take those from
+            # the queue and everything else from the database.
+            oldest = rows[0][0] if rows else min(before_id, tail[0][0])
+            unwritten = {row[0]: (row[0],) + row[2:] for row in self.pending + self.inflight
+                         if row[1] == room and row[0] < oldest}
+        older = {row[0]: row for row in self.query(room, oldest, limit - len(rows))}
+        older.update(unwritten)
+        return [older[i] for i in sorted(older)][-(limit - len(rows)):] + rows
+
+    def writer_loop(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self.closing:
+                    self.pending_ready.wait()
+                closing = self.closing
+            if not closing:
+                time.sleep(HISTORY_FLUSH_INTERVAL)  # let a batch build up
+            with self.lock:
+                self.inflight, self.pending = self.pending, []
+            if self.inflight:
+                try:
+                    self.db.executemany("INSERT INTO messages VALUES (?, ?, ?, ?, ?)", self.inflight)
+                    self.db.commit()
+                except sqlite3.Error as e:
+                    print(f"[ERROR] Could not write chat history: {e}")
+                with self.lock:
+                    self.inflight = []
+            if closing:
+                return
+
+    # Flush everything queued so far and stop the writer.
+    def close(self):
+        with self.lock:
+            self.closing = True
+            self.pending_ready.notify()
+        self.writer.join(timeout=10)
+        with self.reader_lock:
+            self.reader.close()
+        self.db.close()
+
+history = None  # HistoryStore, opened at startup
+
+def log_chat(room, nickname, text):
+    row = history.append(room, nickname, text)
+    if bus:
+        bus.publish(("history", room, row))
+    if peer_links:
+        publish_to_peers(("history", room, row), room)
+    return row
+
+def format_history(rows):
+    today = time.strftime("%Y-%m-%d")
+    lines = []
+    for msg_id, when, nickname, text in rows:
+        stamp = time.localtime(when)
+        stamp = time.strftime("[%H:%M:%S]" if time.strftime("%Y-%m-%d", stamp) == today else "[%Y-%m-%d %H:%M]", stamp)
+        lines.append(f"{stamp} #{msg_id} {nickname}> {text}\n")
+    return "".join(lines)
+
+# since: accepts 30m, 2h, 7d or a YYYY-MM-DD date
+def parse_since(value):
+    units = {"m": 60, "h": 3600, "d": 86400}
+    if value[:-1].isdigit() and value[-1:] in units:
+        return time.time() - int(value[:-1]) * units[value[-1]]
+    return time.mktime(time.strptime(value, "%Y-%m-%d"))
+
+def send_search(client_socket, args):
+    terms, filters = [], {}
+    for word in args.split():
+        key, sep, value = word.partition(":")
+        if sep and key in ("room", "user", "since", "page") and value:
+            filters[key] = value
+        else:
+            terms.append(word)
+    try:
+        since = parse_since(filters["since"]) if "since" in filters else None
+        page = int(filters.get("page", 1))
+        if not terms or not 1 <= page <= SEARCH_MAX_PAGE:
+            raise ValueError
+    except (ValueError, OverflowError):  # OverflowError: a since: too far back for a float
+        client_socket.sendall(f"{timestamp()} SERVER> Usage: /search <terms> [room:<room>] [user:<nickname>] [since:<30m|2h|7d|YYYY-MM-DD>] [page:<1-{SEARCH_MAX_PAGE}>]\n".encode('utf-8'))
+        return
+    if not history.search_enabled:
+        client_socket.sendall(f"{timestamp()} SERVER> Search is not available on this server.\n".encode('utf-8'))
+        return
+    started = time.perf_counter()
+    rows, more = history.search(terms, filters.get("room"), filters.get("user"), since, page)
+    elapsed = (time.perf_counter() - started) * 1000
+    query = " ".join(terms)
+    if not rows:
+        client_socket.sendall(f"{timestamp()} SERVER> No results for '{query}'.\n".encode('utf-8'))
+        return
+    first = (page - 1) * SEARCH_PAGE + 1
+    header = f"{timestamp()} SERVER> Results {first}-{first + len(rows) - 1} for '{query}' ({elapsed:.1f} ms)"
+    if more:
+        header += f", next page: page:{page + 1}"
+    lines = [header + "\n"]
+    for msg_id, room, when, nickname, text in rows:
+        lines.append(f"{time.strftime('[%Y-%m-%d %H:%M]', time.localtime(when))} #{msg_id} ({room}) {nickname}> {text}\n")
+    client_socket.sendall("".join(lines).encode('utf-8'))
+
+# Version 2 clients get every row in its own FRAME_CHAT, so they can cache
+# it under its id.
+def send_rows(client_socket, header, rows):
+    if client_socket.proto_version < 2:
+        client_socket.sendall((header + format_history(rows)).encode('utf-8'))
+        return
+    client_socket.sendall(header.encode('utf-8'))
+    for row in rows:
+        client_socket.send_frame(FRAME_CHAT, CHAT_ID.pack(row[0]) + format_history([row]).encode('utf-8'))
+
+def send_history(client_socket, room, before_id=None):
+    rows = history.recent(room, HISTORY_REPLAY, before_id)
+    if not rows:
+        if before_id is not None:
+            client_socket.sendall(f"{timestamp()} SERVER> No older messages in '{room}'.\n".encode('utf-8'))
+        return
+    send_rows(client_socket, f"{timestamp()} SERVER> History of '{room}' ({len(rows)} messages, /history {rows[0][0]} for older):\n", rows)
+
+# What a client with a local cache missed: the messages after after_id, or
+# the usual replay when it has nothing cached yet. Returns the ids sent.
+def send_sync(client_socket, room, after_id):
+    limit = SYNC_LIMIT if after_id else HISTORY_REPLAY
+    rows = [row for row in history.recent(room, limit) if row[0] > after_id]
+    if not rows:
+        return set()
+    header = f"{timestamp()} SERVER> {len(rows)} new messages in '{room}'"
+    if len(rows) == limit:
+        header += f" (/history {rows[0][0]} for older)"
+    send_rows(client_socket, header + ":\n", rows)
+    return {row[0] for row in rows}
+
+# Searches, history pages and replays may have to read the database. In
+# async mode that would stall every client on the event loop, so they run
+# in the loop's default executor; in threaded mode they run in place, on the
+# client's own thread.
+def run_blocking(func, *args):
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        func(*args)
+        return
+    loop.run_in_executor(None, run_reporting, func, args)
+
+def run_reporting(func, args):
+    try:
+        func(*args)
+    except ConnectionError:
+        pass  # the client left meanwhile
+    except Exception as e:
+        print(f"[ERROR] {func.__name__} failed: {e}")
+
+# --- Framed protocol ---
+# Old clients send one command per recv() and read newline terminated text.
+# Newer clients answer the PROTO advert with FRAME_MAGIC + their highest
+# supported version and from then on both directions use frames:
+#   version (1 byte) | type (1 byte) | payload length (4 bytes, big endian) | payload
+FRAME_MAGIC = b"LCF"
+FRAME_VERSION = 4
+FRAME_HEADER = struct.Struct("!BBI")
+MAX_FRAME_SIZE = 8 * 1024 * 1024
+FRAME_HELLO = 0   # server -> client: negotiated version (1 byte)
+FRAME_TEXT = 1    # one command or chat line, UTF-8
+FRAME_FILE_OFFER = 2  # transfer id, size (!IQ) + "peer\0filename"
+FRAME_FILE_CHUNK = 3  # transfer id (!I) + raw file bytes
+FRAME_FILE_ACK = 4    # transfer id, bytes received so far (!IQ)
+FRAME_FILE_END = 5    # transfer id (!I)
+FRAME_FILE_ABORT = 6  # transfer id, upload flag (!IB) + reason, UTF-8
+FRAME_CHAT = 7        # server -> client, version 2: history id (!Q) + chat line, UTF-8
+FRAME_TYPING = 8      # server -> client, version 3: room, number typing, nicknames (NUL separated, UTF-8)
+FRAME_PRESENCE = 9    # server -> client, version 4: user list snapshot or change, JSON
+CHAT_ID = struct.Struct("!Q")
+PROTO_ADVERT = f"PROTO LCF/{FRAME_VERSION}\n".encode('utf-8')
+
+# --- Chunked file transfer ---
+# Framed clients stream files as raw chunks. The server relays each chunk as it
+# arrives; senders may only have FILE_WINDOW unacknowledged bytes in flight, so
+# a transfer never occupies more than one window of server memory.
+FILE_CHUNK_SIZE = 64 * 1024
+FILE_WINDOW = 8 * FILE_CHUNK_SIZE
+FILE_OFFER = struct.Struct("!IQ")
+FILE_ID = struct.Struct("!I")
+FILE_ACK = struct.Struct("!IQ")
+# The upload flag tells which id space an abort refers to: 1 when the id is the
+# uploading client's own id, 0 when it is the relay id the recipient was given.
+FILE_ABORT = struct.Struct("!IB")
+file_transfers = {}                    # relay id: FileTransfer
+file_transfers_lock = threading.Lock()
+transfer_ids = itertools.count(1)
 
 STICKERS = {
     "shrug": r"¯\_(ツ)_/¯",
@@ -38,374 +706,2611 @@ STICKERS = {
     "lenny": r"( ͡° ͜ʖ ͡°)",
 }
 
+# --- Metrics ---
+# With --metrics-port the server answers GET /metrics on a side port with
+# counters and histograms in the Prometheus text format. The hot paths only
+# write to a shard owned by their own thread, so they take no lock; a scrape
+# adds the shards up, and reads gauges (connections, queue depths, threads)
+# straight from the live state. Shards of threads that have ended are folded
+# into one at scrape time.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+BACKLOG_BUCKETS = (0, 1, 4, 16, 64, 128, 256, 1024)
+METRICS_HELP = {
+    "connections_total": ("counter", "Connections accepted."),
+    "connections": ("gauge", "Open client connections."),
+    "sessions": ("gauge", "Logged-in users, including other workers' and peers'."),
+    "rooms": ("gauge", "Rooms with local members."),
+    "threads": ("gauge", "Threads in this process (one per client in threaded mode)."),
+    "messages_total": ("counter", "Messages broadcast, by room (\"*\" is everyone, \"other\" rooms past the first METRICS_ROOMS)."),
+    "fanout_seconds": ("histogram", "Time to queue one broadcast for every recipient."),
+    "bytes_received_total": ("counter", "Bytes received from clients."),
+    "bytes_sent_total": ("counter", "Bytes written to clients."),
+    "outbound_backlog": ("histogram", "Messages queued per client connection."),
+    "outbound_dropped_total": ("counter", "Queued messages dropped for slow clients."),
+    "outbound_disconnected_total": ("counter", "Slow clients disconnected."),
+    "file_bytes_total": ("counter", "File transfer bytes relayed, chunked or as base64 text."),
+    "file_transfers": ("gauge", "File transfers in progress."),
+    "command_seconds": ("histogram", "Time to handle one line from a client, by command (\"chat\" for chat lines)."),
+}
+
+# Room names come from clients, so only the first METRICS_ROOMS seen get their
+# own label; the rest share "other" and a scrape stays a bounded size.
+metric_rooms = set()
+metric_rooms_lock = threading.Lock()
+
+def room_label(room):
+    if not room:
+        return "*"
+    if room in metric_rooms:
+        return room
+    with metric_rooms_lock:
+        if len(metric_rooms) < METRICS_ROOMS:
+            metric_rooms.add(room)
+            return room
+    return "other"
+
+class Metrics:
+    def __init__(self):
+        self.local = threading.local()
+        self.shards = []              # (thread, counters, histograms)
+        self.shards_lock = threading.Lock()
+        self.retired = ({}, {})       # what ended threads counted
+
+    def shard(self):
+        shard = getattr(self.local, "shard", None)
+        if shard is None:
+            shard = self.local.shard = (threading.current_thread(), defaultdict(int), {})
+            with self.shards_lock:
+                self.shards.append(shard)
+        return shard
+
+    def count(self, name, value=1, **labels):
+        self.shard()[1][(name, tuple(labels.items()))] += value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        histograms = self.shard()[2]
+        key = (name, tuple(labels.items()))
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = [buckets, [0] * len(buckets), 0.0, 0]
+        for i, bound in enumerate(buckets):
+            if value <= bound:
+                histogram[1][i] += 1
+                break
+        histogram[2] += value
+        histogram[3] += 1
+
+    def total(self, name):
+        # A counter summed over all its labels and shards
+        counters, _ = self.collect()
+        return sum(value for (key, _), value in counters.items() if key == name)
+
+    @staticmethod
+    def quantile(histogram, q):
+        # Upper bound of the bucket holding quantile q
+        buckets, counts, total, n = histogram
+        seen = 0
+        for bound, count in zip(buckets, counts):
+            seen += count
+            if seen >= q * n:
+                return bound
+        return float("inf")
+
+    @staticmethod
+    def merge(counters, histograms, into):
+        for key, value in list(counters.items()):
+            into[0][key] = into[0].get(key, 0) + value
+        for key, (buckets, counts, total, n) in list(histograms.items()):
+            merged = into[1].setdefault(key, [buckets, [0] * len(buckets), 0.0, 0])
+            merged[1] = [a + b for a, b in zip(merged[1], counts)]
+            merged[2] += total
+            merged[3] += n
+
+    def collect(self):
+        # Totals over every shard. The dicts of live threads may change while
+        # they are read, so they are copied first (one C-level call each).
+        with self.shards_lock:
+            for shard in [s for s in self.shards if not s[0].is_alive()]:
+                self.shards.remove(shard)
+                self.merge(shard[1], shard[2], self.retired)
+            shards = list(self.shards)
+        totals = ({}, {})
+        self.merge(*self.retired, totals)
+        for _, counters, histograms in shards:
+            self.merge(counters.copy(), {k: (v[0], list(v[1]), v[2], v[3]) for k, v in histograms.copy().items()}, totals)
+        return totals
+
+    def render(self):
+        counters, histograms = self.collect()
+        conns = list(clients)
+        with fanout_stats_lock:
+            sent = fanout_stats["bytes"] + sum(c.bytes_sent for c in conns)
+        counters[("bytes_sent_total", ())] = sent
+        counters[("outbound_dropped_total", ())] = outbound_stats["dropped"]
+        counters[("outbound_disconnected_total", ())] = outbound_stats["disconnected"]
+        gauges = {"connections": len(conns), "sessions": len(sessions), "rooms": len(chat_rooms),
+                  "threads": threading.active_count(), "file_transfers": len(file_transfers)}
+        backlog = [BACKLOG_BUCKETS, [0] * len(BACKLOG_BUCKETS), 0.0, 0]
+        for c in conns:
+            depth = c.queue_depth()
+            for i, bound in enumerate(BACKLOG_BUCKETS):
+                if depth <= bound:
+                    backlog[1][i] += 1
+                    break
+            backlog[2] += depth
+            backlog[3] += 1
+        histograms[("outbound_backlog", ())] = backlog
+        worker = () if worker_id is None else (("worker", str(worker_id)),)
+        samples = defaultdict(list)
+        for name, value in gauges.items():
+            samples[name].append(("", worker, value))
+        for (name, labels), value in counters.items():
+            samples[name].append(("", worker + labels, value))
+        for (name, labels), (buckets, counts, total, n) in histograms.items():
+            cumulative = 0
+            for bound, count in zip(buckets, counts):
+                cumulative += count
+                samples[name].append(("_bucket", worker + labels + (("le", repr(bound)),), cumulative))
+            samples[name].append(("_bucket", worker + labels + (("le", "+Inf"),), n))
+            samples[name].append(("_sum", worker + labels, total))
+            samples[name].append(("_count", worker + labels, n))
+        lines = []
+        for name in sorted(samples):
+            kind, text = METRICS_HELP.get(name, ("untyped", ""))
+            lines.append(f"# HELP communicator_{name} {text}")
+            lines.append(f"# TYPE communicator_{name} {kind}")
+            for suffix, labels, value in samples[name]:
+                label_text = ",".join(f'{k}="{metric_label(v)}"' for k, v in labels)
+                lines.append(f"communicator_{name}{suffix}{{{label_text}}} {value}" if labels
+                             else f"communicator_{name}{suffix} {value}")
+        return ("\n".join(lines) + "\n").encode('utf-8')
+
+def metric_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+metrics = Metrics()
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = metrics.render()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes would flood the console
+
+class MetricsServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+def start_metrics(port):
+    if not port:
+        return
+    try:
+        server = MetricsServer((HOST, port), MetricsHandler)
+    except OSError as e:
+        print(f"[ERROR] Metrics endpoint on port {port} failed: {e}")
+        return
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"[INFO] Serving metrics on http://{HOST}:{port}/metrics")
+
+_timestamp_cache = (0, "")
+
 def timestamp():
-    return time.strftime("[%H:%M:%S]", time.localtime())
+    # strftime once per second, not once per message
+    global _timestamp_cache
+    now = int(time.time())
+    if _timestamp_cache[0] != now:
+        _timestamp_cache = (now, time.strftime("[%H:%M:%S]", time.localtime(now)))
+    return _timestamp_cache[1]
 
 def broadcast(message, sender_socket=None, include_sender=True, room=None):
-    # Only send to users in the same room
+    payload = message if isinstance(message, Payload) else Payload(message)
+    deliver(payload, sender_socket, include_sender, room)
+    if bus:
+        bus.publish(("broadcast", room, bytes(payload.text), payload.msg_id))
+    if peer_links:
+        publish_to_peers(("broadcast", room, payload.text), room)
+
+def deliver(payload, sender_socket=None, include_sender=True, room=None):
+    # Only send to users in the same room. The message is wrapped once and the
+    # same buffer is queued for every recipient.
+    started = time.perf_counter()
     targets = clients if not room else chat_rooms[room]
     for client in list(targets):
         if include_sender or client != sender_socket:
             try:
-                client.sendall(message)
+                client.sendall(payload)
             except:
                 pass
+    metrics.count("messages_total", room=room_label(room))
+    metrics.observe("fanout_seconds", time.perf_counter() - started)
 
 def broadcast_system(msg, room=None):
     broadcast(f"{timestamp()} SERVER> {msg}\n".encode('utf-8'), room=room)
 
-def handle_client(client_socket, address):
-    ip = address[0]
-    print(f"[INFO] New connection from {address}")
-    try:
-        # Ban IP check
-        if ip in banned_ips:
-            print(f"[INFO] Blocked connection attempt from banned IP {ip}")
-            client_socket.sendall(b"Your IP is banned from this server.\n")
-            client_socket.close()
-            return
-        # Ask for nickname
-        client_socket.sendall(b"Enter your nickname: ")
-        nickname = client_socket.recv(1024).decode('utf-8').strip()
-        if not nickname:
-            nickname = f"User{address[1]}"
-        # Blocked nickname check
-        if nickname in blocked_nicknames:
-            print(f"[INFO] Blocked connection attempt from blocked nickname {nickname} ({address})")
-            client_socket.sendall(b"You are blocked from this server.\n")
-            client_socket.close()
+# --- Typing indicators ---
+# /typing marks the sender as typing in their room for TYPING_TTL seconds
+# (clients repeat it while the user keeps typing); /notyping or a chat line
+# ends it. Instead of a line per /typing, every room gets at most one
+# FRAME_TYPING per TYPING_INTERVAL naming everyone typing in it. Only version
+# 3 clients get these frames, so nothing reaches the chat stream or history.
+class TypingTracker:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rooms = {}        # room: {session: expiry}, in the order they started typing
+        self.changed = set()   # rooms to send an update to
+        self.wake = threading.Event()  # set while there is anything to look after
+        threading.Thread(target=self.flush_loop, daemon=True).start()
+
+    def start(self, session):
+        with self.lock:
+            typers = self.rooms.setdefault(session.room, {})
+            if session not in typers:
+                self.changed.add(session.room)
+                self.wake.set()
+            typers[session] = time.time() + TYPING_TTL
+
+    def stop(self, session):
+        # Returns whether the session was typing
+        with self.lock:
+            typers = self.rooms.get(session.room)
+            if not typers or typers.pop(session, None) is None:
+                return False
+            self.changed.add(session.room)
+            self.wake.set()
+            return True
+
+    def show(self, conn, room):
+        # The current state of a room, for a client that just joined it
+        with self.lock:
+            typers = list(self.rooms.get(room, ()))
+        if typers:
+            self.send(room, typers, [conn])
+
+    def flush_loop(self):
+        while True:
+            self.wake.wait()
+            time.sleep(TYPING_INTERVAL)
+            now = time.time()
+            with self.lock:
+                # Typers that left, changed rooms or went quiet drop out here
+                for room, typers in list(self.rooms.items()):
+                    for session, expiry in list(typers.items()):
+                        if expiry <= now or session.room != room or sessions.from_key(session.key) is not session:
+                            del typers[session]
+                            self.changed.add(room)
+                    if not typers:
+                        del self.rooms[room]
+                updates = [(room, list(self.rooms.get(room, ()))) for room in self.changed]
+                self.changed.clear()
+                if not self.rooms:
+                    self.wake.clear()
+            for room, typers in updates:
+                self.send(room, typers)
+
+    def send(self, room, typers, conns=None):
+        # A client leaves itself out of the names. Clients that are behind
+        # on their chat lines are skipped, the next update corrects them.
+        payload = "\0".join([room, str(len(typers))] + [s.nickname for s in typers[:TYPING_NAMES]]).encode('utf-8')
+        for conn in conns or list(chat_rooms.get(room, ())):
+            if conn.proto_version >= 3 and conn.queue_depth() < OUTBOUND_QUEUE_SIZE // 2:
+                try:
+                    conn.send_frame(FRAME_TYPING, payload)
+                except Exception:
+                    pass
+
+# --- Connections ---
+# Every connected client is represented by a socket-like connection object. The
+# command handlers only ever call sendall(), close() and getpeername() on it, so
+# the same code runs in both the threaded and the asyncio server modes.
+#
+# sendall() never blocks: data goes into the connection's bounded outbound
+# queue and a writer drains it to the socket (in threaded mode one writer
+# thread serves every connection, see SocketWriter). When a slow reader lets
+# its queue fill up, OVERFLOW_POLICY decides what happens.
+class ClientConnection(abc.ABC):
+    def __init__(self, address):
+        self.address = address
+        self.stage = "nickname"  # nickname -> password -> chat
+        self.pending_nickname = None
+        self.closing = False
+        self.resumable = True    # False once the server itself ends the connection
+        self.outbox = deque()
+        self.bulk = deque()   # file transfer frames: bounded by FILE_WINDOW, never dropped
+        self.file_ids = {}    # sender's transfer id: FileTransfer
+        self.outbox_lock = threading.Lock()
+        self.dropped = 0
+        self.writes = 0          # write syscalls made by the writer
+        self.delivered = 0       # queued messages written
+        self.bytes_sent = 0
+        self.framed = False
+        self.proto_version = 0
+        self.rbuf = bytearray()
+        self.skip = 0            # bytes still to come of an oversized frame being dropped
+        self.input_lock = threading.Lock()  # held while data is taken in and handled
+
+    def getpeername(self):
+        return self.address
+
+    def sendall(self, data):
+        if isinstance(data, Payload):
+            data = data.for_connection(self)
+        elif self.framed:
+            data = encode_frame(FRAME_TEXT, data, self.proto_version)
+        self.enqueue(data)
+
+    def send_frame(self, frame_type, payload, bulk=False):
+        data = encode_frame(frame_type, payload, self.proto_version)
+        if not bulk:
+            self.enqueue(data)
             return
-        nicknames[client_socket] = nickname
-        user_status[nickname] = "online"
-        user_rooms[nickname] = "main"
-        chat_rooms["main"].add(client_socket)
-        if nickname in ADMINS:
-            client_socket.sendall(b"Enter admin password: ")
-            password = client_socket.recv(1024).decode('utf-8').strip()
-            if password == ADMIN_PASSWORD:
-                admin_clients.add(client_socket)
-                client_socket.sendall(b"Admin access granted.\n")
-                print(f"[INFO] {nickname} ({address}) logged in as admin.")
-            else:
-                client_socket.sendall(b"Wrong password. Connection closed.\n")
-                client_socket.close()
-                print(f"[INFO] {nickname} ({address}) failed admin login.")
+        with self.outbox_lock:
+            if self.closing:
+                raise ConnectionError("connection closed")
+            self.bulk.append(data)
+            self.notify_writer()
+
+    def enqueue(self, data):
+        with self.outbox_lock:
+            if self.closing:
+                raise ConnectionError("connection closed")
+            overflow = len(self.outbox) >= OUTBOUND_QUEUE_SIZE
+            if overflow and OVERFLOW_POLICY == "drop_oldest":
+                self.outbox.popleft()
+                self.dropped += 1
+                outbound_stats["dropped"] += 1
+                overflow = False
+            if not overflow:
+                self.outbox.append(data)
+                self.notify_writer()
+        if overflow:
+            outbound_stats["disconnected"] += 1
+            print(f"[INFO] Disconnecting slow client {self.address}: outbound queue full ({OUTBOUND_QUEUE_SIZE})")
+            self.abort()
+            raise ConnectionError("outbound queue full")
+
+    def close(self):
+        # Graceful close: the writer flushes what is queued, then closes
+        with self.outbox_lock:
+            self.resumable = False
+            if self.closing:
                 return
+            self.closing = True
+            self.notify_writer()
+
+    def queue_depth(self):
+        return len(self.outbox) + len(self.bulk)
+
+    # Called with outbox_lock held. Takes up to WRITE_BATCH queued messages for
+    # one vectored write; chat goes ahead of file data.
+    def next_batch(self):
+        batch = []
+        for queue in (self.outbox, self.bulk):
+            while queue and len(batch) < WRITE_BATCH:
+                batch.append(queue.popleft())
+        return batch
+
+    def count_write(self, batch, writes):
+        self.writes += writes
+        self.delivered += len(batch)
+        self.bytes_sent += sum(len(b) for b in batch)
+
+    # Called with outbox_lock held
+    @abc.abstractmethod
+    def notify_writer(self):
+        pass
+
+    @abc.abstractmethod
+    def abort(self):
+        pass
+
+class SocketConnection(ClientConnection):
+    def __init__(self, sock, address):
+        super().__init__(address)
+        self.sock = sock
+        self.outbox_ready = threading.Condition(self.outbox_lock)
+        self.paused = False    # a hot restart holds the writer between batches
+        self.writing = False   # a batch is taken and not fully written yet
+        self.unsent = []       # what is left of that batch, for the shared writer
+        self.batch = []
+        self.batch_calls = 0
+        self.waiting = False   # registered with the shared writer until writable
+        if not SHARED_WRITER:
+            threading.Thread(target=self.writer_loop, daemon=True).start()
+
+    def notify_writer(self):
+        if SHARED_WRITER:
+            shared_writer().wake(self)
         else:
-            client_socket.sendall(b"Welcome.\n")
-        welcome_msg = f"{nickname} has joined the chat."
-        print(f"[INFO] {welcome_msg}")
-        broadcast((f"{timestamp()} {welcome_msg}\n").encode('utf-8'), room="main")
-        # Send user count after join
-        user_count_msg = f"{timestamp()} SERVER> Users connected: {len(nicknames)}\n"
-        broadcast(user_count_msg.encode('utf-8'), room="main")
-        print(f"[INFO] Users connected: {len(nicknames)}")
+            self.outbox_ready.notify_all()
+
+    # Only where send() cannot be told not to block (see SocketWriter)
+    def writer_loop(self):
+        try:
+            while True:
+                with self.outbox_ready:
+                    while not self.closing and (self.paused or not (self.outbox or self.bulk)):
+                        self.outbox_ready.wait()
+                    batch = self.next_batch()
+                    if not batch:
+                        break  # closing and fully flushed
+                    self.writing = True
+                try:
+                    self.count_write(batch, sendmsg_all(self.sock, batch))
+                finally:
+                    with self.outbox_ready:
+                        self.writing = False
+                        self.outbox_ready.notify_all()
+        except Exception:
+            pass
+        self.abort()
+
+    def pause_writer(self):
+        with self.outbox_ready:
+            self.paused = True
+
+    def writer_paused(self, deadline):
+        # False if the writer is still in the middle of a batch at deadline
+        with self.outbox_ready:
+            return self.outbox_ready.wait_for(lambda: not self.writing, max(0.0, deadline - time.time()))
+
+    def resume_writer(self):
+        with self.outbox_ready:
+            self.paused = False
+            self.outbox_ready.notify_all()
+            if SHARED_WRITER:
+                self.notify_writer()
+
+    def abort(self):
+        with self.outbox_lock:
+            self.closing = True
+            self.outbox.clear()
+            self.bulk.clear()
+            self.outbox_ready.notify_all()
+            if SHARED_WRITER:
+                self.notify_writer()  # it closes the socket, once it is out of its selector
+        try:
+            # shutdown() also wakes up the handler thread blocked in recv()
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except:
+            pass
+        if SHARED_WRITER:
+            return
+        try:
+            self.sock.close()
+        except:
+            pass
+
+# In threaded mode every SocketConnection is drained by this one thread
+# rather than by a writer thread of its own, so a client costs one thread
+# (its reader), not two. notify_writer() hands the connection over and
+# wakes the thread through a socketpair. The writer takes a batch, writes
+# what the socket takes without blocking (MSG_DONTWAIT) and, when a client
+# is slow to read, keeps the rest and waits in a selector until its socket
+# is writable again, so a slow client never holds up the others. The thread
+# and its socketpair are made on first use, in the process that serves the
+# clients (not in the hub before it forks its workers). Where send() cannot
+# be told not to block (Windows), each connection keeps its own writer.
+SHARED_WRITER = hasattr(socket, "MSG_DONTWAIT")
+socket_writer = None
+socket_writer_lock = threading.Lock()
+
+def shared_writer():
+    global socket_writer
+    if socket_writer is None:
+        with socket_writer_lock:
+            if socket_writer is None:
+                socket_writer = SocketWriter()
+    return socket_writer
 
+class SocketWriter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ready = set()      # connections with something new to do
+        self.woken = False
+        self.selector = selectors.DefaultSelector()
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.selector.register(self.wakeup, selectors.EVENT_READ)
+        threading.Thread(target=self.run, daemon=True).start()
+
+    # May be called with the connection's outbox_lock held
+    def wake(self, conn):
+        with self.lock:
+            self.ready.add(conn)
+            if self.woken:
+                return
+            self.woken = True
+        try:
+            self.waker.send(b"\0")
+        except OSError:
+            pass
+
+    def run(self):
         while True:
-            data = client_socket.recv(4096)
-            if not data:
+            for key, _ in self.selector.select():
+                if key.data is None:
+                    try:
+                        while self.wakeup.recv(4096):
+                            pass
+                    except BlockingIOError:
+                        pass
+                    with self.lock:
+                        ready, self.ready, self.woken = self.ready, set(), False
+                    for conn in ready:
+                        if not conn.waiting or conn.closing:
+                            self.flush(conn)
+                else:
+                    self.flush(key.data)
+
+    def flush(self, conn):
+        # Writes batches until the outbox is empty, the writer is paused or
+        # the socket is full
+        while True:
+            with conn.outbox_ready:
+                if not conn.unsent:
+                    batch = [] if conn.paused and not conn.closing else conn.next_batch()
+                    if not batch:
+                        if conn.closing:
+                            break  # closing and fully flushed, or aborted
+                        return
+                    conn.batch, conn.batch_calls, conn.writing = batch, 0, True
+                    conn.unsent = [memoryview(b) for b in batch]
+            try:
+                sent = conn.sock.sendmsg(conn.unsent, [], socket.MSG_DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                self.wait_writable(conn)
+                return
+            except OSError:
                 break
-            msg = data.decode('utf-8').strip()
-            nickname = nicknames.get(client_socket, "")
-            room = user_rooms[nickname]
-
-
-            # --- Call signaling ---
-            # /call_request <target>
-            if msg.startswith("/call_request "):
-                target = msg.split(" ", 1)[1].strip()
-                # Check if target exists
-                found = False
-                for client, nick in nicknames.items():
-                    if nick == target:
-                        # Optionally: check if target is already in a call (not implemented, simple relay)
-                        client.sendall(f"/call_request {nickname}\n".encode('utf-8'))
-                        found = True
-                        break
-                if not found:
-                    client_socket.sendall(f"/call_busy {target}\n".encode('utf-8'))
-                continue
-            # /call_accept <from_user>
-            if msg.startswith("/call_accept "):
-                from_user = msg.split(" ", 1)[1].strip()
-                found = False
-                for client, nick in nicknames.items():
-                    if nick == from_user:
-                        client.sendall(f"/call_accepted {nickname}\n".encode('utf-8'))
-                        found = True
+            conn.batch_calls += 1
+            unsent = conn.unsent
+            while unsent and sent >= unsent[0].nbytes:
+                sent -= unsent.pop(0).nbytes
+            if unsent:
+                unsent[0] = unsent[0][sent:]
+                self.wait_writable(conn)
+                return
+            conn.count_write(conn.batch, conn.batch_calls)
+            with conn.outbox_ready:
+                conn.batch, conn.writing = [], False
+                conn.outbox_ready.notify_all()
+        # The connection is done: out of the selector first, then closed, so
+        # its descriptor cannot be reused while still registered
+        if conn.waiting:
+            self.selector.unregister(conn.sock)
+            conn.waiting = False
+        with conn.outbox_ready:
+            conn.closing = True
+            conn.outbox.clear()
+            conn.bulk.clear()
+            conn.unsent, conn.batch, conn.writing = [], [], False
+            conn.outbox_ready.notify_all()
+        try:
+            # shutdown() also wakes up the handler thread blocked in recv()
+            conn.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            conn.sock.close()
+        except OSError:
+            pass
+
+    def wait_writable(self, conn):
+        if not conn.waiting:
+            self.selector.register(conn.sock, selectors.EVENT_WRITE, conn)
+            conn.waiting = True
+
+class StreamConnection(ClientConnection):
+    def __init__(self, reader, writer, loop, address):
+        super().__init__(address)
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.loop_thread = threading.get_ident()
+        self.outbox_event = asyncio.Event()
+        self.writer_task = loop.create_task(self.writer_loop())
+
+    def notify_writer(self):
+        # The console thread also broadcasts; hand those wakeups to the loop
+        if threading.get_ident() == self.loop_thread:
+            self.outbox_event.set()
+        else:
+            self.loop.call_soon_threadsafe(self.outbox_event.set)
+
+    async def writer_loop(self):
+        try:
+            while True:
+                await self.outbox_event.wait()
+                self.outbox_event.clear()
+                while True:
+                    with self.outbox_lock:
+                        batch = self.next_batch()
+                    if not batch:
                         break
-                continue
-            # /call_reject <from_user>
-            if msg.startswith("/call_reject "):
-                from_user = msg.split(" ", 1)[1].strip()
-                found = False
-                for client, nick in nicknames.items():
-                    if nick == from_user:
-                        client.sendall(f"/call_rejected {nickname}\n".encode('utf-8'))
-                        found = True
+                    # One transport write per batch (the transport joins the buffers)
+                    self.writer.writelines(batch)
+                    self.count_write(batch, 1)
+                    await self.writer.drain()
+                if self.closing:
+                    break
+        except Exception:
+            pass
+        self.writer.close()
+
+    def abort(self):
+        with self.outbox_lock:
+            self.closing = True
+            self.outbox.clear()
+            self.bulk.clear()
+        if threading.get_ident() == self.loop_thread:
+            self.writer.transport.abort()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.transport.abort)
+
+class DetachedConnection(ClientConnection):
+    # Stands in for a client whose connection dropped, for RESUME_GRACE
+    # seconds. What is sent to the session meanwhile stays in the outbox
+    # as is (bytes or Payload), to be sent once the client resumes; when
+    # the time is up, or the server ends the session, the client leaves.
+    def __init__(self, conn):
+        super().__init__(conn.address)
+        self.stage = "chat"
+        self.resumable = False
+        self.framed = conn.framed
+        self.proto_version = conn.proto_version
+        self.timer = threading.Timer(RESUME_GRACE, self.close)
+        self.timer.daemon = True
+
+    def sendall(self, data):
+        self.enqueue(data)
+
+    def send_frame(self, frame_type, payload, bulk=False):
+        raise ConnectionError("client is reconnecting")
+
+    def notify_writer(self):
+        pass
+
+    def close(self):
+        with self.outbox_lock:
+            if self.closing:
+                return
+            self.closing = True
+            self.outbox.clear()
+        self.timer.cancel()
+        client_disconnected(self)
+
+    def abort(self):
+        self.close()
+
+def encode_frame(frame_type, payload, version=FRAME_VERSION):
+    return FRAME_HEADER.pack(version, frame_type, len(payload)) + payload
+
+class Payload:
+    # An outgoing text message encoded once and shared, read-only, by the
+    # queues of every recipient. The framed form is built on first use; chat
+    # lines that were logged carry their history id for version 2 clients.
+    __slots__ = ("text", "framed", "msg_id")
+
+    def __init__(self, data, msg_id=None):
+        self.text = memoryview(data)
+        self.framed = {}
+        self.msg_id = msg_id
+
+    def for_connection(self, conn):
+        if not conn.framed:
+            return self.text
+        data = self.framed.get(conn.proto_version)
+        if data is None:
+            if self.msg_id is not None and conn.proto_version >= 2:
+                frame = encode_frame(FRAME_CHAT, CHAT_ID.pack(self.msg_id) + self.text, conn.proto_version)
+            else:
+                frame = encode_frame(FRAME_TEXT, self.text, conn.proto_version)
+            data = self.framed[conn.proto_version] = memoryview(frame)
+        return data
+
+def sendmsg_all(sock, buffers):
+    # Write every buffer using as few sendmsg() calls as possible; returns the
+    # number of calls made.
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(b"".join(buffers))  # Windows has no sendmsg()
+        return 1
+    buffers = [memoryview(b) for b in buffers]
+    first = 0
+    calls = 0
+    while first < len(buffers):
+        sent = sock.sendmsg(buffers[first:])
+        calls += 1
+        while first < len(buffers) and sent >= buffers[first].nbytes:
+            sent -= buffers[first].nbytes
+            first += 1
+        if sent:
+            buffers[first] = buffers[first][sent:]
+    return calls
+
+class FrameTooLarge(ValueError):
+    def __init__(self, length):
+        super().__init__(f"frame too large ({length} bytes)")
+        self.length = length
+
+def parse_frames(buf):
+    # Yield (type, payload) for every complete frame in buf, then drop the
+    # consumed bytes. Each frame is looked at exactly once. A frame over
+    # MAX_FRAME_SIZE raises FrameTooLarge with its header left at the start
+    # of buf.
+    pos = 0
+    try:
+        while len(buf) - pos >= FRAME_HEADER.size:
+            version, frame_type, length = FRAME_HEADER.unpack_from(buf, pos)
+            if length > MAX_FRAME_SIZE:
+                raise FrameTooLarge(length)
+            start = pos + FRAME_HEADER.size
+            end = start + length
+            if len(buf) < end:
+                break
+            pos = end
+            yield frame_type, bytes(buf[start:end])
+    finally:
+        del buf[:pos]
+
+# --- Handshake and command processing (transport independent) ---
+def client_connected(client_socket):
+    ip = client_socket.address[0]
+    print(f"[INFO] New connection from {client_socket.address}")
+    metrics.count("connections_total")
+    # Ban IP check
+    if ip in banned_ips:
+        print(f"[INFO] Blocked connection attempt from banned IP {ip}")
+        client_socket.sendall(b"Your IP is banned from this server.\n")
+        client_socket.close()
+        return False
+    # Advertise the framed protocol, then ask for nickname
+    client_socket.sendall(PROTO_ADVERT + b"Enter your nickname: ")
+    return True
+
+def handle_data(client_socket, data):
+    # Feed one received chunk to the connection. Returns False once the
+    # connection should be closed.
+    if client_socket.framed:
+        if client_socket.skip:
+            dropped = min(client_socket.skip, len(data))
+            client_socket.skip -= dropped
+            data = data[dropped:]
+        client_socket.rbuf += data
+        while True:
+            try:
+                for frame_type, payload in parse_frames(client_socket.rbuf):
+                    if not handle_frame(client_socket, frame_type, payload):
+                        return False
+                return True
+            except FrameTooLarge as e:
+                drop_frame(client_socket, e.length)
+    if client_socket.stage == "nickname" and data.startswith(FRAME_MAGIC) and len(data) > len(FRAME_MAGIC):
+        # Client accepted the PROTO advert: switch to frames
+        client_socket.proto_version = min(data[len(FRAME_MAGIC)], FRAME_VERSION)
+        client_socket.framed = True
+        client_socket.send_frame(FRAME_HELLO, bytes([client_socket.proto_version]))
+        return handle_data(client_socket, data[len(FRAME_MAGIC) + 1:])
+    return handle_line(client_socket, data.decode('utf-8').strip())
+
+def drop_frame(client_socket, length):
+    # An oversized frame is not buffered: what has arrived of it is thrown
+    # away now, the rest as it comes in, and the sender is told
+    buffered = min(len(client_socket.rbuf) - FRAME_HEADER.size, length)
+    del client_socket.rbuf[:FRAME_HEADER.size + buffered]
+    client_socket.skip = length - buffered
+    print(f"[INFO] Dropped a {length} byte frame from {client_socket.address}")
+    client_socket.sendall(f"{timestamp()} SERVER> Message too large ({length} bytes, at most {MAX_FRAME_SIZE}), not delivered.\n".encode('utf-8'))
+
+def handle_frame(client_socket, frame_type, payload):
+    if frame_type == FRAME_TEXT:
+        return handle_line(client_socket, payload.decode('utf-8').strip())
+    if FRAME_FILE_OFFER <= frame_type <= FRAME_FILE_ABORT:
+        if client_socket.stage == "chat":
+            handle_file_frame(client_socket, frame_type, payload)
+        return True
+    print(f"[INFO] Ignoring unknown frame type {frame_type} from {client_socket.address}")
+    return True
+
+class FileTransfer:
+    def __init__(self, relay_id, sender, sender_id, target, filename, size):
+        self.relay_id = relay_id      # id the target sees
+        self.sender = sender
+        self.sender_id = sender_id    # id the sender picked
+        self.target = target
+        self.filename = filename
+        self.size = size
+        self.relayed = 0
+        self.acked = 0
+        self.ended = False
+
+def handle_file_frame(client_socket, frame_type, payload):
+    nickname = sessions.get(client_socket).nickname
+    if frame_type == FRAME_FILE_OFFER:
+        sender_id, size = FILE_OFFER.unpack_from(payload)
+        target, _, filename = payload[FILE_OFFER.size:].decode('utf-8').partition("\0")
+        target_session = sessions.find(target)
+        target_socket = target_session.conn if target_session else None
+        if target_socket is None:
+            client_socket.send_frame(FRAME_FILE_ABORT, FILE_ABORT.pack(sender_id, 1) + f"User {target} not found.".encode('utf-8'))
+            return
+        if not target_socket.framed or target_session.remote or isinstance(target_socket, DetachedConnection):
+            # Old client on the other end, one on another worker (chunks are
+            # not relayed between workers) or one that is reconnecting: the
+            # sender falls back to /sendfile, which a resumed client still gets
+            client_socket.send_frame(FRAME_FILE_ABORT, FILE_ABORT.pack(sender_id, 1) + b"unsupported")
+            return
+        xfer = FileTransfer(next(transfer_ids), client_socket, sender_id, target_socket, filename, size)
+        with file_transfers_lock:
+            file_transfers[xfer.relay_id] = xfer
+            client_socket.file_ids[sender_id] = xfer
+        print(f"[INFO] File transfer {xfer.relay_id}: {nickname} -> {target} '{filename}' ({size} bytes)")
+        relay_file_frame(xfer, xfer.target, FRAME_FILE_OFFER,
+                         FILE_OFFER.pack(xfer.relay_id, size) + f"{nickname}\0{filename}".encode('utf-8'))
+        return
+    (transfer_id,) = FILE_ID.unpack_from(payload)
+    if frame_type in (FRAME_FILE_CHUNK, FRAME_FILE_END):
+        xfer = client_socket.file_ids.get(transfer_id)
+        if xfer is None:
+            return  # already aborted
+        if frame_type == FRAME_FILE_END:
+            xfer.ended = True
+            relay_file_frame(xfer, xfer.target, FRAME_FILE_END, FILE_ID.pack(xfer.relay_id))
+            return
+        chunk = memoryview(payload)[FILE_ID.size:]
+        xfer.relayed += len(chunk)
+        metrics.count("file_bytes_total", len(chunk), path="chunked")
+        if xfer.relayed - xfer.acked > FILE_WINDOW:
+            abort_transfer(xfer, "flow control window exceeded")
+            return
+        relay_file_frame(xfer, xfer.target, FRAME_FILE_CHUNK, FILE_ID.pack(xfer.relay_id) + chunk)
+        return
+    if frame_type == FRAME_FILE_ACK:
+        transfer_id, received = FILE_ACK.unpack_from(payload)
+        xfer = file_transfers.get(transfer_id)
+        if xfer is None or xfer.target is not client_socket:
+            return
+        xfer.acked = received
+        if not relay_file_frame(xfer, xfer.sender, FRAME_FILE_ACK, FILE_ACK.pack(xfer.sender_id, received), bulk=False):
+            return
+        if xfer.ended and received >= xfer.relayed:
+            finish_transfer(xfer)
+            print(f"[INFO] File transfer {xfer.relay_id} complete ({received} bytes)")
+        return
+    if frame_type == FRAME_FILE_ABORT:
+        transfer_id, upload = FILE_ABORT.unpack_from(payload)
+        if upload:
+            xfer = client_socket.file_ids.get(transfer_id)
+        else:
+            xfer = file_transfers.get(transfer_id)
+            if xfer is not None and xfer.target is not client_socket:
+                xfer = None
+        if xfer is not None:
+            abort_transfer(xfer, payload[FILE_ABORT.size:].decode('utf-8', errors='replace'), origin=client_socket)
+
+def relay_file_frame(xfer, conn, frame_type, payload, bulk=True):
+    # The other side may be going away (closing, or detached while it
+    # reconnects): that ends the transfer, not the connection it came in on
+    try:
+        conn.send_frame(frame_type, payload, bulk=bulk)
+        return True
+    except ConnectionError:
+        abort_transfer(xfer, "peer disconnected", origin=conn)
+        return False
+
+def finish_transfer(xfer):
+    with file_transfers_lock:
+        file_transfers.pop(xfer.relay_id, None)
+        xfer.sender.file_ids.pop(xfer.sender_id, None)
+
+def abort_transfer(xfer, reason, origin=None):
+    finish_transfer(xfer)
+    print(f"[INFO] File transfer {xfer.relay_id} aborted: {reason}")
+    reason = reason.encode('utf-8')
+    # Tell whichever side did not abort (both, if the server aborted)
+    for conn, transfer_id, upload in ((xfer.sender, xfer.sender_id, 1), (xfer.target, xfer.relay_id, 0)):
+        if conn is not origin:
+            try:
+                conn.send_frame(FRAME_FILE_ABORT, FILE_ABORT.pack(transfer_id, upload) + reason, bulk=True)
+            except:
+                pass
+
+def handle_line(client_socket, line):
+    if client_socket.stage == "resuming":
+        return True  # another worker is handing the session over
+    if client_socket.stage == "nickname":
+        return handle_nickname(client_socket, line)
+    if client_socket.stage == "password":
+        return handle_password(client_socket, line)
+    if line == "/quit":
+        client_socket.close()  # leaving for good, no session is kept for it
+        return False
+    handle_message(client_socket, line)
+    return True
+
+def handle_nickname(client_socket, nickname):
+    address = client_socket.address
+    if nickname.startswith("/resume "):
+        return resume_session(client_socket, nickname[8:])
+    if not nickname:
+        nickname = f"User{address[1]}"
+    # Blocked nickname check
+    if nickname in blocked_nicknames:
+        print(f"[INFO] Blocked connection attempt from blocked nickname {nickname} ({address})")
+        client_socket.sendall(b"You are blocked from this server.\n")
+        client_socket.close()
+        return False
+    if nickname in ADMINS:
+        client_socket.pending_nickname = nickname
+        client_socket.stage = "password"
+        client_socket.sendall(b"Enter admin password: ")
+        return True
+    client_socket.sendall(b"Welcome.\n")
+    join_chat(client_socket, nickname)
+    return True
+
+def handle_password(client_socket, password):
+    nickname = client_socket.pending_nickname
+    address = client_socket.address
+    if password == ADMIN_PASSWORD:
+        client_socket.sendall(b"Admin access granted.\n")
+        print(f"[INFO] {nickname} ({address}) logged in as admin.")
+        join_chat(client_socket, nickname).is_admin = True
+        return True
+    client_socket.sendall(b"Wrong password. Connection closed.\n")
+    client_socket.close()
+    print(f"[INFO] {nickname} ({address}) failed admin login.")
+    return False
+
+def join_chat(client_socket, nickname):
+    client_socket.stage = "chat"
+    session = sessions.add(client_socket, nickname)
+    if session.nickname != nickname:
+        client_socket.sendall(f"{timestamp()} SERVER> Nickname {nickname} is taken, you are {session.nickname}.\n".encode('utf-8'))
+        nickname = session.nickname
+    if client_socket.proto_version < 2:
+        run_blocking(send_history, client_socket, session.room)  # newer clients ask with /sync
+    else:
+        client_socket.sendall(f"/session {sessions.issue_token(session)}\n".encode('utf-8'))
+        typing_users.show(client_socket, session.room)
+    if client_socket.proto_version >= 4:
+        sessions.roster(client_socket)
+    welcome_msg = f"{nickname} has joined the chat."
+    print(f"[INFO] {welcome_msg}")
+    broadcast((f"{timestamp()} {welcome_msg}\n").encode('utf-8'), room="main")
+    print(f"[INFO] Users connected: {len(sessions)}")
+    return session
+
+# --- Session resumption ---
+# Version 2 clients get a token at login ("/session <token>"). When such a
+# client's connection drops without a /quit, a DetachedConnection holds its
+# session (nickname, room, status, admin rights and whatever is sent to it)
+# for RESUME_GRACE seconds and nobody is told. A client that reconnects in
+# time sends "/resume <token> <last history id>" instead of its nickname and
+# gets "/resumed <nickname> <room>", the chat lines it missed (as /sync
+# would send them) and then the rest of what was held for it. Unknown
+# tokens get "/resume_failed" and the client logs in again.
+resume_ids = itertools.count()
+resuming = {}  # resume request: (connection, last id), while another worker hands the session over
+
+def resume_session(client_socket, args):
+    parts = args.split()
+    token = parts[0] if parts else ""
+    last_id = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 0
+    session = sessions.from_token(token)
+    if session is None or session.remote:
+        owner = token.partition(".")[0]
+        if bus and owner.isdigit() and int(owner) != worker_id:
+            request = next(resume_ids)
+            resuming[request] = (client_socket, last_id)
+            client_socket.stage = "resuming"
+            bus.publish(("resume", (int(owner), token), (worker_id, request)))
+        else:
+            client_socket.sendall(b"/resume_failed\n")
+        return True
+    old = sessions.replace_conn(session, client_socket)
+    if old in last_messages:
+        last_messages[client_socket] = last_messages.pop(old)
+    finish_resume(client_socket, session, release_connection(old), last_id)
+    return True
+
+def release_connection(old):
+    # The connection a resumed session was taken from. A stand-in gives up
+    # what it held; a live one (the client saw the drop before we did) is cut.
+    if not isinstance(old, DetachedConnection):
+        old.abort()
+        return []
+    old.timer.cancel()
+    if old in clients:
+        clients.remove(old)
+    with old.outbox_lock:
+        old.closing = True
+        pending = list(old.outbox)
+        old.outbox.clear()
+    return pending
+
+def finish_resume(client_socket, session, pending, last_id):
+    client_socket.stage = "chat"
+    client_socket.sendall(f"/resumed {session.nickname} {session.room}\n".encode('utf-8'))
+    if client_socket.proto_version >= 4:
+        sessions.roster(client_socket)
+    run_blocking(send_missed, client_socket, session.room, pending, last_id)
+    print(f"[INFO] {session.nickname} resumed the session from {client_socket.address}")
+
+def send_missed(client_socket, room, pending, last_id):
+    synced = send_sync(client_socket, room, last_id)
+    for data in pending:
+        if isinstance(data, Payload) and data.msg_id in synced:
+            continue  # already sent by the sync
+        client_socket.sendall(data)
+
+def detach_session(session):
+    detached = DetachedConnection(session.conn)
+    sessions.replace_conn(session, detached)
+    clients.append(detached)  # it gets the broadcasts to everyone too
+    detached.timer.start()
+    print(f"[INFO] {session.nickname} lost the connection, holding the session for {RESUME_GRACE} s")
+    return detached
+
+# Worker side of a resume that reached another worker: give up the session
+# (its "leave" only updates the registries) and send it to that worker
+def hand_over_session(token, requester):
+    session = sessions.from_token(token)
+    state = None
+    if session is not None and not session.remote:
+        old = session.conn
+        sessions.hand_over(old)
+        pending = release_connection(old)
+        state = (session.key, session.nickname, session.room, session.status, session.is_admin,
+                 [(bytes(p.text), p.msg_id) if isinstance(p, Payload) else bytes(p) for p in pending])
+    bus.publish(("resumed", requester, state))
+
+def resume_handed_over(request, state):
+    client_socket, last_id = resuming.pop(request, (None, 0))
+    if client_socket is None:
+        return
+    if state is None:
+        client_socket.stage = "nickname"
+        client_socket.sendall(b"/resume_failed\n")
+        return
+    old_key, nickname, room, status, is_admin, pending = state
+    session = sessions.take_over(client_socket, old_key, nickname, room, status)
+    session.is_admin = is_admin
+    token = sessions.issue_token(session)
+    pending = [Payload(*p) if isinstance(p, tuple) else p for p in pending]
+    if client_socket.closing:
+        detach_session(session).outbox.extend(pending)  # gone again while we waited
+        return
+    finish_resume(client_socket, session, pending, last_id)
+    client_socket.sendall(f"/session {token}\n".encode('utf-8'))
+
+# --- Client commands ---
+# Commands are looked up by their first word in `commands`, so a line costs
+# one dict lookup whatever the command, and a line that does not start with
+# "/" is chat and is not parsed at all. Handlers get the connection, the
+# session and what follows the command word. A command registered with
+# args=True needs something after its name, args=False takes nothing and
+# args=None either; a line that does not fit, or an unknown command, is sent
+# as chat like before. Every line is timed into the command_seconds metric
+# (see /stats). Handlers are named cmd_<command>, clear of the module's
+# other functions and of the stdlib. Plugins add commands with the same
+# decorator (see load_plugins).
+class Command:
+    __slots__ = ("name", "handler", "args")
+
+    def __init__(self, name, handler, args):
+        self.name = name
+        self.handler = handler
+        self.args = args
+
+commands = {}   # command word: Command
+
+def command(*names, args=None):
+    def register(handler):
+        for name in names:
+            commands[name] = Command(name, handler, args)
+        return handler
+    return register
+
+def handle_message(client_socket, msg):
+    started = time.perf_counter()
+    session = sessions.get(client_socket)
+    name = "chat"
+    if msg.startswith("/"):
+        word, sep, rest = msg.partition(" ")
+        cmd = commands.get(word)
+        if cmd is not None and (cmd.args is None or cmd.args == bool(sep)):
+            name = word
+            cmd.handler(client_socket, session, rest)
+    if name == "chat":
+        chat_line(client_socket, session, msg)
+    metrics.observe("command_seconds", time.perf_counter() - started, command=name)
+
+def chat_line(client_socket, session, msg):
+    # Broadcast message to all clients in the same room, with timestamp
+    outmsg = f"{timestamp()} {session.nickname}> {msg}\n"
+    row = log_chat(session.room, session.nickname, msg)
+    broadcast(Payload(outmsg.encode('utf-8'), row[0]), sender_socket=client_socket, room=session.room)
+    last_messages[client_socket] = (time.time(), msg)
+    if typing_users.stop(session):
+        sessions.publish(session, "typing", False)
+
+def load_plugins(names):
+    # A plugin is a module with register(command, server): it adds commands
+    # with the `command` decorator and reaches the rest of the server
+    # (sessions, broadcast, ...) through `server`, this module.
+    import importlib
+    server = sys.modules[__name__]
+    for name in names:
+        importlib.import_module(name).register(command, server)
+        print(f"[INFO] Loaded plugin {name}")
+
+# --- Call signaling ---
+# /call_request <target>
+@command("/call_request", args=True)
+def cmd_call_request(client_socket, session, args):
+    target = args.strip()
+    # Check if target exists
+    target_session = sessions.find(target)
+    if target_session:
+        # Optionally: check if target is already in a call (not implemented, simple relay)
+        target_session.conn.sendall(f"/call_request {session.nickname}\n".encode('utf-8'))
+    else:
+        client_socket.sendall(f"/call_busy {target}\n".encode('utf-8'))
+
+# /call_accept <from_user>
+@command("/call_accept", args=True)
+def cmd_call_accept(client_socket, session, args):
+    target_session = sessions.find(args.strip())
+    if target_session:
+        target_session.conn.sendall(f"/call_accepted {session.nickname}\n".encode('utf-8'))
+
+# /call_reject <from_user>
+@command("/call_reject", args=True)
+def cmd_call_reject(client_socket, session, args):
+    target_session = sessions.find(args.strip())
+    if target_session:
+        target_session.conn.sendall(f"/call_rejected {session.nickname}\n".encode('utf-8'))
+
+# /call_end
+@command("/call_end")
+def cmd_call_end(client_socket, session, args):
+    # End call for both parties (broadcast to all, or track call state for more advanced logic)
+    # For now, just notify all users in the room
+    for other in sessions.all():
+        if other.conn != client_socket:
+            other.conn.sendall(f"/call_ended {session.nickname}\n".encode('utf-8'))
+
+# /call_busy <target>
+@command("/call_busy", args=True)
+def cmd_call_busy(client_socket, session, args):
+    target_session = sessions.find(args.strip())
+    if target_session:
+        target_session.conn.sendall(f"/call_busy {session.nickname}\n".encode('utf-8'))
+
+# --- Typing indicator ---
+@command("/typing", args=False)
+def cmd_typing(client_socket, session, args):
+    typing_users.start(session)
+    sessions.publish(session, "typing", True)
+
+@command("/notyping", args=False)
+def cmd_notyping(client_socket, session, args):
+    if typing_users.stop(session):
+        sessions.publish(session, "typing", False)
+
+# --- Private message ---
+@command("/msg", args=True)
+def cmd_private_message(client_socket, session, args):
+    try:
+        target, pm = args.split(" ", 1)
+    except ValueError:
+        client_socket.sendall(f"{timestamp()} SERVER> Usage: /msg <user> <message>\n".encode('utf-8'))
+        return
+    target_session = sessions.find(target)
+    if not target_session:
+        client_socket.sendall(f"{timestamp()} SERVER> User {target} not found.\n".encode('utf-8'))
+        return
+    try:
+        target_session.conn.sendall(f"{timestamp()} [PM] {session.nickname}> {pm}\n".encode('utf-8'))
+    except ConnectionError:
+        client_socket.sendall(f"{timestamp()} SERVER> Could not deliver your message to {target}.\n".encode('utf-8'))
+        return
+    client_socket.sendall(f"{timestamp()} [PM to {target}]> {pm}\n".encode('utf-8'))
+
+# --- Status ---
+@command("/status", args=True)
+def cmd_set_status(client_socket, session, args):
+    status = args.strip()
+    sessions.set_status(session, status)
+    broadcast_system(f"{session.nickname} is now '{status}'", room=session.room)
+
+# --- Edit last message ---
+@command("/edit", args=True)
+def cmd_edit_message(client_socket, session, args):
+    new_msg = args.strip()
+    if client_socket in last_messages:
+        t, old = last_messages[client_socket]
+        edit_msg = f"{timestamp()} {session.nickname} (edited): {new_msg}"
+        broadcast(edit_msg.encode('utf-8'), room=session.room)
+        last_messages[client_socket] = (time.time(), new_msg)
+    else:
+        client_socket.sendall(f"{timestamp()} SERVER> No message to edit.\n".encode('utf-8'))
+
+# --- Delete last message ---
+@command("/delete", args=False)
+def cmd_delete_message(client_socket, session, args):
+    if client_socket in last_messages:
+        t, old = last_messages[client_socket]
+        broadcast_system(f"{session.nickname} deleted their last message.", room=session.room)
+        last_messages.pop(client_socket, None)
+    else:
+        client_socket.sendall(f"{timestamp()} SERVER> No message to delete.\n".encode('utf-8'))
+
+# --- Stickers ---
+@command("/sticker", args=True)
+def cmd_send_sticker(client_socket, session, args):
+    sticker = args.strip()
+    if sticker in STICKERS:
+        sticker_msg = f"{timestamp()} {session.nickname}> {STICKERS[sticker]}"
+        row = log_chat(session.room, session.nickname, STICKERS[sticker])
+        broadcast(Payload(sticker_msg.encode('utf-8'), row[0]), room=session.room)
+    else:
+        client_socket.sendall(f"{timestamp()} SERVER> Sticker not found. Available: {', '.join(STICKERS)}\n".encode('utf-8'))
+
+# --- Peer-to-peer file transfer rendezvous ---
+# The server only introduces the two clients; the file itself goes over a
+# direct TCP connection between them. A /p2p_fail makes the sender fall
+# back to sending through the server.
+# /p2p_offer <target> <port> <token> <size> <filename>
+@command("/p2p_offer", args=True)
+def cmd_p2p_offer(client_socket, session, args):
+    parts = args.split(" ", 4)
+    if len(parts) != 5:
+        client_socket.sendall(f"{timestamp()} SERVER> Usage: /p2p_offer <user> <port> <token> <size> <filename>\n".encode('utf-8'))
+        return
+    target, port, token, size, filename = parts
+    target_session = sessions.find(target)
+    target_socket = target_session.conn if target_session else None
+    # Only framed (current) clients understand the offer
+    if target_socket is None or not target_socket.framed:
+        client_socket.sendall(f"/p2p_fail {target} {token}\n".encode('utf-8'))
+        return
+    sender_ip = client_socket.address[0]
+    target_socket.sendall(f"/p2p_offer {session.nickname} {sender_ip} {port} {token} {size} {filename}\n".encode('utf-8'))
+    print(f"[INFO] P2P rendezvous: {session.nickname} ({sender_ip}:{port}) -> {target} '{filename}' ({size} bytes)")
+
+# /p2p_fail <sender> <token>
+@command("/p2p_fail", args=True)
+def cmd_p2p_fail(client_socket, session, args):
+    parts = args.split(" ")
+    target_session = sessions.find(parts[0]) if len(parts) == 2 else None
+    if target_session:
+        target_session.conn.sendall(f"/p2p_fail {session.nickname} {parts[1]}\n".encode('utf-8'))
+
+# --- File transfer (base64, small files only) ---
+@command("/sendfile", args=True)
+def cmd_send_file(client_socket, session, args):
+    try:
+        # Accept: /sendfile <user> <filename>:::<base64>
+        parts = args.split(" ", 1)
+        if len(parts) != 2 or ":::" not in parts[1]:
+            client_socket.sendall(f"{timestamp()} SERVER> Usage: /sendfile <user> <filename>:::<base64data>\n".encode('utf-8'))
+            return
+        target = parts[0]
+        filename, b64 = parts[1].split(":::", 1)
+        filename = filename.strip()
+        b64 = b64.strip()
+        # Forward to target user using the same protocol as client expects
+        target_session = sessions.find(target)
+        if target_session:
+            # Forward as: /sendfile <sender> <filename>:::<base64>
+            target_session.conn.sendall(f"/sendfile {session.nickname} {filename}:::{b64}\n".encode('utf-8'))
+            metrics.count("file_bytes_total", len(b64), path="base64")
+            client_socket.sendall(f"{timestamp()} SERVER> File sent to {target}.\n".encode('utf-8'))
+        else:
+            client_socket.sendall(f"{timestamp()} SERVER> User {target} not found.\n".encode('utf-8'))
+    except Exception as e:
+        client_socket.sendall(f"{timestamp()} SERVER> Error: {e}\n".encode('utf-8'))
+
+# --- Join room ---
+# /join <room> [#after_id]: clients with a local cache rejoining after a new
+# login pass the newest id they have and get only what is newer
+@command("/join", args=True)
+def cmd_join_room(client_socket, session, args):
+    new_room, _, after_id = args.strip().rpartition(" #")
+    if not new_room or not after_id.isdigit():
+        new_room, after_id = args.strip(), None
+    sessions.move(session, new_room)
+    client_socket.sendall(f"{timestamp()} SERVER> Joined room '{new_room}'.\n".encode('utf-8'))
+    run_blocking(enter_room, client_socket, session, new_room, after_id)
+
+def enter_room(client_socket, session, room, after_id):
+    # The replay first, so the newcomer sees the room in order
+    if after_id is None:
+        send_history(client_socket, room)
+    else:
+        send_sync(client_socket, room, int(after_id))
+    typing_users.show(client_socket, room)
+    broadcast_system(f"{session.nickname} joined this room.", room=room)
+
+# --- History paging ---
+# /history [before_id]
+@command("/history")
+def cmd_history_page(client_socket, session, args):
+    before_id = args.strip().lstrip("#")
+    if before_id and not before_id.isdigit():
+        client_socket.sendall(f"{timestamp()} SERVER> Usage: /history [message id]\n".encode('utf-8'))
+    else:
+        run_blocking(send_history, client_socket, session.room, int(before_id) if before_id else None)
+
+# /sync <room> <after_id>: sent by clients with a local cache
+@command("/sync", args=True)
+def cmd_sync_room(client_socket, session, args):
+    room, _, after_id = args.strip().rpartition(" ")  # room names may have spaces
+    if after_id.isdigit() and room == session.room:
+        run_blocking(send_sync, client_socket, session.room, int(after_id))
+
+# --- Rename ---
+@command("/rename", args=True)
+def cmd_rename(client_socket, session, args):
+    nickname = session.nickname
+    new_nickname = args.strip()
+    if not new_nickname or " " in new_nickname:
+        client_socket.sendall(f"{timestamp()} SERVER> Usage: /rename <nickname>\n".encode('utf-8'))
+    elif new_nickname in blocked_nicknames or new_nickname in ADMINS:
+        client_socket.sendall(f"{timestamp()} SERVER> Nickname {new_nickname} is not allowed.\n".encode('utf-8'))
+    elif not sessions.rename(session, new_nickname):
+        client_socket.sendall(f"{timestamp()} SERVER> Nickname {new_nickname} is already in use.\n".encode('utf-8'))
+    else:
+        print(f"[INFO] {nickname} renamed to {new_nickname}")
+        broadcast_system(f"{nickname} is now known as {new_nickname}.", room=session.room)
+
+# --- Search ---
+# /search <terms> [room:<room>] [user:<nickname>] [since:<when>] [page:<n>]
+@command("/search")
+def cmd_search(client_socket, session, args):
+    run_blocking(send_search, client_socket, args)
+
+# --- /list: show users with status ---
+@command("/list", args=False)
+def cmd_list_users(client_socket, session, args):
+    client_socket.sendall(f"{timestamp()} SERVER> LIST: {sessions.list_line()}\n".encode('utf-8'))
+
+@command("/roster", args=False)
+def cmd_roster(client_socket, session, args):
+    if client_socket.proto_version >= 4:
+        sessions.roster(client_socket)
+
+@command("/listip", args=False)
+def cmd_list_ips(client_socket, session, args):
+    if session.is_admin:
+        iplist = ";".join(f"{s.nickname} ({s.ip})" for s in sessions.all())
+        client_socket.sendall(f"SERVER> LISTIP: {iplist}\n".encode('utf-8'))
+    else:
+        client_socket.sendall(b"SERVER> LISTIP: Permission denied.\n")
+
+@command("/clearall", args=False)
+def cmd_clear_all(client_socket, session, args):
+    if session.is_admin:
+        print(f"[INFO] CLEARALL issued by admin {session.nickname}")
+        broadcast(b"SERVER> CLEARALL\n")
+    else:
+        client_socket.sendall(b"SERVER> CLEARALL: Permission denied.\n")
+
+def client_disconnected(client_socket):
+    if client_socket in clients:
+        clients.remove(client_socket)
+    with fanout_stats_lock:
+        fanout_stats["deliveries"] += client_socket.delivered
+        fanout_stats["writes"] += client_socket.writes
+        fanout_stats["bytes"] += client_socket.bytes_sent
+        client_socket.delivered = client_socket.writes = client_socket.bytes_sent = 0
+    for xfer in list(file_transfers.values()):
+        if client_socket in (xfer.sender, xfer.target):
+            abort_transfer(xfer, "peer disconnected", origin=client_socket)
+    session = sessions.get(client_socket)
+    if session and session.token and client_socket.resumable and RESUME_GRACE > 0:
+        detach_session(session)  # nobody is told yet, the client may be back
+    elif sessions.remove(client_socket):
+        left_msg = f"{session.nickname} has left the chat."
+        broadcast((f"{timestamp()} {left_msg}\n").encode('utf-8'), room=session.room)
+        print(f"[INFO] Users connected: {len(sessions)}")
+    client_socket.close()
+
+# --- Threaded server: one thread per client ---
+def handle_client(client_socket, address):
+    conn = SocketConnection(client_socket, address)
+    clients.append(conn)
+    serve_client(conn, greet=True)
+
+def serve_client(conn, greet=False):
+    # Where a hot restart is possible, data is only taken from the socket
+    # under input_lock once poll() says it is there, so a restart can stop
+    # the reading without losing anything.
+    poller = None
+    if HOT_RESTART:
+        poller = select.poll()
+        poller.register(conn.sock, select.POLLIN)
+    try:
+        if greet and not client_connected(conn):
+            return
+        while True:
+            if poller is not None:
+                poller.poll()
+            with conn.input_lock:
+                if not restarting:
+                    data = conn.sock.recv(4096)
+                    if not data:
                         break
-                continue
-            # /call_end
-            if msg.startswith("/call_end"):
-                # End call for both parties (broadcast to all, or track call state for more advanced logic)
-                # For now, just notify all users in the room
-                for client, nick in nicknames.items():
-                    if client != client_socket:
-                        client.sendall(f"/call_ended {nickname}\n".encode('utf-8'))
-                continue
-            # /call_busy <target>
-            if msg.startswith("/call_busy "):
-                target = msg.split(" ", 1)[1].strip()
-                for client, nick in nicknames.items():
-                    if nick == target:
-                        client.sendall(f"/call_busy {nickname}\n".encode('utf-8'))
+                    metrics.count("bytes_received_total", len(data))
+                    if not handle_data(conn, data):
                         break
-                continue
-            # --- Typing indicator ---
-            if msg == "/typing":
-                typing_users[room].add(nickname)
-                broadcast_system(f"{nickname} is typing...", room=room)
-                continue
-            if msg == "/notyping":
-                typing_users[room].discard(nickname)
-                continue
+                    continue
+            restart_over.wait()
+    except Exception as e:
+        print(f"[ERROR] Exception in handle_client: {e}")
+    finally:
+        if restarting:
+            restart_over.wait()  # the next process takes the connection over
+        client_disconnected(conn)
 
-            # --- Private message ---
-            if msg.startswith("/msg "):
-                try:
-                    _, target, pm = msg.split(" ", 2)
-                    found = False
-                    for client, nick in nicknames.items():
-                        if nick == target:
-                            client.sendall(f"{timestamp()} [PM] {nickname}> {pm}\n".encode('utf-8'))
-                            client_socket.sendall(f"{timestamp()} [PM to {target}]> {pm}\n".encode('utf-8'))
-                            found = True
-                            break
-                    if not found:
-                        client_socket.sendall(f"{timestamp()} SERVER> User {target} not found.\n".encode('utf-8'))
-                except Exception:
-                    client_socket.sendall(f"{timestamp()} SERVER> Usage: /msg <user> <message>\n".encode('utf-8'))
-                continue
+def run_threaded_server(server_socket):
+    poller = None
+    if HOT_RESTART:
+        poller = select.poll()
+        poller.register(server_socket, select.POLLIN)
+    while True:
+        if poller is not None:
+            poller.poll()
+        with accept_lock:
+            if restarting:
+                continue  # the next process accepts it
+            client_socket, address = server_socket.accept()
+        threading.Thread(target=handle_client, args=(client_socket, address), daemon=True).start()
 
-            # --- Status ---
-            if msg.startswith("/status "):
-                status = msg[8:].strip()
-                user_status[nickname] = status
-                broadcast_system(f"{nickname} is now '{status}'", room=room)
-                continue
+# --- Async server: every client on a single event loop ---
+async def handle_client_async(reader, writer):
+    conn = StreamConnection(reader, writer, asyncio.get_running_loop(), writer.get_extra_info("peername"))
+    clients.append(conn)
+    try:
+        if not client_connected(conn):
+            return
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                break
+            metrics.count("bytes_received_total", len(data))
+            if not handle_data(conn, data):
+                break
+    except Exception as e:
+        print(f"[ERROR] Exception in handle_client: {e}")
+    finally:
+        client_disconnected(conn)
 
-            # --- Edit last message ---
-            if msg.startswith("/edit "):
-                new_msg = msg[6:].strip()
-                if client_socket in last_messages:
-                    t, old = last_messages[client_socket]
-                    edit_msg = f"{timestamp()} {nickname} (edited): {new_msg}"
-                    broadcast(edit_msg.encode('utf-8'), room=room)
-                    last_messages[client_socket] = (time.time(), new_msg)
-                else:
-                    client_socket.sendall(f"{timestamp()} SERVER> No message to edit.\n".encode('utf-8'))
-                continue
+def raise_fd_limit():
+    # Thousands of idle connections need thousands of descriptors
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except Exception:
+        pass
 
-            # --- Delete last message ---
-            if msg == "/delete":
-                if client_socket in last_messages:
-                    t, old = last_messages[client_socket]
-                    broadcast_system(f"{nickname} deleted their last message.", room=room)
-                    last_messages.pop(client_socket, None)
-                else:
-                    client_socket.sendall(f"{timestamp()} SERVER> No message to delete.\n".encode('utf-8'))
-                continue
+async def serve_async(server_socket):
+    server = await asyncio.start_server(handle_client_async, sock=server_socket)
+    async with server:
+        await server.serve_forever()
 
-            # --- Stickers ---
-            if msg.startswith("/sticker "):
-                sticker = msg[9:].strip()
-                if sticker in STICKERS:
-                    sticker_msg = f"{timestamp()} {nickname}> {STICKERS[sticker]}"
-                    broadcast(sticker_msg.encode('utf-8'), room=room)
-                else:
-                    client_socket.sendall(f"{timestamp()} SERVER> Sticker not found. Available: {', '.join(STICKERS)}\n".encode('utf-8'))
-                continue
+def run_async_server(server_socket):
+    raise_fd_limit()
+    asyncio.run(serve_async(server_socket))
 
-            # --- File transfer (base64, small files only) ---
-            if msg.startswith("/sendfile "):
-                try:
-                    # Accept: /sendfile <user> <filename>:::<base64>
-                    parts = msg.split(" ", 2)
-                    if len(parts) != 3 or ":::" not in parts[2]:
-                        client_socket.sendall(f"{timestamp()} SERVER> Usage: /sendfile <user> <filename>:::<base64data>\n".encode('utf-8'))
-                        continue
-                    target = parts[1]
-                    filename, b64 = parts[2].split(":::", 1)
-                    filename = filename.strip()
-                    b64 = b64.strip()
-                    # Forward to target user using the same protocol as client expects
-                    found = False
-                    for client, nick in nicknames.items():
-                        if nick == target:
-                            # Forward as: /sendfile <sender> <filename>:::<base64>
-                            client.sendall(f"/sendfile {nickname} {filename}:::{b64}\n".encode('utf-8'))
-                            client_socket.sendall(f"{timestamp()} SERVER> File sent to {target}.\n".encode('utf-8'))
-                            found = True
-                            break
-                    if not found:
-                        client_socket.sendall(f"{timestamp()} SERVER> User {target} not found.\n".encode('utf-8'))
-                except Exception as e:
-                    client_socket.sendall(f"{timestamp()} SERVER> Error: {e}\n".encode('utf-8'))
-                continue
+# --- Worker processes ---
+# With --workers N the main process forks N workers that accept from the
+# shared listening socket, each running the threaded or async server. The
+# main process becomes the hub of a local bus: one socketpair per worker
+# carrying length-prefixed pickled tuples. Workers publish room broadcasts,
+# messages for clients of other workers and session changes (join, leave,
+# rename, room, status); the hub forwards room broadcasts only to workers
+# with members in that room. Every worker keeps the other workers' sessions
+# in its registry, so /list and nickname lookups see one server.
+BUS_HEADER = struct.Struct("!I")
 
-            # --- Join room ---
-            if msg.startswith("/join "):
-                new_room = msg[6:].strip()
-                old_room = user_rooms[nickname]
-                chat_rooms[old_room].discard(client_socket)
-                user_rooms[nickname] = new_room
-                chat_rooms[new_room].add(client_socket)
-                client_socket.sendall(f"{timestamp()} SERVER> Joined room '{new_room}'.\n".encode('utf-8'))
-                broadcast_system(f"{nickname} joined this room.", room=new_room)
-                continue
+worker_id = None
+bus = None   # BusEndpoint to the hub, in workers
+hub = None   # Hub, in the main process of a multi-process server
 
-            # --- Search (not needed on server, client-side only) ---
+# The registry publishes session changes with sessions.lock held, so sending
+# only queues the message; a writer thread per endpoint does the blocking
+# sendall. Two workers whose buffers are both full still read each other,
+# instead of each waiting on the other's lock. The writer starts with the
+# first message, so no thread is running yet when the hub forks its workers.
+class BusEndpoint:
+    def __init__(self, sock):
+        self.sock = sock
+        self.outbox = deque()
+        self.outbox_ready = threading.Condition()
+        self.writer = None
+        self.closed = False
 
-            # --- /list: show users with status ---
-            if msg == "/list":
-                userlist = ",".join(f"{nick} [{reputation[nick]}] ({user_status[nick]})" for nick in nicknames.values())
-                client_socket.sendall(f"{timestamp()} SERVER> LIST: {userlist}\n".encode('utf-8'))
-                continue
-            if msg == "/listip":
-                if client_socket in admin_clients:
-                    iplist = ";".join(f"{nick} ({client.getpeername()[0]})" for client, nick in nicknames.items())
-                    client_socket.sendall(f"SERVER> LISTIP: {iplist}\n".encode('utf-8'))
-                else:
-                    client_socket.sendall(b"SERVER> LISTIP: Permission denied.\n")
-                continue
-            if msg == "/clearall":
-                if client_socket in admin_clients:
-                    print(f"[INFO] CLEARALL issued by admin {nickname}")
-                    broadcast(b"SERVER> CLEARALL\n")
+    def publish(self, message):
+        self.send_raw(pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+
+    def send_raw(self, data):
+        with self.outbox_ready:
+            if self.closed:
+                raise OSError("bus link closed")
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.write_loop, daemon=True)
+                self.writer.start()
+            self.outbox.append(BUS_HEADER.pack(len(data)) + data)
+            self.outbox_ready.notify()
+
+    def write_loop(self):
+        while True:
+            with self.outbox_ready:
+                while not self.outbox and not self.closed:
+                    self.outbox_ready.wait()
+                if self.closed:
+                    return
+                data = b"".join(self.outbox)
+                self.outbox.clear()
+            try:
+                self.sock.sendall(data)
+            except OSError:
+                self.close()
+                return
+
+    def close(self):
+        with self.outbox_ready:
+            self.closed = True
+            self.outbox.clear()
+            self.outbox_ready.notify()
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)  # wakes the reader
+        except OSError:
+            pass
+        self.sock.close()
+
+    # Yields every message as pickled bytes until the other end closes
+    def receive(self):
+        buf = bytearray()
+        while True:
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                return
+            buf += chunk
+            pos = 0
+            while len(buf) - pos >= BUS_HEADER.size:
+                size, = BUS_HEADER.unpack_from(buf, pos)
+                if len(buf) - pos - BUS_HEADER.size < size:
+                    break
+                pos += BUS_HEADER.size + size
+                yield bytes(buf[pos - size:pos])
+            del buf[:pos]
+
+class RemoteConnection:
+    # Stands in for a client connected to another worker or cluster peer.
+    # Sends go over the link (the bus or a PeerLink) to whoever owns the
+    # client, under the key the owner knows it by.
+    def __init__(self, key, address, framed, link):
+        self.key = key
+        self.address = address
+        self.framed = framed
+        self.link = link
+
+    def getpeername(self):
+        return self.address
+
+    def sendall(self, data):
+        if isinstance(data, Payload):
+            data = data.text
+        self.link.publish(("send", self.key, bytes(data)))
+
+    def close(self):
+        self.link.publish(("close", self.key))
+
+class Hub:
+    def __init__(self, endpoints, processes):
+        self.endpoints = endpoints
+        self.processes = processes
+        self.lock = threading.Lock()
+        self.rooms = {}                  # session key: room
+        self.room_workers = defaultdict(lambda: defaultdict(int))  # room: {worker: members}
+
+    def track(self, key, room):
+        # Called with lock held; room None removes the session
+        old = self.rooms.pop(key, None)
+        if old is not None:
+            members = self.room_workers[old]
+            members[key[0]] -= 1
+            if not members[key[0]]:
+                del members[key[0]]
+                if not members:
+                    del self.room_workers[old]
+        if room is not None:
+            self.rooms[key] = room
+            self.room_workers[room][key[0]] += 1
+
+    def route(self, origin, message):
+        kind = message[0]
+        if kind in ("send", "close", "resume", "resumed"):
+            return [message[1][0]]
+        with self.lock:
+            if kind == "broadcast" and message[1]:
+                return [w for w in self.room_workers.get(message[1], ()) if w != origin]
+            if kind == "join":
+                self.track(message[1], message[4])
+            elif kind == "move":
+                self.track(message[1], message[2])
+            elif kind == "leave":
+                self.track(message[1], None)
+            elif kind == "handover":
+                self.track(message[2], None)
+                self.track(message[1], message[5])
+        return [w for w in range(len(self.endpoints)) if w != origin]
+
+    def forward(self, workers, data):
+        for w in workers:
+            try:
+                self.endpoints[w].send_raw(data)
+            except OSError:
+                pass  # that worker is gone
+
+    def serve(self, index):
+        try:
+            for data in self.endpoints[index].receive():
+                self.forward(self.route(index, pickle.loads(data)), data)
+        except OSError:
+            pass
+        print(f"[ERROR] Worker {index} exited")
+        # Its clients are gone too
+        with self.lock:
+            keys = [key for key in self.rooms if key[0] == index]
+        for key in keys:
+            message = ("leave", key)
+            self.forward(self.route(index, message), pickle.dumps(message, pickle.HIGHEST_PROTOCOL))
+
+    def console(self, cmd):
+        self.forward(range(len(self.endpoints)), pickle.dumps(("console", cmd), pickle.HIGHEST_PROTOCOL))
+
+    def stop(self):
+        for p in self.processes:
+            p.terminate()
+        for p in self.processes:
+            p.join(5)
+
+def handle_bus_message(message):
+    kind = message[0]
+    if kind == "broadcast":
+        deliver(Payload(message[2], message[3]), room=message[1])
+    elif kind == "history":
+        history.remember(message[1], message[2])
+    elif kind == "console":
+        console_command(message[1])
+    elif kind == "join":
+        sessions.add_remote(*message[1:])
+    elif kind == "handover":
+        sessions.handed_over(*message[1:])
+    elif kind == "resume":
+        hand_over_session(message[1][1], message[2])
+    elif kind == "resumed":
+        resume_handed_over(message[1][1], message[2])
+    else:
+        session = sessions.from_key(message[1])
+        if session is None:
+            return
+        try:
+            if kind == "send" and not session.remote:
+                session.conn.sendall(message[2])
+            elif kind == "close" and not session.remote:
+                session.conn.close()
+            elif kind == "leave":
+                sessions.remove(session.conn)
+            elif kind == "rename":
+                sessions.rename(session, message[2])
+            elif kind == "move":
+                sessions.move(session, message[2])
+            elif kind == "status":
+                sessions.set_status(session, message[2])
+            elif kind == "typing":
+                if message[2]:
+                    typing_users.start(session)
                 else:
-                    client_socket.sendall(b"SERVER> CLEARALL: Permission denied.\n")
-                continue
-            # --- End command handling ---
-            # Broadcast message to all clients in the same room, with timestamp
-            outmsg = f"{timestamp()} {nickname}> {msg}\n"
-            broadcast(outmsg.encode('utf-8'), sender_socket=client_socket, room=room)
-            last_messages[client_socket] = (time.time(), msg)
+                    typing_users.stop(session)
+        except Exception:
+            pass
+
+def bus_loop():
+    for data in bus.receive():
+        try:
+            handle_bus_message(pickle.loads(data))
+        except Exception as e:
+            print(f"[ERROR] Bus message failed: {e}")
+    print(f"[ERROR] Worker {worker_id}: lost the hub, exiting")
+    os._exit(1)
+
+def run_worker(index, server_socket, bus_socket):
+    global worker_id, bus, history, typing_users
+    worker_id = index
+    bus = BusEndpoint(bus_socket)
+    history = HistoryStore(HISTORY_DB, index, WORKERS)
+    typing_users = TypingTracker()
+    threading.Thread(target=bus_loop, daemon=True).start()
+    if METRICS_PORT:
+        start_metrics(METRICS_PORT + index)  # every worker counts its own clients
+    if index == 0:
+        start_discovery()  # worker 0 sees every session, so it speaks for the server
+    print(f"[INFO] Worker {index} (pid {os.getpid()}) serving in {SERVER_MODE} mode")
+    try:
+        if SERVER_MODE == "async":
+            run_async_server(server_socket)
+        else:
+            run_threaded_server(server_socket)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        history.close()
+
+def run_workers(server_socket):
+    global hub
+    try:
+        context = multiprocessing.get_context("fork")
+    except ValueError:
+        print("[ERROR] --workers needs fork(), which this platform does not have")
+        return
+    HistoryStore(HISTORY_DB).close()  # create or upgrade the schema once, before the workers open it
+    endpoints, processes = [], []
+    for index in range(WORKERS):
+        hub_side, worker_side = socket.socketpair()
+        process = context.Process(target=run_worker, args=(index, server_socket, worker_side), daemon=True)
+        process.start()
+        worker_side.close()
+        endpoints.append(BusEndpoint(hub_side))
+        processes.append(process)
+    hub = Hub(endpoints, processes)
+    for index in range(WORKERS):
+        threading.Thread(target=hub.serve, args=(index,), daemon=True).start()
+    # Started after forking, so no worker inherits a thread blocked on stdin
+    threading.Thread(target=server_console, daemon=True).start()
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        hub.stop()
+
+# --- Federation ---
+# Servers on different subnets can be linked into a cluster: a server dials
+# every address given with --peer and accepts links on --cluster-port. Links
+# are not relayed, so every server that should see another needs a link to
+# it (a full mesh). A link carries the same messages as the worker bus, as
+# length-prefixed JSON, and starts with a hello and the list of sessions on
+# each side. Peers' clients become remote sessions, so /msg, call signalling
+# and /list cover the whole cluster. Each link counts the peer's members per
+# room and room traffic is only sent to peers with members in that room.
+#
+# A peer can send text to, and disconnect, any local client, so links are
+# authenticated. With --cluster-secret each hello carries a random nonce and
+# each side answers with an HMAC of the other's nonce and its own node name;
+# a link that cannot prove it knows the secret is dropped. Without a secret,
+# links are only accepted from the hosts given with --peer.
+peer_links = {}   # node name: PeerLink
+peer_links_lock = threading.Lock()
+
+class PeerLink(BusEndpoint):
+    def __init__(self, sock, address):
+        super().__init__(sock)
+        self.address = address
+        self.node = None
+        self.rooms = defaultdict(int)   # room: the peer's members in it
+
+    def publish(self, message):
+        # Chat lines are bytes here; they travel as UTF-8 text
+        data = json.dumps(message, default=lambda b: bytes(b).decode('utf-8', 'replace'))
+        self.send_raw(data.encode('utf-8'))
+
+    def wants(self, room):
+        return room is None or self.rooms.get(room, 0) > 0
+
+def publish_to_peers(message, room=None):
+    for link in list(peer_links.values()):
+        if link.wants(room):
+            try:
+                link.publish(message)
+            except OSError:
+                pass  # the link's reader notices and cleans up
+
+def handle_peer_message(link, message):
+    kind = message[0]
+    if kind == "broadcast":
+        deliver(Payload(message[2].encode('utf-8')), room=message[1])
+    elif kind == "history":
+        # Keep our own log of what was said in rooms we have members in
+        history.append(message[1], message[2][2], message[2][3])
+    elif kind == "join":
+        if sessions.from_key((link.node,) + tuple(message[1])):
+            return  # announced twice while the link came up
+        session = sessions.add_remote(tuple(message[1]), *message[2:], link=link)
+        link.rooms[session.room] += 1
+    elif kind in ("send", "close"):
+        session = sessions.from_key(tuple(message[1]))
+        if session and not session.remote:
+            if kind == "send":
+                session.conn.sendall(message[2].encode('utf-8'))
+            else:
+                session.conn.close()
+    else:
+        session = sessions.from_key((link.node,) + tuple(message[1]))
+        if session is None:
+            return
+        if kind == "leave":
+            link.rooms[session.room] -= 1
+            sessions.remove(session.conn)
+        elif kind == "move":
+            link.rooms[session.room] -= 1
+            link.rooms[message[2]] += 1
+            sessions.move(session, message[2])
+        elif kind == "rename":
+            sessions.rename(session, message[2])
+        elif kind == "status":
+            sessions.set_status(session, message[2])
+        elif kind == "typing":
+            if message[2]:
+                typing_users.start(session)
+            else:
+                typing_users.stop(session)
+
+def peer_proof(nonce, node):
+    return hmac.new(CLUSTER_SECRET.encode('utf-8'), f"{nonce}:{node}".encode('utf-8'), hashlib.sha256).hexdigest()
+
+def authenticate_peer(link, messages, nonce):
+    # Returns the peer's node name, or None
+    hello = json.loads(next(messages))
+    if hello[0] != "hello" or len(hello) != 3 or not isinstance(hello[1], str) or hello[1] == NODE_NAME:
+        return None
+    if CLUSTER_SECRET is None:
+        return hello[1]
+    link.publish(("auth", peer_proof(hello[2], NODE_NAME)))
+    auth = json.loads(next(messages))
+    if auth[0] != "auth" or not hmac.compare_digest(str(auth[1]), peer_proof(nonce, hello[1])):
+        print(f"[ERROR] Cluster link from {link.address} failed authentication")
+        return None
+    return hello[1]
+
+def serve_peer_link(link):
+    try:
+        nonce = secrets.token_hex(16)
+        link.publish(("hello", NODE_NAME, nonce))
+        messages = link.receive()
+        node = authenticate_peer(link, messages, nonce)
+        if node is None:
+            return
+        link.node = node
+        with peer_links_lock:
+            if link.node in peer_links:
+                return  # already linked the other way round
+            peer_links[link.node] = link
+        print(f"[INFO] Linked with cluster peer {link.node} {link.address}")
+        # Tell the peer who is connected here. A join racing with this is
+        # sent twice, which add_remote() ignores. The list is taken under the
+        # lock but sent after, so a slow peer holds up nobody else.
+        with sessions.lock:
+            joins = [("join", session.key, session.nickname, session.ip, session.room,
+                      session.status, session.conn.framed) for session in sessions.all() if not session.remote]
+        for join in joins:
+            link.publish(join)
+        for data in messages:
+            try:
+                handle_peer_message(link, json.loads(data))
+            except OSError:
+                pass  # a local client went away
+            except Exception as e:
+                print(f"[ERROR] Bad message from cluster peer {link.node}: {e}")
+    except (OSError, ValueError, StopIteration):
+        pass
+    finally:
+        link.close()
+        with peer_links_lock:
+            if peer_links.get(link.node) is not link:
+                return
+            del peer_links[link.node]
+        for session in sessions.all():
+            if session.remote and session.conn.link is link:
+                sessions.remove(session.conn)
+        print(f"[INFO] Lost cluster peer {link.node}")
+
+def connect_peer(address):
+    host, _, port = address.rpartition(":")
+    while True:
+        try:
+            sock = socket.create_connection((host, int(port)), timeout=PEER_RETRY)
+            sock.settimeout(None)
+            serve_peer_link(PeerLink(sock, address))
+        except OSError:
+            pass
+        time.sleep(PEER_RETRY)
+
+def peer_hosts():
+    # Addresses of the hosts given with --peer
+    hosts = set()
+    for address in PEERS:
+        try:
+            hosts.add(socket.gethostbyname(address.rpartition(":")[0]))
+        except OSError:
+            pass
+    return hosts
+
+def accept_peers(listener):
+    while True:
+        sock, address = listener.accept()
+        if CLUSTER_SECRET is None and address[0] not in peer_hosts():
+            print(f"[INFO] Refused cluster link from {address}: not a --peer host and no --cluster-secret set")
+            sock.close()
+            continue
+        threading.Thread(target=serve_peer_link, args=(PeerLink(sock, address),), daemon=True).start()
+
+def start_federation():
+    if CLUSTER_PORT:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((HOST, CLUSTER_PORT))
+        listener.listen(16)
+        threading.Thread(target=accept_peers, args=(listener,), daemon=True).start()
+        print(f"[INFO] Accepting cluster links on {HOST}:{CLUSTER_PORT} as {NODE_NAME}"
+              + ("" if CLUSTER_SECRET else ", from --peer hosts only (no --cluster-secret)"))
+    for address in PEERS:
+        threading.Thread(target=connect_peer, args=(address,), daemon=True).start()
+
+# --- LAN discovery ---
+# Every ANNOUNCE_INTERVAL seconds the server multicasts a small JSON datagram
+# describing itself (version, port, users, rooms, load) to DISCOVERY_GROUP.
+# Clients listen for those, and can send a query to the group or as a
+# broadcast to get an immediate unicast answer. Replies are rate limited, in
+# total and per address, so queries cannot turn the server into a UDP
+# amplifier.
+def announcement():
+    rooms = sorted({s.room for s in sessions.all()})
+    try:
+        load = round(os.getloadavg()[0], 2)
+    except (AttributeError, OSError):
+        load = None  # Windows
+    return json.dumps({"service": DISCOVERY_SERVICE, "name": NODE_NAME, "version": SERVER_VERSION, "port": PORT,
+                       "users": len(sessions), "rooms": rooms[:20], "load": load}).encode('utf-8')
+
+def is_discovery_query(data):
+    try:
+        message = json.loads(data)
+    except ValueError:
+        return False
+    return isinstance(message, dict) and message.get("service") == DISCOVERY_SERVICE and message.get("query")
+
+def discovery_loop():
+    try:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, "SO_REUSEPORT"):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)  # several servers on one host
+        sock.bind(("", DISCOVERY_PORT))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                        struct.pack("4s4s", socket.inet_aton(DISCOVERY_GROUP), socket.inet_aton("0.0.0.0")))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+    except OSError as e:
+        print(f"[ERROR] LAN discovery disabled: {e}")
+        return
+    print(f"[INFO] Announcing on {DISCOVERY_GROUP}:{DISCOVERY_PORT} every {ANNOUNCE_INTERVAL}s")
+    next_announce = 0
+    tokens = QUERY_REPLY_RATE
+    last_refill = time.time()
+    replied = {}  # address: time of the last reply
+    while True:
+        now = time.time()
+        if now >= next_announce:
+            try:
+                sock.sendto(announcement(), (DISCOVERY_GROUP, DISCOVERY_PORT))
+            except OSError:
+                pass
+            next_announce = now + ANNOUNCE_INTERVAL
+        sock.settimeout(max(0.01, next_announce - now))
+        try:
+            data, address = sock.recvfrom(2048)
+        except socket.timeout:
+            continue
+        except OSError:
+            continue
+        if not is_discovery_query(data):
+            continue  # announcements, ours and other servers'
+        now = time.time()
+        tokens = min(QUERY_REPLY_RATE, tokens + (now - last_refill) * QUERY_REPLY_RATE)
+        last_refill = now
+        if tokens < 1 or now - replied.get(address[0], 0) < QUERY_REPLY_INTERVAL:
+            continue
+        tokens -= 1
+        if len(replied) > 1024:
+            replied = {ip: t for ip, t in replied.items() if now - t < QUERY_REPLY_INTERVAL}
+        replied[address[0]] = now
+        try:
+            sock.sendto(announcement(), address)
+        except OSError:
+            pass
+
+def start_discovery():
+    if DISCOVERY:
+        threading.Thread(target=discovery_loop, daemon=True).start()
+
+# --- Hot restart ---
+# In threaded mode /restart execs the server file again without dropping
+# anyone. Clients stop being read from (a handler only takes data from its
+# socket after poll() says it is there, under the connection's input_lock,
+# so from then on new data stays in the kernel), file transfers are
+# aborted, and every writer finishes the batch it is writing and pauses. The
+# sessions, each connection's state and what is still queued for it, the
+# bans, blocks and reputation go into a private temporary file; the
+# listening socket and the client sockets are inherited by the new process,
+# which finds the file through HANDOFF_ENV and the descriptors through
+# HANDOFF_FDS_ENV (the listener first), and carries on. If the file cannot
+# be read it still serves on the same listener and closes the client
+# sockets, whose clients reconnect. A connection whose writer is still stuck
+# after HANDOFF_TIMEOUT is cut and what was queued for it is dropped; its
+# session is kept for it to resume, or ended at once if it has no resume
+# token, so nobody keeps seeing it. If anything fails before the exec the
+# server just carries on as it was.
+HANDOFF_ENV = "COMMUNICATOR_HANDOFF"
+HANDOFF_FDS_ENV = "COMMUNICATOR_HANDOFF_FDS"
+HANDOFF_FORMAT = 1
+HANDOFF_TIMEOUT = 5       # seconds to wait for a writer to finish its batch
+HOT_RESTART = os.name == "posix" and hasattr(select, "poll")
+
+restarting = False                  # set while the state is being handed over
+restart_over = threading.Event()    # set when a hot restart was called off
+accept_lock = threading.Lock()
+listening_socket = None
+
+def hot_restart():
+    # Returns only if the restart did not happen
+    global restarting
+    script = os.path.abspath(sys.argv[0])
+    try:
+        with open(script, encoding="utf-8") as f:
+            compile(f.read(), script, "exec")
+    except (OSError, SyntaxError) as e:
+        print(f"[ERROR] Not restarting, {script} does not load: {e}")
+        return
+    print("[INFO] Restarting server, connections are kept.")
+    restart_over.clear()
+    restarting = True
+    with accept_lock:
+        conns = list(clients)
+        for conn in conns:
+            with conn.input_lock:
+                pass  # a line being handled is finished first
+        for xfer in list(file_transfers.values()):
+            abort_transfer(xfer, "server restarting")
+        live = [c for c in conns if isinstance(c, SocketConnection)]
+        for conn in live:
+            conn.pause_writer()
+        deadline = time.time() + HANDOFF_TIMEOUT
+        stuck = [c for c in live if not c.writer_paused(deadline)]
+        try:
+            state, fds = handoff_state(conns, stuck)
+            fd, path = tempfile.mkstemp(prefix="communicator_handoff_")
+            with os.fdopen(fd, "wb") as f:
+                pickle.dump(state, f)
+            for fd in fds:
+                os.set_inheritable(fd, True)
+            os.environ[HANDOFF_ENV] = path
+            os.environ[HANDOFF_FDS_ENV] = ",".join(map(str, fds))
+            history.close()  # flushes the chat lines not yet written
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        except Exception as e:
+            print(f"[ERROR] Restart failed, carrying on: {e}")
+            os.environ.pop(HANDOFF_ENV, None)
+            os.environ.pop(HANDOFF_FDS_ENV, None)
+            reopen_history()
+            restarting = False
+            for conn in live:
+                conn.resume_writer()
+            restart_over.set()
+
+def reopen_history():
+    global history
+    if history.closing:
+        history = HistoryStore(HISTORY_DB)
+
+def handoff_state(conns, stuck):
+    connections, fds = [], [listening_socket.fileno()]
+    for conn in conns:
+        if conn.closing:
+            continue
+        session = sessions.get(conn)
+        fd = conn.sock.fileno() if isinstance(conn, SocketConnection) and conn not in stuck else -1
+        if fd == -1 and session is None:
+            continue  # nothing to resume or end
+        if conn in stuck:
+            # Its queue is already framed for the socket being cut; the
+            # client gets the room's messages again with /sync on resume
+            queued = []
+        else:
+            with conn.outbox_lock:
+                queued = [(bytes(d.text), d.msg_id) if isinstance(d, Payload) else bytes(d)
+                          for d in list(conn.outbox) + list(conn.bulk)]
+        state = {"fd": fd if fd != -1 else None, "address": conn.address, "stage": conn.stage,
+                 "pending_nickname": conn.pending_nickname, "framed": conn.framed,
+                 "proto_version": conn.proto_version, "rbuf": bytes(conn.rbuf), "queued": queued,
+                 "last_message": last_messages.get(conn), "session": None}
+        if session is not None:
+            state["session"] = {"nickname": session.nickname, "room": session.room, "status": session.status,
+                                "is_admin": session.is_admin, "token": session.token,
+                                "watcher": conn in sessions.watchers}
+        if state["fd"] is not None:
+            fds.append(fd)
+        connections.append(state)
+    state = {"format": HANDOFF_FORMAT, "listener": listening_socket.fileno(), "connections": connections,
+             "presence_version": sessions.version, "blocked_nicknames": blocked_nicknames,
+             "banned_ips": banned_ips, "reputation": dict(reputation),
+             "user_rep_votes": dict(user_rep_votes), "vote_kick_votes": dict(vote_kick_votes),
+             "reports": dict(reports), "client_versions": client_versions}
+    return state, fds
+
+def load_handoff(path, fds):
+    # The state left by the process this one replaced. Whatever happens, the
+    # file is removed and the listening socket is used; if the state cannot
+    # be used, the client sockets are closed and only the listener is kept.
+    listener, client_fds = fds[0], fds[1:]
+    try:
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if state.get("format") != HANDOFF_FORMAT:
+            raise ValueError(f"format {state.get('format')}, expected {HANDOFF_FORMAT}")
     except Exception as e:
-        print(f"[ERROR] Exception in handle_client: {e}")
+        print(f"[ERROR] Could not read the restart state ({e}); clients must reconnect")
+        for fd in client_fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        state = {}
     finally:
-        if client_socket in clients:
-            clients.remove(client_socket)
-        if client_socket in nicknames:
-            left_msg = f"{nicknames[client_socket]} has left the chat."
-            room = user_rooms[nicknames[client_socket]]
-            broadcast((f"{timestamp()} {left_msg}\n").encode('utf-8'), room=room)
-            chat_rooms[room].discard(client_socket)
-            del nicknames[client_socket]
-            # Send user count after leave
-            user_count_msg = f"SERVER> Users connected: {len(nicknames)}\n"
-            broadcast(user_count_msg.encode('utf-8'))
-            print(f"[INFO] Users connected: {len(nicknames)}")
-        if client_socket in admin_clients:
-            admin_clients.remove(client_socket)
-        client_socket.close()
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+    state["listener"] = listener
+    return state
+
+def restore_handoff(state):
+    blocked_nicknames.update(state["blocked_nicknames"])
+    banned_ips.update(state["banned_ips"])
+    reputation.update(state["reputation"])
+    user_rep_votes.update(state["user_rep_votes"])
+    vote_kick_votes.update(state["vote_kick_votes"])
+    reports.update(state["reports"])
+    client_versions.update(state["client_versions"])
+    sessions.version = state["presence_version"]
+    taken_over = []
+    for saved in state["connections"]:
+        address = tuple(saved["address"])
+        if saved["fd"] is None:
+            conn = DetachedConnection(types.SimpleNamespace(address=address, framed=saved["framed"],
+                                                            proto_version=saved["proto_version"]))
+        else:
+            sock = socket.socket(fileno=saved["fd"])
+            sock.set_inheritable(False)
+            conn = SocketConnection(sock, address)
+            conn.stage, conn.pending_nickname = saved["stage"], saved["pending_nickname"]
+            conn.framed, conn.proto_version = saved["framed"], saved["proto_version"]
+            conn.rbuf += saved["rbuf"]
+        with conn.outbox_lock:
+            conn.outbox.extend(Payload(*d) if isinstance(d, tuple) else d for d in saved["queued"])
+            conn.notify_writer()
+        clients.append(conn)
+        if saved["session"] is not None:
+            sessions.restore(conn, saved["session"])
+        if saved["last_message"] is not None:
+            last_messages[conn] = saved["last_message"]
+        taken_over.append(conn)
+    # Only now that every session is back may anyone's lines be handled
+    for conn in taken_over:
+        if isinstance(conn, DetachedConnection):
+            if sessions.get(conn).token:
+                conn.timer.start()
+            else:
+                conn.close()  # cut with no way back: everyone sees it leave
+        else:
+            threading.Thread(target=serve_client, args=(conn,), daemon=True).start()
+    print(f"[INFO] Took over {len(taken_over)} connections and {len(sessions)} sessions from the previous process")
+
+# --- Sampling profiler ---
+# "/profile start [hz]" on the console starts a thread that records the stack
+# of every other thread (client handlers, writers, the event loop, the
+# console) hz times a second. "/profile dump [directory]" writes what was
+# collected so far, without stopping: the stacks in collapsed form (one
+# "outermost;...;innermost count" line per stack, which flamegraph.pl and
+# speedscope read) and a summary of each thread's samples and CPU time.
+# "/profile stop" ends sampling. Clients notice nothing but the sampler's
+# own CPU time, which the summary reports too.
+class SamplingProfiler:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sampler = None
+        self.stop_event = None
+        self.reset()
+
+    def reset(self):
+        self.stacks = defaultdict(int)   # collapsed stack: samples
+        self.threads = {}                # ident: [name, native id, samples]
+        self.labels = {}                 # code object: frame label
+        self.samples = 0
+        self.started = time.time()
+        self.cpu_start = thread_cpu_times()
+
+    def start(self, hz):
+        with self.lock:
+            if self.sampler is not None:
+                return False
+            self.reset()
+            self.stop_event = threading.Event()
+            self.sampler = threading.Thread(target=self.run, args=(1.0 / hz, self.stop_event), daemon=True)
+            self.sampler.start()
+            return True
+
+    def stop(self):
+        with self.lock:
+            sampler = self.sampler
+            if sampler is None:
+                return False
+            self.stop_event.set()
+            self.sampler = None
+        sampler.join()  # outside the lock, which a last sample may be waiting for
+        return True
+
+    def label(self, code):
+        label = self.labels.get(code)
+        if label is None:
+            label = self.labels[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+        return label
+
+    def run(self, interval, stop_event):
+        me = threading.get_ident()
+        while not stop_event.wait(interval):
+            frames = sys._current_frames()
+            with self.lock:
+                if stop_event.is_set():
+                    return  # stopped, maybe already started again, while we took the frames
+                for ident, frame in frames.items():
+                    if ident == me:
+                        continue
+                    stack = []
+                    while frame is not None:
+                        stack.append(self.label(frame.f_code))
+                        frame = frame.f_back
+                    self.stacks[";".join(reversed(stack))] += 1
+                    thread = self.threads.get(ident)
+                    if thread is None:
+                        # A thread we have not seen yet: look up its name once
+                        known = {t.ident: t for t in threading.enumerate()}.get(ident)
+                        thread = self.threads[ident] = [known.name if known else str(ident),
+                                                        getattr(known, "native_id", None), 0]
+                    thread[2] += 1
+                self.samples += 1
+
+    def dump(self, directory, suffix=""):
+        with self.lock:
+            stacks = sorted(self.stacks.items(), key=lambda item: item[1], reverse=True)
+            threads = [list(t) for t in self.threads.values()]
+            samples, started, cpu_start = self.samples, self.started, self.cpu_start
+            sampler = self.sampler
+        cpu_now = thread_cpu_times()
+        base = os.path.join(directory, f"profile-{time.strftime('%Y%m%d-%H%M%S')}{suffix}")
+        with open(base + ".collapsed", "w", encoding="utf-8") as f:
+            for stack, count in stacks:
+                f.write(f"{stack} {count}\n")
+        elapsed = time.time() - started
+        rows = []
+        for name, native_id, count in threads:
+            cpu = None
+            if native_id in cpu_now:
+                cpu = cpu_now[native_id] - cpu_start.get(native_id, 0.0)
+            rows.append((cpu if cpu is not None else -1.0, name, native_id, count))
+        rows.sort(reverse=True)
+        with open(base + "-threads.txt", "w", encoding="utf-8") as f:
+            f.write(f"{samples} samples of {len(threads)} threads over {elapsed:.1f} s\n")
+            if sampler is not None and sampler.native_id in cpu_now:
+                own = cpu_now[sampler.native_id] - cpu_start.get(sampler.native_id, 0.0)
+                f.write(f"sampler CPU: {own:.3f} s ({own / max(elapsed, 1e-9) * 100:.1f}%)\n")
+            f.write(f"{'cpu s':>10} {'cpu %':>6} {'samples':>8}  thread\n")
+            for cpu, name, native_id, count in rows:
+                cpu_text = f"{cpu:10.3f} {cpu / max(elapsed, 1e-9) * 100:6.1f}" if cpu >= 0 else f"{'-':>10} {'-':>6}"
+                f.write(f"{cpu_text} {count:8d}  {name} (tid {native_id}){'' if cpu >= 0 else ', ended'}\n")
+        return base
+
+def thread_cpu_times():
+    # CPU seconds (user + system) of every thread of this process, by native
+    # thread id; empty where /proc is not available
+    times = {}
+    try:
+        tasks = os.listdir("/proc/self/task")
+    except OSError:
+        return times
+    ticks = os.sysconf("SC_CLK_TCK")
+    for task in tasks:
+        try:
+            with open(f"/proc/self/task/{task}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            times[int(task)] = (int(fields[11]) + int(fields[12])) / ticks
+        except (OSError, ValueError, IndexError):
+            pass
+    return times
+
+profiler = SamplingProfiler()
 
 def server_console():
     while True:
-        cmd = input()
-        if cmd.startswith("/autoupdate"):
-            import requests
-            github_url = "https://raw.githubusercontent.com/sirpatch/Lan-Communicator/main/CServer.py"
-            try:
-                print("[INFO] Checking for updates...")
-                resp = requests.get(github_url, timeout=10)
-                if resp.status_code == 200:
-                    import re
-                    m = re.search(r'SERVER_VERSION\s*=\s*"([^"]+)"', resp.text)
-                    if m:
-                        remote_version = m.group(1)
-                        print(f"[INFO] Remote version: {remote_version}")
-                        if remote_version != SERVER_VERSION:
-                            print(f"[INFO] Newer version found: {remote_version}. Downloading...")
-                            with open(__file__, "w", encoding="utf-8") as f:
-                                f.write(resp.text)
-                            print("[INFO] Update complete. Please restart the server.")
-                        else:
-                            print("[INFO] Already up to date.")
+        if not console_command(input()):
+            break
+
+def console_command(cmd):
+    if hub and not cmd.startswith("/autoupdate"):
+        # The workers hold the clients, so they all run the command
+        hub.console(cmd)
+        if cmd in ("/quit", "/exit"):
+            return False
+        if cmd == "/restart":
+            time.sleep(0.5)  # let the workers flush their history
+            hub.stop()
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+        return True
+    # Only one worker answers commands about the whole server
+    lead = worker_id in (None, 0)
+    label = "" if worker_id is None else f" (worker {worker_id})"
+    if cmd.startswith("/autoupdate"):
+        import requests
+        github_url = "https://raw.githubusercontent.com/sirpatch/Lan-Communicator/main/CServer.py"
+        try:
+            print("[INFO] Checking for updates...")
+            resp = requests.get(github_url, timeout=10)
+            if resp.status_code == 200:
+                import re
+                m = re.search(r'SERVER_VERSION\s*=\s*"([^"]+)"', resp.text)
+                if m:
+                    remote_version = m.group(1)
+                    print(f"[INFO] Remote version: {remote_version}")
+                    if remote_version != SERVER_VERSION:
+                        print(f"[INFO] Newer version found: {remote_version}. Downloading...")
+                        with open(__file__, "w", encoding="utf-8") as f:
+                            f.write(resp.text)
+                        print("[INFO] Update complete. /restart applies it" + (" without disconnecting anyone." if HOT_RESTART and SERVER_MODE == "threaded" and not hub else "."))
                     else:
-                        print("[ERROR] Could not find version in remote file.")
+                        print("[INFO] Already up to date.")
                 else:
-                    print(f"[ERROR] Failed to fetch remote file. Status: {resp.status_code}")
-            except Exception as e:
-                print(f"[ERROR] Update failed: {e}")
-        elif cmd.startswith("/msg "):
-            msg = cmd[5:].strip()
+                    print("[ERROR] Could not find version in remote file.")
+            else:
+                print(f"[ERROR] Failed to fetch remote file. Status: {resp.status_code}")
+        except Exception as e:
+            print(f"[ERROR] Update failed: {e}")
+    elif cmd.startswith("/msg "):
+        msg = cmd[5:].strip()
+        if lead:
             print(f"[INFO] SERVER> {msg}")
             broadcast(f"SERVER> {msg}\n".encode('utf-8'))
-        elif cmd.startswith("/block "):
-            to_block = cmd[7:].strip()
-            blocked_nicknames.add(to_block)
+    elif cmd.startswith("/block "):
+        to_block = cmd[7:].strip()
+        blocked_nicknames.add(to_block)
+        if lead:
             print(f"[INFO] Blocked nickname: {to_block}")
-            # Disconnect blocked users immediately
-            for client, nick in list(nicknames.items()):
-                if nick == to_block:
-                    try:
-                        client.sendall(b"You have been blocked by the server.\n")
-                        client.close()
-                    except:
-                        pass
-        elif cmd.startswith("/banip "):
-            ip_to_ban = cmd[7:].strip()
-            banned_ips.add(ip_to_ban)
+        # Disconnect blocked users immediately
+        session = sessions.find(to_block)
+        if session and not session.remote:
+            try:
+                session.conn.sendall(b"You have been blocked by the server.\n")
+                session.conn.close()
+            except:
+                pass
+    elif cmd.startswith("/banip "):
+        ip_to_ban = cmd[7:].strip()
+        banned_ips.add(ip_to_ban)
+        if lead:
             print(f"[INFO] Banned IP: {ip_to_ban}")
-            # Disconnect all clients from this IP
-            for client, nick in list(nicknames.items()):
-                try:
-                    if client.getpeername()[0] == ip_to_ban:
-                        client.sendall(b"Your IP has been banned by the server.\n")
-                        client.close()
-                except:
-                    pass
-        elif cmd.startswith("/unblock "):
-            to_unblock = cmd[9:].strip()
-            if to_unblock in blocked_nicknames:
-                blocked_nicknames.remove(to_unblock)
+        # Disconnect all clients from this IP
+        for session in sessions.from_ip(ip_to_ban):
+            if session.remote:
+                continue
+            try:
+                session.conn.sendall(b"Your IP has been banned by the server.\n")
+                session.conn.close()
+            except:
+                pass
+    elif cmd.startswith("/unblock "):
+        to_unblock = cmd[9:].strip()
+        if to_unblock in blocked_nicknames:
+            blocked_nicknames.remove(to_unblock)
+            if lead:
                 print(f"[INFO] Unblocked nickname: {to_unblock}")
-        elif cmd.startswith("/unbanip "):
-            ip_to_unban = cmd[9:].strip()
-            if ip_to_unban in banned_ips:
-                banned_ips.remove(ip_to_unban)
+    elif cmd.startswith("/unbanip "):
+        ip_to_unban = cmd[9:].strip()
+        if ip_to_unban in banned_ips:
+            banned_ips.remove(ip_to_unban)
+            if lead:
                 print(f"[INFO] Unbanned IP: {ip_to_unban}")
-        elif cmd == "/list":
-            print("[INFO] Connected users:", ", ".join(nicknames.values()))
-        elif cmd == "/blocked":
+    elif cmd == "/list":
+        if lead:
+            print("[INFO] Connected users:", ", ".join(s.nickname for s in sessions.all()))
+    elif cmd == "/peers":
+        for link in list(peer_links.values()):
+            rooms = ", ".join(f"{room} ({n})" for room, n in link.rooms.items() if n > 0)
+            print(f"[INFO] Peer {link.node} {link.address}: members in {rooms or 'no rooms'}")
+        if not peer_links:
+            print("[INFO] No cluster peers linked.")
+    elif cmd == "/fanout":
+        conns = list(clients)
+        messages = metrics.total("messages_total")
+        with fanout_stats_lock:
+            deliveries = fanout_stats["deliveries"] + sum(c.delivered for c in conns)
+            writes = fanout_stats["writes"] + sum(c.writes for c in conns)
+            sent = fanout_stats["bytes"] + sum(c.bytes_sent for c in conns)
+            now = time.time()
+            rate = (messages - fanout_mark["messages"]) / max(now - fanout_mark["time"], 1e-9)
+            fanout_mark.update(time=now, messages=messages)
+        print(f"[INFO] Fan-out{label}: {rate:.1f} messages/sec since last /fanout, {messages} messages, "
+              f"{deliveries} deliveries, {writes} write syscalls ({writes / max(deliveries, 1):.3f} per delivered message), "
+              f"{sent} bytes sent")
+    elif cmd == "/queues":
+        conns = list(clients)
+        print(f"[INFO] Outbound queues{label} ({OVERFLOW_POLICY}, max {OUTBOUND_QUEUE_SIZE}): "
+              f"{sum(c.queue_depth() for c in conns)} queued, {outbound_stats['dropped']} dropped, "
+              f"{outbound_stats['disconnected']} slow clients disconnected")
+        for c in sorted(conns, key=lambda c: c.queue_depth(), reverse=True):
+            print(f"[INFO]   {sessions.get(c).nickname if c in sessions else '-'} {c.address}: depth {c.queue_depth()}, dropped {c.dropped}")
+    elif cmd == "/stats":
+        _, histograms = metrics.collect()
+        timings = sorted(((dict(labels)["command"], h) for (name, labels), h in histograms.items() if name == "command_seconds"),
+                         key=lambda item: item[1][2], reverse=True)
+        print(f"[INFO] Command timing{label}, by total time:")
+        for name, histogram in timings:
+            _, _, total, n = histogram
+            print(f"[INFO]   {name}: {n} calls, {total * 1000:.1f} ms total, mean {total / n * 1e6:.0f} us, "
+                  f"p99 <= {Metrics.quantile(histogram, 0.99) * 1000:g} ms")
+        if not timings:
+            print("[INFO]   No commands handled yet.")
+    elif cmd == "/profile" or cmd.startswith("/profile "):
+        parts = cmd.split()
+        action = parts[1] if len(parts) > 1 else ""
+        suffix = "" if worker_id is None else f"-worker{worker_id}"
+        if action == "start":
+            try:
+                hz = float(parts[2]) if len(parts) > 2 else PROFILE_HZ
+            except ValueError:
+                hz = 0.0
+            hz = min(hz, PROFILE_MAX_HZ)
+            if not hz > 0:  # also turns away "nan"
+                print(f"[INFO] Usage: /profile start [samples/sec, at most {PROFILE_MAX_HZ}]")
+            elif profiler.start(hz):
+                print(f"[INFO] Profiling{label} at {hz:g} samples/sec")
+            else:
+                print(f"[INFO] Already profiling{label}")
+        elif action == "stop":
+            if profiler.stop():
+                print(f"[INFO] Profiling stopped{label} after {profiler.samples} samples, /profile dump writes them")
+            else:
+                print(f"[INFO] Not profiling{label}")
+        elif action == "dump":
+            try:
+                base = profiler.dump(parts[2] if len(parts) > 2 else PROFILE_DIR, suffix)
+                print(f"[INFO] Wrote {base}.collapsed and {base}-threads.txt")
+            except OSError as e:
+                print(f"[ERROR] Profile dump failed: {e}")
+        else:
+            print("[INFO] Usage: /profile start [samples/sec] | stop | dump [directory]")
+    elif cmd == "/blocked":
+        if lead:
             print("[INFO] Blocked nicknames:", ", ".join(blocked_nicknames))
-        elif cmd == "/banned":
+    elif cmd == "/banned":
+        if lead:
             print("[INFO] Banned IPs:", ", ".join(banned_ips))
-        elif cmd in ("/quit", "/exit"):
+    elif cmd in ("/quit", "/exit"):
+        if lead:
             print("[INFO] Shutting down server from console.")
             broadcast(b"SERVER> Server is shutting down.\n")
-            break
-        elif cmd == "/restart":
+        return False
+    elif cmd == "/restart":
+        if worker_id is None and SERVER_MODE == "threaded" and HOT_RESTART:
+            hot_restart()
+            return True
+        if lead:
             print("[INFO] Restarting server by command.")
             broadcast(b"SERVER> Server is restarting...\n")
-            import os, sys
+        history.close()
+        if worker_id is None:
             os.execv(sys.executable, [sys.executable] + sys.argv)
-        else:
-            print("[INFO] Commands: /msg <text>, /block <nickname>, /banip <ip>, /unblock <nickname>, /unbanip <ip>, /list, /blocked, /banned, /quit, /restart")
+    elif lead:
+        print("[INFO] Commands: /msg <text>, /block <nickname>, /banip <ip>, /unblock <nickname>, /unbanip <ip>, /list, /peers, /queues, /fanout, /stats, /profile, /blocked, /banned, /quit, /restart")
+    return True
 
 if __name__ == "__main__":
-    print(f"[INFO] Communicator Server v{SERVER_VERSION} starting on {HOST}:{PORT}")
-    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    server_socket.bind((HOST, PORT))
-    server_socket.listen(100)
-    threading.Thread(target=server_console, daemon=True).start()
+    parser = argparse.ArgumentParser(description="Communicator Server")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--mode", choices=["threaded", "async"], default=SERVER_MODE,
+                        help="threaded: one thread per client, async: all clients on one asyncio event loop")
+    parser.add_argument("--queue-size", type=int, default=OUTBOUND_QUEUE_SIZE,
+                        help="outbound messages buffered per client")
+    parser.add_argument("--overflow", choices=["drop_oldest", "disconnect"], default=OVERFLOW_POLICY,
+                        help="what to do when a client's outbound queue is full")
+    parser.add_argument("--history-db", default=HISTORY_DB,
+                        help="SQLite file for the chat history")
+    parser.add_argument("--workers", type=int, default=WORKERS,
+                        help="run this many worker processes to use several CPU cores (0: single process)")
+    parser.add_argument("--cluster-port", type=int, default=CLUSTER_PORT,
+                        help="accept links from other servers on this port")
+    parser.add_argument("--peer", action="append", default=[], metavar="HOST:PORT",
+                        help="link to the server with this cluster port (repeatable)")
+    parser.add_argument("--node-name", help="name of this server in the cluster")
+    parser.add_argument("--cluster-secret", default=os.environ.get("COMMUNICATOR_CLUSTER_SECRET"),
+                        help="secret shared by the servers of a cluster (default: $COMMUNICATOR_CLUSTER_SECRET)")
+    parser.add_argument("--no-discovery", action="store_true",
+                        help="do not announce this server on the LAN or answer discovery queries")
+    parser.add_argument("--resume-grace", type=int, default=RESUME_GRACE,
+                        help="seconds a dropped client's session is kept for it to resume (0: never)")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT,
+                        help="serve Prometheus metrics on this port (with --workers, worker N uses port + N)")
+    parser.add_argument("--plugin", action="append", default=[], metavar="MODULE",
+                        help="import MODULE and let it register client commands (repeatable)")
+    args = parser.parse_args()
+    HOST, PORT, SERVER_MODE = args.host, args.port, args.mode
+    OUTBOUND_QUEUE_SIZE, OVERFLOW_POLICY = args.queue_size, args.overflow
+    HISTORY_DB = args.history_db
+    WORKERS = args.workers
+    CLUSTER_PORT, PEERS = args.cluster_port, args.peer
+    CLUSTER_SECRET = args.cluster_secret
+    NODE_NAME = args.node_name or f"{socket.gethostname()}:{PORT}"
+    DISCOVERY = not args.no_discovery
+    RESUME_GRACE = args.resume_grace
+    METRICS_PORT = args.metrics_port
+    if WORKERS and (CLUSTER_PORT or PEERS):
+        parser.error("--workers cannot be combined with cluster links yet")
+    load_plugins(args.plugin)
+    print(f"[INFO] Communicator Server v{SERVER_VERSION} starting on {HOST}:{PORT} ({SERVER_MODE} mode"
+          + (f", {WORKERS} workers)" if WORKERS else ")"))
+    handed_over = None
+    if HANDOFF_ENV in os.environ:
+        fds = [int(fd) for fd in os.environ.pop(HANDOFF_FDS_ENV).split(",")]
+        handed_over = load_handoff(os.environ.pop(HANDOFF_ENV), fds)
+    if handed_over:
+        server_socket = socket.socket(fileno=handed_over["listener"])
+        server_socket.set_inheritable(False)
+    else:
+        server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server_socket.bind((HOST, PORT))
+        server_socket.listen(1024 if SERVER_MODE == "async" or WORKERS else 100)
+    listening_socket = server_socket
+    if not WORKERS:
+        history = HistoryStore(HISTORY_DB)
+        typing_users = TypingTracker()
+        if handed_over and handed_over.get("format") == HANDOFF_FORMAT:
+            restore_handoff(handed_over)
+        threading.Thread(target=server_console, daemon=True).start()
+        start_federation()
+        start_discovery()
+        start_metrics(METRICS_PORT)
     try:
-        while True:
-            client_socket, address = server_socket.accept()
-            clients.append(client_socket)
-            threading.Thread(target=handle_client, args=(client_socket, address), daemon=True).start()
+        if WORKERS:
+            run_workers(server_socket)
+        elif SERVER_MODE == "async":
+            run_async_server(server_socket)
+        else:
+            run_threaded_server(server_socket)
     except KeyboardInterrupt:
         print("[INFO] Server shutting down.")
     finally:
-        server_socket.close()
\ No newline at end of file
+        server_socket.close()
+        if history:
+            history.close()
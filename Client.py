@@ -12,6 +12,16 @@ import re
 import base64
 import urllib.request
 import random
+import struct
+import itertools
+import tempfile
+import shutil
+import secrets
+import selectors
+import errno
+import json
+import sqlite3
+from collections import deque
 
 # --- Requirements check and auto-install ---
 REQUIRED_MODULES = ["curses"]
@@ -39,10 +49,267 @@ def check_and_install_requirements():
 
 check_and_install_requirements()
 
+# --- Framed protocol (must match CServer.py) ---
+# Servers that support frames advertise "PROTO LCF/<version>" before the
+# nickname prompt. We answer with FRAME_MAGIC + our version and from then on
+# every message is: version (1 byte) | type (1 byte) | length (4 bytes) | payload
+FRAME_MAGIC = b"LCF"
+FRAME_VERSION = 4
+FRAME_HEADER = struct.Struct("!BBI")
+MAX_FRAME_SIZE = 8 * 1024 * 1024
+FRAME_HELLO = 0
+FRAME_TEXT = 1
+FRAME_FILE_OFFER = 2  # transfer id, size (!IQ) + "peer\0filename"
+FRAME_FILE_CHUNK = 3  # transfer id (!I) + raw file bytes
+FRAME_FILE_ACK = 4    # transfer id, bytes received so far (!IQ)
+FRAME_FILE_END = 5    # transfer id (!I)
+FRAME_FILE_ABORT = 6  # transfer id, upload flag (!IB) + reason
+FRAME_CHAT = 7        # history id (!Q) + chat line (version 2)
+FRAME_TYPING = 8      # room, number typing, nicknames, NUL separated (version 3)
+FRAME_PRESENCE = 9    # user list snapshot or change, JSON (version 4)
+CHAT_ID = struct.Struct("!Q")
+
+# --- Chunked file transfer ---
+FILE_CHUNK_SIZE = 64 * 1024
+FILE_WINDOW = 8 * FILE_CHUNK_SIZE   # unacknowledged bytes a sender may have in flight
+FILE_ACK_TIMEOUT = 30               # seconds without progress before giving up
+FILE_OFFER = struct.Struct("!IQ")
+FILE_ID = struct.Struct("!I")
+FILE_ACK = struct.Struct("!IQ")
+FILE_ABORT = struct.Struct("!IB")
+
+# --- Direct (peer-to-peer) file transfer ---
+P2P_ACCEPT_TIMEOUT = 5       # seconds the sender waits for the receiver to connect
+P2P_CONNECT_TIMEOUT = 3      # seconds the receiver tries to reach the sender
+P2P_BLOCK_SIZE = 4 * 1024 * 1024
+P2P_BUFFER_SIZE = 256 * 1024
+
+# --- Chat window rendering ---
+RENDER_FRAME = 1 / 30         # seconds between screen updates
+ANIMATE_CHAR_DELAY = 0.025    # typewriter effect: seconds per character
+ANIMATE_BACKLOG = 3           # lines waiting before the typewriter effect is skipped
+ANIMATE_RESUME = 1.0          # seconds without a backlog before it comes back
+SCROLLBACK_LINES = 10000      # messages kept for scrolling back
+
+# --- Reconnecting ---
+CONNECT_TIMEOUT = 10          # seconds to reach the server and log in
+RECONNECT_MIN_DELAY = 0.5     # first retry after the connection dropped
+RECONNECT_MAX_DELAY = 30      # the delay doubles up to this
+
+# --- Typing indicator ---
+TYPING_REFRESH = 3            # seconds between two /typing while the user keeps typing
+
+# --- LAN server discovery ---
+SCAN_IN_FLIGHT = 256       # connection attempts open at the same time
+SCAN_HOST_TIMEOUT = 0.5    # seconds a host gets to accept and send its banner
+SCAN_DEADLINE = 3.0        # seconds the whole scan may take
+SERVER_PORT = 3256
+DISCOVERY_GROUP = "239.255.32.56"   # servers announce themselves here
+DISCOVERY_PORT = 3257
+DISCOVERY_SERVICE = "lan-communicator"
+
+def encode_frame(frame_type, payload, version=FRAME_VERSION):
+    return FRAME_HEADER.pack(version, frame_type, len(payload)) + payload
+
+class RecvBuffer:
+    # Receive buffer with a read cursor. recv_into() fills the free space at
+    # the end, readers move the cursor forward, and unread bytes are only
+    # moved (once) when the free space runs out, so the cost is linear in the
+    # bytes received. Views handed out are valid until the next receive.
+    RECV_SIZE = 65536
+
+    def __init__(self, capacity=RECV_SIZE * 4):
+        self.buf = bytearray(capacity)
+        self.view = memoryview(self.buf)
+        self.start = 0  # first unread byte
+        self.end = 0    # end of the received bytes
+
+    def __len__(self):
+        return self.end - self.start
+
+    def reserve(self, size):
+        if len(self.buf) - self.end >= size:
+            return
+        unread = self.end - self.start
+        if unread + size <= len(self.buf) // 2:
+            self.view[:unread] = self.view[self.start:self.end]  # compact in place
+        else:
+            buf = bytearray(max(len(self.buf) * 2, unread + size))
+            buf[:unread] = self.view[self.start:self.end]
+            self.buf, self.view = buf, memoryview(buf)
+        self.start, self.end = 0, unread
+
+    def recv_from(self, sock, size=RECV_SIZE):
+        # One recv_into() straight into the buffer; returns 0 on EOF
+        self.reserve(size)
+        n = sock.recv_into(self.view[self.end:self.end + size])
+        self.end += n
+        return n
+
+    def find(self, sub, offset=0):
+        pos = self.buf.find(sub, self.start + offset, self.end)
+        return pos if pos == -1 else pos - self.start
+
+    def rfind(self, sub, offset=0):
+        pos = self.buf.rfind(sub, self.start + offset, self.end)
+        return pos if pos == -1 else pos - self.start
+
+    def startswith(self, prefix):
+        return self.buf.startswith(prefix, self.start, self.end)
+
+    def peek(self, n):
+        return self.view[self.start:self.start + n]
+
+    def take(self, n):
+        data = self.view[self.start:self.start + n]
+        self.start += n
+        return data
+
+    def skip(self, n):
+        self.start += n
+
+def parse_frames(buf):
+    # Yield (type, payload) for every complete frame in buf (a RecvBuffer).
+    # Payloads are memoryviews into the buffer.
+    while len(buf) >= FRAME_HEADER.size:
+        version, frame_type, length = FRAME_HEADER.unpack_from(buf.buf, buf.start)
+        if length > MAX_FRAME_SIZE:
+            raise ValueError(f"frame too large ({length} bytes)")
+        if len(buf) < FRAME_HEADER.size + length:
+            break
+        buf.skip(FRAME_HEADER.size)
+        yield frame_type, buf.take(length)
+
+def recv_frame(sock, buf):
+    # Block until one complete frame is available (used during the handshake)
+    while True:
+        for frame_type, payload in parse_frames(buf):
+            return frame_type, bytes(payload)
+        if not buf.recv_from(sock):
+            raise ConnectionError("Server closed the connection")
+
 NICKNAME_FILE = os.path.expanduser("~/.communicator_nick")
 COLOR_FILE = os.path.expanduser("~/.communicator_color")
+CACHE_FILE = os.path.expanduser("~/.communicator_cache.db")
+CACHE_ROOM_LIMIT = 1000      # cached messages kept per server and room
+CACHE_PAINT = 100            # cached messages shown at startup
+CACHE_COMMIT_INTERVAL = 1.0  # seconds between cache commits
+
+# --- Scrollback ---
+def wrap_text(text, width):
+    rows = []
+    for line in text.split('\n'):
+        rows.extend(line[i:i + width] for i in range(0, max(len(line), 1), width))
+    return rows
+
+class Scrollback:
+    # The chat history as a ring of the last SCROLLBACK_LINES messages.
+    # Messages are wrapped when first drawn and again only when the width
+    # changes, and draw() only looks at the messages that fit on screen, so
+    # neither memory nor redraw time grows with the length of the session.
+    def __init__(self, capacity=SCROLLBACK_LINES):
+        self.capacity = capacity
+        self.records = [None] * capacity  # [text, attr, wrapped for width, rows]
+        self.count = 0    # messages added so far; message n is records[n % capacity]
+        self.cleared = 0  # /clear hides the messages before this one
+        self.bottom = None  # last message on screen when scrolled back, None to follow new ones
+        self.mentions = deque()  # numbers of the messages that mention us
+
+    def oldest(self):
+        return max(0, self.count - self.capacity)
+
+    def append(self, text, attr, mention=False):
+        self.records[self.count % self.capacity] = [text, attr, 0, None]
+        if mention:
+            self.mentions.append(self.count)
+        self.count += 1
+        while self.mentions and self.mentions[0] < self.oldest():
+            self.mentions.popleft()
+        if self.bottom is not None and self.bottom < self.oldest():
+            self.bottom = self.oldest()
+
+    def clear(self):
+        self.cleared = self.count
+        self.bottom = None
+
+    def rows(self, n, width):
+        record = self.records[n % self.capacity]
+        if record[2] != width:
+            record[2], record[3] = width, wrap_text(record[0], width)
+        return record[3]
+
+    def page_up(self, height, width):
+        n = self.count - 1 if self.bottom is None else self.bottom
+        seen = 0
+        while n > self.oldest() and seen < height - 1:
+            seen += len(self.rows(n, width))
+            n -= 1
+        if self.count:
+            self.bottom = n
+
+    def page_down(self, height, width):
+        if self.bottom is None:
+            return
+        n = self.bottom
+        seen = 0
+        while n < self.count - 1 and seen < height - 1:
+            n += 1
+            seen += len(self.rows(n, width))
+        self.bottom = None if n >= self.count - 1 else n
+
+    def follow(self):
+        self.bottom = None
+
+    def previous_mention(self):
+        # Scroll so the mention before the bottom line is the last one on screen
+        limit = self.count if self.bottom is None else self.bottom
+        for n in reversed(self.mentions):
+            if n < limit:
+                self.bottom = n
+                return True
+        return False
+
+    def draw(self, win, tail=None):
+        # Fill win with the messages ending at self.bottom (or the newest);
+        # tail is (text, attr) of a line that is still being typed out
+        height, width = win.getmaxyx()
+        width -= 1  # curses cannot write to the bottom-right cell
+        lines = []  # (row, attr), bottom first
+        if self.bottom is None:
+            last, first = self.count - 1, max(self.cleared, self.oldest())
+            if tail:
+                lines.extend((row, tail[1]) for row in reversed(wrap_text(tail[0], width)))
+        else:
+            last, first = self.bottom, self.oldest()
+            height -= 1  # status row
+        n = last
+        while n >= first and len(lines) < height:
+            attr = self.records[n % self.capacity][1]
+            lines.extend((row, attr) for row in reversed(self.rows(n, width)))
+            n -= 1
+        win.erase()
+        for y, (row, attr) in enumerate(reversed(lines[:height])):
+            win.addstr(y, 0, row, attr)
+        if self.bottom is not None:
+            status = f"-- {self.count - 1 - self.bottom} newer messages, End to return --"
+            win.addstr(height, 0, status[:width], curses.A_REVERSE)
 
 # --- Utility functions ---
+def typing_summary(count, names, nickname):
+    # "A is typing...", "A and B are typing...", "A, B and 3 others are typing..."
+    if nickname in names:
+        names = [n for n in names if n != nickname]
+        count -= 1
+    if count <= 0:
+        return ""
+    if len(names) < min(count, 2):
+        return f"{count} people are typing..."
+    if count == 1:
+        return f"{names[0]} is typing..."
+    if count <= 3 and len(names) == count:
+        return f"{', '.join(names[:-1])} and {names[-1]} are typing..."
+    return f"{names[0]}, {names[1]} and {count - 2} others are typing..."
+
 def save_nickname(nickname):
     try:
         with open(NICKNAME_FILE, "w", encoding="utf-8") as f:
@@ -103,6 +370,83 @@ def play_notification_sound():
     except Exception:
         pass
 
+# --- Local message cache ---
+# Chat lines the server sent with their history id, kept per server and room
+# so a restarted client can show the conversation right away and then ask the
+# server (/sync) only for what is newer. Commits are batched so the receive
+# thread hardly ever waits on the disk. Live lines ("[12:00:00] nick> text")
+# and history rows ("[2024-05-01 12:00] #42 nick> text") are stored as the
+# same fields and formatted alike when shown.
+CHAT_LINE = re.compile(r"\[([0-9: -]+)\] (?:#\d+ )?(.+?)> (.*)", re.S)
+
+def parse_chat_line(line):
+    # (time, nickname, text) of a chat line, or None
+    m = CHAT_LINE.fullmatch(line)
+    if not m:
+        return None
+    stamp, nickname, text = m.groups()
+    try:
+        if len(stamp) == 8:  # today
+            when = time.strptime(time.strftime("%Y-%m-%d ") + stamp, "%Y-%m-%d %H:%M:%S")
+        else:
+            when = time.strptime(stamp, "%Y-%m-%d %H:%M")
+    except ValueError:
+        return None
+    return time.mktime(when), nickname, text
+
+def format_chat_line(msg_id, when, nickname, text):
+    stamp = time.localtime(when)
+    today = time.strftime("%Y-%m-%d", stamp) == time.strftime("%Y-%m-%d")
+    return f"{time.strftime('[%H:%M:%S]' if today else '[%Y-%m-%d %H:%M]', stamp)} #{msg_id} {nickname}> {text}"
+
+class MessageCache:
+    def __init__(self, path, server):
+        self.server = server
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chat_lines (server TEXT NOT NULL, room TEXT NOT NULL, "
+                        "id INTEGER NOT NULL, time REAL NOT NULL, nickname TEXT NOT NULL, text TEXT NOT NULL, "
+                        "PRIMARY KEY (server, room, id))")
+        # Keep the newest CACHE_ROOM_LIMIT messages of every room of this server
+        rooms = self.db.execute("SELECT DISTINCT room FROM chat_lines WHERE server = ?", (server,)).fetchall()
+        for (room,) in rooms:
+            self.db.execute("DELETE FROM chat_lines WHERE server = ? AND room = ? AND id < (SELECT id FROM chat_lines "
+                            "WHERE server = ? AND room = ? ORDER BY id DESC LIMIT 1 OFFSET ?)",
+                            (server, room, server, room, CACHE_ROOM_LIMIT - 1))
+        self.db.commit()
+        self.committed = time.time()
+
+    def recent(self, room, limit):
+        # (id, time, nickname, text) rows, oldest first
+        with self.lock:
+            rows = self.db.execute("SELECT id, time, nickname, text FROM chat_lines WHERE server = ? AND room = ? "
+                                   "ORDER BY id DESC LIMIT ?", (self.server, room, limit)).fetchall()
+        return rows[::-1]
+
+    def last_id(self, room):
+        with self.lock:
+            return self.db.execute("SELECT MAX(id) FROM chat_lines WHERE server = ? AND room = ?",
+                                   (self.server, room)).fetchone()[0] or 0
+
+    def add(self, room, msg_id, when, nickname, text):
+        with self.lock:
+            if self.db is None:
+                return
+            self.db.execute("INSERT OR IGNORE INTO chat_lines VALUES (?, ?, ?, ?, ?, ?)",
+                            (self.server, room, msg_id, when, nickname, text))
+            if time.time() - self.committed > CACHE_COMMIT_INTERVAL:
+                self.db.commit()
+                self.committed = time.time()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
+
 # --- Main Communicator ---
 def main(stdscr):
     # --- Call state ---
@@ -138,13 +482,18 @@ def main(stdscr):
     def create_windows():
         max_y, max_x = stdscr.getmaxyx()
         chat_win = curses.newwin(max_y - 3, max_x, 0, 0)
-        chat_win.scrollok(True)
         input_win = curses.newwin(1, max_x, max_y - 2, 0)
+        input_win.keypad(True)
         status_win = curses.newwin(1, max_x, max_y - 1, 0)
         return chat_win, input_win, status_win, max_y, max_x
 
     chat_win, input_win, status_win, max_y, max_x = create_windows()
     lock = threading.Lock()
+    typing_line = ""  # who else is typing, shown in the separator row
+    def draw_separator():
+        text = f"-- {typing_line} " if typing_line else ""
+        stdscr.addstr(max_y - 3, 0, (text + "-" * max_x)[:max_x - 1])
+        stdscr.refresh()
     stop_event = threading.Event()
 
     # --- Get server and nickname ---
@@ -155,14 +504,113 @@ def main(stdscr):
     stdscr.refresh()
     curses.echo()
     server_ip = stdscr.getstr(max_y - 2, len(server_prompt)).decode().strip() or "172.22.90.1"
+    server_port = SERVER_PORT
+    if server_ip.count(":") == 1 and server_ip.split(":")[1].isdigit():
+        server_ip, server_port = server_ip.split(":")[0], int(server_ip.split(":")[1])
     if server_ip.lower() == 'scan':
+        def pick_announced_server():
+            # Live list of the servers announcing themselves on DISCOVERY_GROUP.
+            # A query to the group (and as a broadcast, for networks that drop
+            # multicast) makes them answer right away instead of at their next
+            # announcement. Returns (ip, port), None to quit, or "probe" to fall
+            # back to probing every host of the subnet.
+            try:
+                listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+                listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+                if hasattr(socket, "SO_REUSEPORT"):
+                    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+                listener.bind(("", DISCOVERY_PORT))
+                listener.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                                    struct.pack("4s4s", socket.inet_aton(DISCOVERY_GROUP), socket.inet_aton("0.0.0.0")))
+                listener.setblocking(False)
+            except OSError:
+                return "probe"
+            # Replies come back unicast to a socket of our own: the discovery
+            # port may be shared with a server running on this machine.
+            querier = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            querier.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+            querier.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+            querier.setblocking(False)
+            def query():
+                packet = json.dumps({"service": DISCOVERY_SERVICE, "query": 1}).encode('utf-8')
+                for target in (DISCOVERY_GROUP, "<broadcast>"):
+                    try:
+                        querier.sendto(packet, (target, DISCOVERY_PORT))
+                    except OSError:
+                        pass
+            found = {}  # (ip, port): announcement, in the order they were first seen
+            typed = ""
+            prompt = "Number + Enter to connect, Enter to ask again, 's' to probe every host, 'q' to quit: "
+            def draw():
+                stdscr.clear()
+                stdscr.addstr(0, 0, "Servers on the network (live):", curses.color_pair(3))
+                if not found:
+                    stdscr.addstr(1, 0, "Waiting for server announcements..."[:max_x-1])
+                for idx, ((ip, port), info) in enumerate(list(found.items())[:max_y - 4]):
+                    rooms = ", ".join(str(r) for r in info.get("rooms", []))
+                    load = info.get("load")
+                    line = (f"{idx+1}. {ip}:{port}  {info.get('name', '')}  v{info.get('version', '?')}  "
+                            f"{info.get('users', '?')} users  load {'?' if load is None else load}  rooms: {rooms}")
+                    stdscr.addstr(idx + 1, 0, line[:max_x-1])
+                stdscr.addstr(max_y - 2, 0, (prompt + typed)[:max_x-1])
+                stdscr.refresh()
+            curses.noecho()
+            stdscr.timeout(100)
+            try:
+                query()
+                draw()
+                while True:
+                    changed = False
+                    for s in (listener, querier):
+                        while True:
+                            try:
+                                data, address = s.recvfrom(2048)
+                            except OSError:
+                                break
+                            try:
+                                info = json.loads(data)
+                                if not isinstance(info, dict) or info.get("service") != DISCOVERY_SERVICE or info.get("query"):
+                                    continue
+                                key = (address[0], int(info.get("port", SERVER_PORT)))
+                            except (ValueError, TypeError):
+                                continue
+                            changed = changed or found.get(key) != info
+                            found[key] = info
+                    ch = stdscr.getch()
+                    if ch in (10, 13, curses.KEY_ENTER):
+                        if not typed:
+                            query()
+                        elif 1 <= int(typed) <= len(found):
+                            return list(found)[int(typed) - 1]
+                        typed = ""
+                    elif ch in (curses.KEY_BACKSPACE, 127, 8):
+                        typed = typed[:-1]
+                    elif ch in (ord('s'), ord('S')) and not typed:
+                        return "probe"
+                    elif ch in (ord('q'), ord('Q'), 27):
+                        return None
+                    elif ord('0') <= ch <= ord('9'):
+                        typed += chr(ch)
+                    elif not changed:
+                        continue
+                    draw()
+            finally:
+                stdscr.timeout(-1)
+                curses.echo()
+                listener.close()
+                querier.close()
+        picked = pick_announced_server()
+        if picked is None:
+            return
+        if picked != "probe":
+            server_ip, server_port = picked
+    if server_ip.lower() == 'scan':
+        # Fallback for servers that do not announce themselves (older versions,
+        # networks that drop multicast and broadcast)
         scan_msg = "Scanning for servers..."
         input_win.clear(); input_win.addstr(scan_msg[:input_win.getmaxyx()[1]-1]); input_win.refresh()
-        def scan_for_servers(port=3256, timeout=0.2, already_scanned=None, already_found=None):
-            import socket
+        def local_subnet_hosts():
             import ipaddress
-            found = already_found or []
-            scanned = already_scanned or set()
             # Try to get all local IPv4 addresses
             try:
                 import netifaces
@@ -182,7 +630,8 @@ def main(stdscr):
                     s.close()
                 except Exception:
                     local_ips = ["127.0.0.1"]
-            # Scan all /24 subnets for all interfaces
+            # All /24 subnets for all interfaces
+            hosts = []
             for local_ip in local_ips:
                 try:
                     net = ipaddress.IPv4Interface(local_ip + "/24").network
@@ -190,49 +639,105 @@ def main(stdscr):
                     continue
                 for ip in net.hosts():
                     ipstr = str(ip)
-                    if ipstr in scanned or ipstr == local_ip:
-                        continue
-                    scanned.add(ipstr)
-                    # Show currently scanned IP
-                    input_win.clear(); input_win.addstr(f"Scanning: {ipstr}"[:input_win.getmaxyx()[1]-1]); input_win.refresh()
-                    try:
+                    if ipstr != local_ip and ipstr not in hosts:
+                        hosts.append(ipstr)
+            return hosts
+
+        def scan_for_servers(hosts, port=SERVER_PORT, on_found=None, on_progress=None):
+            # Probe up to SCAN_IN_FLIGHT hosts at once with non-blocking
+            # connects. A host that neither refuses nor sends a banner within
+            # SCAN_HOST_TIMEOUT is given up on, and the scan as a whole stops
+            # at SCAN_DEADLINE.
+            sel = selectors.DefaultSelector()
+            pending = list(reversed(hosts))
+            deadline = time.time() + SCAN_DEADLINE
+            done = 0
+            try:
+                while (pending or sel.get_map()) and time.time() < deadline:
+                    while pending and len(sel.get_map()) < SCAN_IN_FLIGHT:
+                        ipstr = pending.pop()
                         s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                        s.settimeout(timeout)
-                        s.connect((ipstr, port))
-                        s.sendall(b"\n")
-                        banner = s.recv(1024).decode(errors='ignore')
-                        if "nickname" in banner.lower() or "welcome" in banner.lower():
-                            found.append((ipstr, banner.strip()))
+                        s.setblocking(False)
+                        err = s.connect_ex((ipstr, port))
+                        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, getattr(errno, "WSAEWOULDBLOCK", -1)):
                             s.close()
-                            return found, scanned, True  # Stop scan, found server
-                        s.close()
-                    except Exception:
-                        pass
-            return found, scanned, False  # No new server found
+                            done += 1
+                            continue
+                        sel.register(s, selectors.EVENT_WRITE, [ipstr, time.time() + SCAN_HOST_TIMEOUT, b""])
+                    now = time.time()
+                    for key, events in sel.select(timeout=max(0.0, min(0.05, deadline - now))):
+                        s, (ipstr, expires, banner) = key.fileobj, key.data
+                        finished = True
+                        try:
+                            if events & selectors.EVENT_WRITE:
+                                # Connected (or refused): wait for the banner
+                                if s.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                                    sel.modify(s, selectors.EVENT_READ, key.data)
+                                    finished = False
+                            else:
+                                data = s.recv(1024)
+                                key.data[2] = banner = banner + data
+                                text = banner.decode(errors='ignore')
+                                if "nickname" in text.lower() or "welcome" in text.lower():
+                                    if on_found:
+                                        on_found(ipstr, " ".join(text.split()))
+                                elif data and len(banner) < 1024:
+                                    finished = False
+                        except OSError:
+                            pass
+                        if finished:
+                            sel.unregister(s)
+                            s.close()
+                            done += 1
+                    now = time.time()
+                    for key in list(sel.get_map().values()):
+                        if now > key.data[1]:
+                            sel.unregister(key.fileobj)
+                            key.fileobj.close()
+                            done += 1
+                    if on_progress:
+                        on_progress(done, len(hosts))
+            finally:
+                for key in list(sel.get_map().values()):
+                    key.fileobj.close()
+                sel.close()
+
         servers = []
-        scanned = set()
+        max_list_lines = max_y - 6  # Leave space for prompt and input
+        def show_servers():
+            # Print server list line by line, paginated to fit window
+            stdscr.clear()
+            stdscr.addstr(0, 0, "Servers found:", curses.color_pair(3))
+            for idx, (ip, banner) in enumerate(servers[:max_list_lines]):
+                line = f"{idx+1}. {ip} - {banner}"
+                stdscr.addstr(idx + 1, 0, line[:max_x-1])
+            stdscr.refresh()
+        def on_found(ip, banner):
+            servers.append((ip, banner))
+            show_servers()
+        last_progress = [0]
+        def on_progress(done, total):
+            if time.time() - last_progress[0] < 0.1 and done < total:
+                return
+            last_progress[0] = time.time()
+            progress = f"Scanning: {done}/{total} hosts, {len(servers)} servers found"
+            input_win.clear(); input_win.addstr(progress[:input_win.getmaxyx()[1]-1]); input_win.refresh()
         keep_scanning = True
         while keep_scanning:
-            new_servers, scanned, found_flag = scan_for_servers(already_scanned=scanned, already_found=servers)
-            servers = new_servers
+            known = {ip for ip, _ in servers}
+            scan_for_servers([ip for ip in local_subnet_hosts() if ip not in known], on_found=on_found, on_progress=on_progress)
             input_win.clear(); input_win.refresh()
             if not servers:
                 stdscr.addstr(max_y - 2, 0, "No Communicator servers found on local network. Press any key.")
                 stdscr.refresh()
                 stdscr.getch()
                 return
-            # Print server list line by line, paginated to fit window
-            stdscr.clear()
-            stdscr.addstr(0, 0, "Servers found:", curses.color_pair(3))
-            max_list_lines = max_y - 6  # Leave space for prompt and input
-            for idx, (ip, banner) in enumerate(servers[:max_list_lines]):
-                line = f"{idx+1}. {ip} - {banner}"
-                stdscr.addstr(idx + 1, 0, line[:max_x-1])
+            show_servers()
             prompt_line = min(len(servers), max_list_lines) + 2
-            stdscr.addstr(prompt_line, 0, "Enter server number to connect, or press Enter to scan more: ")
+            stdscr.addstr(prompt_line, 0, "Enter server number to connect, or press Enter to scan again: ")
             stdscr.refresh()
             curses.echo()
-            user_input = stdscr.getstr(prompt_line, len("Enter server number to connect, or press Enter to scan more: ")).decode().strip()
+            user_input = stdscr.getstr(prompt_line, len("Enter server number to connect, or press Enter to scan again: ")).decode().strip()
             if user_input.isdigit():
                 sel = int(user_input)
                 if 1 <= sel <= len(servers):
@@ -245,7 +750,7 @@ def main(stdscr):
                     keep_scanning = False
                     return
             elif user_input == "":
-                # Continue scanning for more servers
+                # Scan again for servers that came up since
                 continue
             else:
                 stdscr.addstr(prompt_line + 1, 0, "Invalid input. Press any key.")
@@ -270,44 +775,247 @@ def main(stdscr):
         nonlocal chat_win, input_win, status_win, max_y, max_x
         chat_win, input_win, status_win, max_y, max_x = create_windows()
         stdscr.clear()
-        stdscr.addstr(max_y - 3, 0, "-" * (max_x - 1))
-        stdscr.refresh()
-        chat_win.refresh()
+        draw_separator()
         input_win.refresh()
         status_win.refresh()
+        render_wake.set()  # the scrollback is re-wrapped for the new width
+
+    # --- Render thread ---
+    # Chat lines are only queued by the other threads; render_loop() adds them
+    # to the scrollback and redraws the visible part of it, once per frame at
+    # most. A lone line is typed out, but once ANIMATE_BACKLOG lines are
+    # waiting they are drawn whole (until things calm down again), so a flood
+    # never holds up the socket.
+    scrollback = Scrollback()
+    render_queue = deque()  # (text, color, animate, mention); text None clears the window
+    render_wake = threading.Event()  # set when there is something to draw
+    def show_line(text, color, animate=False, mention=False):
+        render_queue.append((text, color, animate, mention))
+        render_wake.set()
+
+    def show_typing(text):
+        nonlocal typing_line
+        if text == typing_line:
+            return
+        with lock:
+            typing_line = text
+            draw_separator()
+            input_win.refresh()  # keep the cursor on the input line
+
+    def render_loop():
+        typing = None  # line being typed out: [text, color, mention, started]
+        calm_after = 0  # no typewriter effect before this time
+        while not stop_event.is_set():
+            if typing is None:
+                render_wake.wait(0.5)
+                if not render_wake.is_set():
+                    continue
+            render_wake.clear()
+            frame_start = time.time()
+            if len(render_queue) >= ANIMATE_BACKLOG:
+                calm_after = frame_start + ANIMATE_RESUME
+            with lock:
+                if typing is not None:
+                    text, color, mention, started = typing
+                    if frame_start < calm_after or (frame_start - started) / ANIMATE_CHAR_DELAY >= len(text):
+                        scrollback.append(text, color, mention)
+                        typing = None
+                while typing is None and render_queue:
+                    text, color, animate, mention = render_queue.popleft()
+                    if text is None:
+                        scrollback.clear()
+                    elif animate and frame_start >= calm_after:
+                        typing = [text, color, mention, frame_start]
+                    else:
+                        scrollback.append(text, color, mention)
+                tail = None
+                if typing is not None:
+                    tail = (typing[0][:int((frame_start - typing[3]) / ANIMATE_CHAR_DELAY) + 1], typing[1])
+                try:
+                    scrollback.draw(chat_win, tail)
+                    chat_win.noutrefresh()
+                    input_win.noutrefresh()  # keep the cursor on the input line
+                    curses.doupdate()
+                except curses.error:
+                    pass
+            time.sleep(max(0.0, frame_start + RENDER_FRAME - time.time()))
+
+    # --- Cached history ---
+    # Show what the last session left in the cache before connecting; /sync
+    # asks for the newer messages once the handshake is done.
+    chat_state = {
+        'room': 'main',   # the room we are in, as confirmed by the server
+        'last_id': 0,     # newest history id received for that room
+    }
+    try:
+        cache = MessageCache(CACHE_FILE, f"{server_ip}:{server_port}")
+        cached = cache.recent(chat_state['room'], CACHE_PAINT)
+        chat_state['last_id'] = cache.last_id(chat_state['room'])
+    except sqlite3.Error:
+        cache, cached = None, []
+    for row in cached:
+        show_line(format_chat_line(*row), user_color | curses.A_DIM)
+    if cached:
+        show_line("-- cached messages, catching up --", curses.color_pair(3))
+    threading.Thread(target=render_loop, daemon=True).start()
 
     # --- Connect ---
-    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # connect() dials the server and logs in. With the token of a session
+    # whose connection dropped it asks the server to resume that session (no
+    # nickname, no password, nobody sees us leave and come back); if the
+    # server no longer knows the token we log in again like a new client.
+    sock = None
+    proto_state = {
+        'framed': False,      # True once the server accepted framed mode
+        'version': 0,         # Negotiated frame version
+    }
+    # The user list, kept up to date by FRAME_PRESENCE so /list needs no
+    # round trip. Changes are numbered; after a gap we ask for a new snapshot.
+    roster = {
+        'version': None,      # presence version of 'users', None until the first snapshot
+        'users': {},          # nickname: status
+        'resync': False,      # /roster sent, waiting for the snapshot
+    }
+    session_state = {
+        'token': None,        # from "/session <token>", to resume after a dropped connection
+        'password': None,     # admin password, to log in again when resuming fails
+        'up': False,          # logged in; send_text() queues lines while this is False
+        'outbox': [],         # lines typed while reconnecting
+    }
+    # Only the main thread reads keys. When the connection thread needs the
+    # admin password to log back in, it asks read_input() for it and waits.
+    password_request = {
+        'prompt': None,       # shown instead of the nickname while waiting for the password
+        'answer': None,
+        'ready': threading.Event(),
+    }
+    def ask_password(prompt):
+        password_request['answer'] = None
+        password_request['ready'].clear()
+        password_request['prompt'] = prompt.strip() + " "
+        show_line("The server wants the admin password again to log back in.", curses.color_pair(4))
+        with lock:
+            input_win.erase()
+            input_win.addstr(0, 0, password_request['prompt'][:input_win.getmaxyx()[1] - 1], user_color)
+            input_win.refresh()
+        while not password_request['ready'].wait(0.5):
+            if stop_event.is_set():
+                raise ConnectionError("client is closing")
+        return password_request['answer']
+    handshake_buf = RecvBuffer()  # Bytes read past the handshake, handed to receive()
+    send_lock = threading.Lock()  # File sender threads share the socket with the input loop
+    def write_text(text):
+        data = text.encode('utf-8') if isinstance(text, str) else text
+        if proto_state['framed']:
+            data = encode_frame(FRAME_TEXT, data, proto_state['version'])
+        sock.sendall(data)
+    def send_text(text):
+        with send_lock:
+            if not session_state['up']:
+                session_state['outbox'].append(text)  # sent once we are back
+                return
+            try:
+                write_text(text)
+            except OSError:
+                # The receive thread notices too and reconnects
+                session_state['up'] = False
+                session_state['outbox'].append(text)
+    def send_frame(frame_type, payload):
+        with send_lock:
+            if not session_state['up']:
+                raise ConnectionError("not connected")
+            sock.sendall(encode_frame(frame_type, payload, proto_state['version']))
+    def recv_text():
+        if not proto_state['framed']:
+            data = sock.recv(1024)
+            if not data:
+                raise ConnectionError("Server closed the connection")
+            return data.decode('utf-8')
+        while True:
+            frame_type, payload = recv_frame(sock, handshake_buf)
+            if frame_type == FRAME_HELLO and payload:
+                proto_state['version'] = payload[0]
+            elif frame_type == FRAME_TEXT:
+                return payload.decode('utf-8', errors='replace')
+            elif frame_type == FRAME_CHAT:
+                return payload[CHAT_ID.size:].decode('utf-8', errors='replace')
+
+    is_admin = False
+    admin_status_lock = threading.Lock()
+    def connect():
+        # Returns whether we are logged in and the lines to show. Raises
+        # OSError when the server cannot be reached.
+        nonlocal sock, handshake_buf, nickname, is_admin
+        sock = socket.create_connection((server_ip, server_port), timeout=CONNECT_TIMEOUT)
+        handshake_buf = RecvBuffer()
+        proto_state['framed'], proto_state['version'] = False, 0
+        prompt = sock.recv(1024).decode('utf-8')
+        if not prompt:
+            raise ConnectionError("Server closed the connection")
+        proto_advert = re.search(r"PROTO LCF/(\d+)\n", prompt)
+        token = session_state['token']
+        if not proto_advert and "nickname" not in prompt.lower():
+            return False, [prompt]  # turned away before the login (banned IP)
+        if proto_advert:
+            prompt = prompt.replace(proto_advert.group(0), "")
+            proto_state['framed'] = True
+            proto_state['version'] = min(int(proto_advert.group(1)), FRAME_VERSION)
+            first = f"/resume {token} {chat_state['last_id']}" if token else nickname
+            sock.sendall(FRAME_MAGIC + bytes([FRAME_VERSION]) + encode_frame(FRAME_TEXT, first.encode('utf-8')))
+            if token:
+                try:
+                    reply = recv_text().strip().split(" ", 2)
+                except socket.timeout:
+                    session_state['token'] = None  # no answer about our session, log in next time
+                    raise
+                if reply[0] == "/resumed" and len(reply) == 3:
+                    nickname, chat_state['room'] = reply[1], reply[2]
+                    sock.settimeout(None)
+                    return True, []
+                session_state['token'] = None  # the session is gone
+                write_text(nickname)
+        else:
+            sock.sendall(nickname.encode('utf-8'))
+        lines = [prompt + nickname]
+        prompt = recv_text()
+        logged_in = "Welcome" in prompt
+        if prompt.strip().lower().startswith("enter admin password"):
+            password = session_state['password']
+            if password is None and threading.current_thread() is not threading.main_thread():
+                password = ask_password(prompt)  # reconnecting
+            elif password is None:
+                input_win.clear(); input_win.addstr(prompt); input_win.refresh(); curses.echo()
+                password = input_win.getstr(0, len(prompt)).decode().strip()
+            write_text(password)
+            response = recv_text()
+            lines.append(response)
+            # Server will send a special message if admin access is granted
+            if "Admin access granted" in response:
+                session_state['password'] = password
+                logged_in = True
+                with admin_status_lock:
+                    is_admin = True
+        elif prompt.strip():
+            lines.append(prompt)
+        sock.settimeout(None)
+        if logged_in and proto_state['version'] >= 2:
+            # A new session starts in main; go back to where we were. Either
+            # way the server only fills in what the cache is missing.
+            if chat_state['room'] != "main":
+                write_text(f"/join {chat_state['room']} #{chat_state['last_id']}")
+            else:
+                write_text(f"/sync main {chat_state['last_id']}")
+        return logged_in, lines
+
     try:
-        sock.connect((server_ip, 3256))
+        logged_in, lines = connect()
     except Exception as e:
         stdscr.addstr(max_y - 2, 0, f"Connection failed: {e}"[:max_x-1])
         stdscr.refresh()
         stdscr.getch()
         return
-    prompt = sock.recv(1024).decode('utf-8')
-    sock.sendall(nickname.encode('utf-8'))
-    chat_win.addstr(prompt + nickname + '\n', user_color)
-    chat_win.refresh()
-
-    # --- Admin password prompt and status ---
-    is_admin = False
-    admin_status_lock = threading.Lock()
-    prompt = sock.recv(1024).decode('utf-8')
-    if prompt.strip().lower().startswith("enter admin password"):
-        input_win.clear(); input_win.addstr(prompt); input_win.refresh(); curses.echo()
-        password = input_win.getstr(0, len(prompt)).decode().strip()
-        sock.sendall(password.encode('utf-8'))
-        response = sock.recv(1024).decode('utf-8')
-        chat_win.addstr(response + '\n', user_color)
-        chat_win.refresh()
-        # Server will send a special message if admin access is granted
-        if "Admin access granted" in response:
-            with admin_status_lock:
-                is_admin = True
-    elif prompt.strip():
-        chat_win.addstr(prompt + '\n', user_color)
-        chat_win.refresh()
+    for line in lines:
+        show_line(line, user_color)
 
     # Listen for admin status from server
     def set_admin_status(msg):
@@ -319,136 +1027,562 @@ def main(stdscr):
                 is_admin = False
 
     # --- Receive thread ---
-    pending_files = {}  # id: (filename, sender, filedata)
-    def animated_addstr(win, y, x, text, color, delay=0.025):
-        for i, ch in enumerate(text):
-            win.addstr(y, x + i, ch, color)
-            win.refresh()
-            time.sleep(delay)
-
-    def receive(sock, chat_win, lock, stop_event):
+    pending_files = {}  # id: (filename, sender, path of the received data on disk)
+    incoming_files = {}  # relay id: dict(file, path, filename, sender, size, received)
+    outgoing_files = {}  # transfer id: dict(acked, error), guarded by outgoing_cond
+    outgoing_cond = threading.Condition()
+    transfer_ids = itertools.count(1)
+    p2p_offers = {}  # token: Event set when the receiver could not connect
+
+    def receive(sock, stop_event):
         nonlocal pending_files
         nonlocal dm_state
-        buffer = b""
-        def print_animated(msg, color):
-            with lock:
-                y, x = chat_win.getyx()
-                animated_addstr(chat_win, y, 0, msg, color)
-                chat_win.addstr('\n')
-                chat_win.refresh()
+        buffer = handshake_buf
+        def store_file(sender, filename, b64):
+            try:
+                filedata = base64.b64decode(b64)
+                fd, path = tempfile.mkstemp(prefix="communicator_", suffix=".part")
+                with os.fdopen(fd, "wb") as f:
+                    f.write(filedata)
+                file_id = str(random.randint(10000, 99999))
+                pending_files[file_id] = (filename, sender, path)
+                show_line(f"Received file '{filename}' from {sender}. Use /rcvfile [{file_id}] /path/to/save", curses.color_pair(4) | curses.A_BOLD)
+            except Exception as e:
+                show_line(f"Failed to receive file: {e}", curses.color_pair(6))
+        def handle_line(msg):
+            joined = re.search(r"SERVER> Joined room '(.+)'\.$", msg)
+            if joined:
+                chat_state['room'], chat_state['last_id'] = joined.group(1), 0
+                show_typing("")
+            if msg.startswith("/session "):
+                session_state['token'] = msg[9:].strip()
+                return
+            # Listen for admin status from server
+            if msg == "SERVER> ADMIN_GRANTED":
+                set_admin_status(msg)
+                return
+            if msg == "SERVER> ADMIN_REVOKED":
+                set_admin_status(msg)
+                return
+            listed = re.search(r"SERVER> LIST: (.*)$", msg)
+            if listed:
+                userlist = listed.group(1)
+                show_line("Connected users (from server):", curses.color_pair(3))
+                for user in userlist.split(','):
+                    if user.strip():
+                        show_line(f"- {user.strip()}", curses.color_pair(2))
+                return
+            if msg.startswith("SERVER> LISTIP:"):
+                iplist = msg[len("SERVER> LISTIP:"):].strip()
+                show_line("Connected users + IPs (from server):", curses.color_pair(3))
+                for line in iplist.split(';'):
+                    if line.strip():
+                        show_line(f"- {line.strip()}", curses.color_pair(2))
+                return
+            if msg.startswith("/p2p_offer "):
+                # /p2p_offer <sender> <ip> <port> <token> <size> <filename>
+                parts = msg.split(" ", 6)
+                if len(parts) == 7:
+                    threading.Thread(target=receive_file_p2p, args=parts[1:], daemon=True).start()
+                return
+            if msg.startswith("/p2p_fail "):
+                parts = msg.split(" ")
+                if len(parts) == 3 and parts[2] in p2p_offers:
+                    p2p_offers[parts[2]].set()
+                return
+            if msg == "SERVER> CLEARALL":
+                show_line(None, None)
+                return
+            # --- Mention notification ---
+            mention_pattern = re.compile(r'@' + re.escape(nickname) + r'\b', re.IGNORECASE)
+            if mention_pattern.search(msg):
+                play_notification_sound()
+                show_line(f"[MENTION] {msg}", curses.color_pair(4) | curses.A_BOLD, animate=True, mention=True)
+                return
+            # Animate all other messages
+            show_line(msg, user_color, animate=True)
+        def handle_file_frame(frame_type, payload):
+            if frame_type == FRAME_FILE_ACK:
+                transfer_id, received = FILE_ACK.unpack_from(payload)
+                with outgoing_cond:
+                    if transfer_id in outgoing_files:
+                        outgoing_files[transfer_id]['acked'] = received
+                        outgoing_cond.notify_all()
+                return
+            if frame_type == FRAME_FILE_ABORT:
+                transfer_id, upload = FILE_ABORT.unpack_from(payload)
+                reason = payload[FILE_ABORT.size:].decode('utf-8', errors='replace')
+                if upload:
+                    with outgoing_cond:
+                        if transfer_id in outgoing_files:
+                            outgoing_files[transfer_id]['error'] = reason
+                            outgoing_cond.notify_all()
+                    return
+                entry = incoming_files.pop(transfer_id, None)
+                if entry:
+                    entry['file'].close()
+                    os.remove(entry['path'])
+                    show_status("")
+                    show_line(f"File '{entry['filename']}' from {entry['sender']} failed: {reason}", curses.color_pair(6))
+                return
+            if frame_type == FRAME_FILE_OFFER:
+                transfer_id, size = FILE_OFFER.unpack_from(payload)
+                sender, _, filename = payload[FILE_OFFER.size:].decode('utf-8', errors='replace').partition("\0")
+                filename = os.path.basename(filename)
+                # Stream straight to disk; /rcvfile later moves the file into place
+                fd, path = tempfile.mkstemp(prefix="communicator_", suffix=".part")
+                incoming_files[transfer_id] = {'file': os.fdopen(fd, "wb"), 'path': path, 'filename': filename,
+                                               'sender': sender, 'size': size, 'received': 0, 'reported': 0}
+                show_line(f"Receiving file '{filename}' ({size} bytes) from {sender}...", curses.color_pair(4))
+                return
+            (transfer_id,) = FILE_ID.unpack_from(payload)
+            entry = incoming_files.get(transfer_id)
+            if entry is None:
+                return
+            if frame_type == FRAME_FILE_CHUNK:
+                entry['file'].write(payload[FILE_ID.size:])
+                entry['received'] += len(payload) - FILE_ID.size
+                send_frame(FRAME_FILE_ACK, FILE_ACK.pack(transfer_id, entry['received']))
+                if time.time() - entry['reported'] > 0.2:
+                    entry['reported'] = time.time()
+                    show_status(f"Receiving '{entry['filename']}' from {entry['sender']}: {entry['received'] * 100 // max(entry['size'], 1)}%")
+            elif frame_type == FRAME_FILE_END:
+                del incoming_files[transfer_id]
+                entry['file'].close()
+                show_status("")
+                file_id = str(random.randint(10000, 99999))
+                pending_files[file_id] = (entry['filename'], entry['sender'], entry['path'])
+                show_line(f"Received file '{entry['filename']}' from {entry['sender']}. Use /rcvfile [{file_id}] /path/to/save", curses.color_pair(4) | curses.A_BOLD)
+        def apply_presence(change):
+            if change['op'] == 'snapshot':
+                roster.update(version=change['v'], users=dict(change['users']), resync=False)
+                return
+            if roster['version'] is None or change['v'] <= roster['version']:
+                return  # already in the snapshot
+            if change['v'] != roster['version'] + 1:
+                # We missed one (the server drops what a slow client cannot take)
+                if not roster['resync']:
+                    roster['resync'] = True
+                    send_text("/roster")
+                return
+            roster['version'] = change['v']
+            users = roster['users']
+            if change['op'] in ('join', 'status'):
+                users[change['nick']] = change['status']
+            elif change['op'] == 'leave':
+                users.pop(change['nick'], None)
+            elif change['op'] == 'rename':
+                users[change['new']] = users.pop(change['nick'], "online")
+        def handle_frame(frame_type, payload):
+            if frame_type != FRAME_FILE_CHUNK:
+                payload = bytes(payload)  # chunks go to disk straight from the receive buffer
+            if FRAME_FILE_OFFER <= frame_type <= FRAME_FILE_ABORT:
+                handle_file_frame(frame_type, payload)
+                return
+            if frame_type == FRAME_CHAT:
+                (msg_id,) = CHAT_ID.unpack_from(payload)
+                line = payload[CHAT_ID.size:].decode('utf-8', errors='replace').strip()
+                chat_state['last_id'] = max(chat_state['last_id'], msg_id)
+                fields = parse_chat_line(line) if cache else None
+                if fields:
+                    cache.add(chat_state['room'], msg_id, *fields)
+                handle_line(line)
+                return
+            if frame_type == FRAME_PRESENCE:
+                apply_presence(json.loads(payload))
+                return
+            if frame_type == FRAME_TYPING:
+                fields = payload.decode('utf-8', errors='replace').split("\0")
+                if fields[0] == chat_state['room']:
+                    show_typing(typing_summary(int(fields[1]), fields[2:], nickname))
+                return
+            if frame_type != FRAME_TEXT:
+                return
+            # A frame always holds a whole message, so no delimiter scanning
+            if payload.startswith(b"/sendfile "):
+                header, _, b64 = payload.partition(b":::")
+                header_parts = header.decode('utf-8', errors='replace').split(" ", 4)
+                if len(header_parts) < 3:
+                    show_line("Malformed file transfer header.", curses.color_pair(6))
+                    return
+                store_file(header_parts[1], header_parts[2], b64.strip())
+                return
+            for line in payload.decode('utf-8', errors='replace').splitlines():
+                if line.strip():
+                    handle_line(line.strip())
+        scanned = 0  # bytes of the buffer already searched for a newline
         while not stop_event.is_set():
             try:
-                data = sock.recv(4096)
-                if not data:
+                # Frames may already be waiting from the handshake
+                if proto_state['framed']:
+                    for frame_type, payload in parse_frames(buffer):
+                        handle_frame(frame_type, payload)
+                if not buffer.recv_from(sock):
                     break
-                buffer += data
+                if proto_state['framed']:
+                    continue
                 while True:
                     # Check for file transfer message
                     if buffer.startswith(b"/sendfile "):
+                        scanned = 0
                         delim = buffer.find(b":::")
                         if delim == -1:
                             break
-                        header = buffer[:delim].decode('utf-8', errors='replace')
+                        header = bytes(buffer.peek(delim)).decode('utf-8', errors='replace')
                         header_parts = header.split(" ", 4)
                         if len(header_parts) < 4:
-                            with lock:
-                                chat_win.addstr("Malformed file transfer header.\n", curses.color_pair(6))
-                                chat_win.refresh()
-                            buffer = buffer[delim+3:]
+                            show_line("Malformed file transfer header.", curses.color_pair(6))
+                            buffer.skip(delim+3)
                             continue
                         sender = header_parts[1]
                         filename = header_parts[2]
                         try:
                             b64len = int(header_parts[3])
                         except Exception:
-                            with lock:
-                                chat_win.addstr("Malformed file transfer length.\n", curses.color_pair(6))
-                                chat_win.refresh()
-                            buffer = buffer[delim+3:]
+                            show_line("Malformed file transfer length.", curses.color_pair(6))
+                            buffer.skip(delim+3)
                             continue
                         if len(buffer) < delim+3+b64len:
                             break
-                        b64 = buffer[delim+3:delim+3+b64len]
-                        try:
-                            filedata = base64.b64decode(b64)
-                            file_id = str(random.randint(10000, 99999))
-                            pending_files[file_id] = (filename, sender, filedata)
-                            with lock:
-                                chat_win.addstr(f"Received file '{filename}' from {sender}. Use /rcvfile [{file_id}] /path/to/save\n", curses.color_pair(4) | curses.A_BOLD)
-                                chat_win.refresh()
-                        except Exception as e:
-                            with lock:
-                                chat_win.addstr(f"Failed to receive file: {e}\n", curses.color_pair(6))
-                                chat_win.refresh()
-                        buffer = buffer[delim+3+b64len:]
+                        buffer.skip(delim+3)
+                        store_file(sender, filename, bytes(buffer.take(b64len)))
                         continue
-                    # Otherwise, try to decode as utf-8 message
-                    msg_end = buffer.find(b'\n')
-                    if msg_end == -1:
+                    # Otherwise decode every complete line up to the next file transfer in one go
+                    end = buffer.find(b"\n/sendfile ", scanned)
+                    if end == -1:
+                        end = buffer.rfind(b'\n', scanned)
+                    if end == -1:
+                        scanned = len(buffer)
                         break
-                    try:
-                        msg = buffer[:msg_end].decode('utf-8', errors='replace').strip()
-                    except Exception:
-                        buffer = buffer[msg_end+1:]
-                        continue
-                    buffer = buffer[msg_end+1:]
-                    # Listen for admin status from server
-                    if msg == "SERVER> ADMIN_GRANTED":
-                        set_admin_status(msg)
-                        continue
-                    if msg == "SERVER> ADMIN_REVOKED":
-                        set_admin_status(msg)
-                        continue
-                    if msg.startswith("SERVER> LIST:"):
-                        userlist = msg[len("SERVER> LIST:"):].strip()
-                        with lock:
-                            chat_win.addstr("Connected users (from server):\n", curses.color_pair(3))
-                            for user in userlist.split(','):
-                                if user.strip():
-                                    chat_win.addstr(f"- {user.strip()}\n", curses.color_pair(2))
-                            chat_win.refresh()
-                        continue
-                    if msg.startswith("SERVER> LISTIP:"):
-                        iplist = msg[len("SERVER> LISTIP:"):].strip()
-                        with lock:
-                            chat_win.addstr("Connected users + IPs (from server):\n", curses.color_pair(3))
-                            for line in iplist.split(';'):
-                                if line.strip():
-                                    chat_win.addstr(f"- {line.strip()}\n", curses.color_pair(2))
-                            chat_win.refresh()
-                        continue
-                    if msg == "SERVER> CLEARALL":
-                        with lock:
-                            chat_win.clear(); chat_win.refresh()
-                        continue
-                    # --- Mention notification ---
-                    mention_pattern = re.compile(r'@' + re.escape(nickname) + r'\b', re.IGNORECASE)
-                    if mention_pattern.search(msg):
-                        play_notification_sound()
-                        print_animated(f"[MENTION] {msg}", curses.color_pair(4) | curses.A_BOLD)
-                        continue
-                    # Animate all other messages
-                    print_animated(msg, user_color)
+                    scanned = 0
+                    for msg in str(buffer.take(end + 1), 'utf-8', errors='replace').split('\n'):
+                        if msg.strip():
+                            handle_line(msg.strip())
+            except OSError:
+                break  # connection lost
             except Exception as e:
-                with lock:
-                    chat_win.addstr(f"Receive error: {e}\n", curses.color_pair(6))
-                    chat_win.refresh()
+                show_line(f"Receive error: {e}", curses.color_pair(6))
                 break
 
-    recv_thread = threading.Thread(target=receive, args=(sock, chat_win, lock, stop_event), daemon=True)
+    # --- File sending ---
+    def show_status(text):
+        with lock:
+            status_win.clear()
+            status_win.addstr(0, 0, text[:status_win.getmaxyx()[1]-1], curses.color_pair(3))
+            status_win.refresh()
+
+    def send_file_legacy(target, filepath):
+        # Whole file as one base64 message, for servers/peers without chunked transfer.
+        # Returns False if the connection is gone.
+        filename = os.path.basename(filepath)
+        try:
+            with open(filepath, "rb") as f:
+                file_bytes = f.read()
+            b64 = base64.b64encode(file_bytes)
+            b64len = len(b64)
+        except Exception as e:
+            show_line(f"Failed to read file: {e}", curses.color_pair(6))
+            return True
+        # Send as bytes, not as utf-8 string, to support all binary files
+        # Format: /sendfile <target> <filename> <b64len>:::<b64data>
+        header = f"/sendfile {target} {filename} {b64len}:::".encode('utf-8')
+        filemsg = header + b64
+        if proto_state['framed'] and len(filemsg) > MAX_FRAME_SIZE:
+            # One frame per message: the server would refuse it
+            limit = (MAX_FRAME_SIZE - len(header)) * 3 // 4
+            show_line(f"'{filename}' is too large to send without chunked transfer "
+                      f"({len(file_bytes) / 1048576:.1f} MB, at most {limit / 1048576:.1f} MB).", curses.color_pair(6))
+            return True
+        try:
+            send_text(filemsg)
+        except Exception as e:
+            show_line(f"Socket error: {e}", curses.color_pair(6))
+            return False
+        show_line(f"Sent file '{filename}' to {target}.", curses.color_pair(2))
+        return True
+
+    def send_file_chunked(target, filepath):
+        # Runs on its own thread: stream the file in chunks, never more than
+        # FILE_WINDOW bytes ahead of the receiver's acknowledgements.
+        filename = os.path.basename(filepath)
+        size = os.path.getsize(filepath)
+        transfer_id = next(transfer_ids)
+        state = {'acked': 0, 'error': None}
+        with outgoing_cond:
+            outgoing_files[transfer_id] = state
+        def wait_for(ready):
+            with outgoing_cond:
+                while state['error'] is None and not ready():
+                    if not outgoing_cond.wait(FILE_ACK_TIMEOUT):
+                        state['error'] = "timed out waiting for the receiver"
+                return state['error'] is None
+        sent = 0
+        last_report = 0
+        try:
+            send_frame(FRAME_FILE_OFFER, FILE_OFFER.pack(transfer_id, size) + f"{target}\0{filename}".encode('utf-8'))
+            with open(filepath, "rb") as f:
+                while wait_for(lambda: sent - state['acked'] < FILE_WINDOW):
+                    chunk = f.read(min(FILE_CHUNK_SIZE, FILE_WINDOW - (sent - state['acked'])))
+                    if not chunk:
+                        break
+                    send_frame(FRAME_FILE_CHUNK, FILE_ID.pack(transfer_id) + chunk)
+                    sent += len(chunk)
+                    if time.time() - last_report > 0.2:
+                        last_report = time.time()
+                        show_status(f"Sending '{filename}' to {target}: {state['acked'] * 100 // max(size, 1)}% ({sent}/{size} bytes)")
+            if state['error'] is None:
+                send_frame(FRAME_FILE_END, FILE_ID.pack(transfer_id))
+                wait_for(lambda: state['acked'] >= sent)
+        except Exception as e:
+            state['error'] = str(e)
+            try:
+                send_frame(FRAME_FILE_ABORT, FILE_ABORT.pack(transfer_id, 1) + str(e).encode('utf-8'))
+            except Exception:
+                pass
+        finally:
+            with outgoing_cond:
+                outgoing_files.pop(transfer_id, None)
+        show_status("")
+        if state['error'] == "unsupported":
+            # Receiver runs an old client
+            send_file_legacy(target, filepath)
+        elif state['error']:
+            show_line(f"Failed to send file '{filename}': {state['error']}", curses.color_pair(6))
+        else:
+            show_line(f"Sent file '{filename}' to {target} ({size} bytes).", curses.color_pair(2))
+
+    def send_file_p2p(target, filepath):
+        # Offer the file over a direct connection first. The server only passes
+        # our port and a one-time token to the receiver; if the receiver cannot
+        # reach us, or the file did not get through, fall back to relaying it
+        # through the server. Once all of it went out the receiver may well
+        # have it, so a missing confirmation is reported, not relayed again,
+        # unless the receiver said it failed.
+        filename = os.path.basename(filepath)
+        size = os.path.getsize(filepath)
+        token = secrets.token_hex(16)
+        sent_all = False
+        failed = threading.Event()
+        p2p_offers[token] = failed
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(("0.0.0.0", 0))
+            listener.listen(1)
+            listener.settimeout(0.25)
+            send_text(f"/p2p_offer {target} {listener.getsockname()[1]} {token} {size} {filename}")
+            deadline = time.time() + P2P_ACCEPT_TIMEOUT
+            while not failed.is_set() and time.time() < deadline:
+                try:
+                    peer, _ = listener.accept()
+                except socket.timeout:
+                    continue
+                with peer, peer.makefile("rb") as replies:
+                    peer.settimeout(FILE_ACK_TIMEOUT)
+                    # Lines may arrive split over several segments
+                    if replies.readline(len(token) + 1) != (token + "\n").encode('utf-8'):
+                        continue
+                    with open(filepath, "rb") as f:
+                        offset = 0
+                        while offset < size:
+                            # sendfile() lets the kernel copy straight from the page cache
+                            sent = peer.sendfile(f, offset, min(P2P_BLOCK_SIZE, size - offset))
+                            if not sent:
+                                raise ConnectionError("receiver closed the connection")
+                            offset += sent
+                            show_status(f"Sending '{filename}' to {target} (direct): {offset * 100 // max(size, 1)}%")
+                    sent_all = True
+                    # The receiver confirms once everything is on disk
+                    if replies.readline(3) == b"OK\n":
+                        show_status("")
+                        show_line(f"Sent file '{filename}' to {target} directly ({size} bytes).", curses.color_pair(2))
+                        return
+                    break
+        except Exception:
+            pass
+        finally:
+            listener.close()
+            p2p_offers.pop(token, None)
+            show_status("")
+        if sent_all and not failed.is_set():
+            show_line(f"Sent file '{filename}' to {target} directly ({size} bytes), but {target} did not confirm it.", curses.color_pair(4))
+            return
+        send_file_chunked(target, filepath)
+
+    def receive_file_p2p(sender, ip, port, token, size, filename):
+        filename = os.path.basename(filename)
+        size = int(size)
+        fd, path = tempfile.mkstemp(prefix="communicator_", suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f, socket.create_connection((ip, int(port)), timeout=P2P_CONNECT_TIMEOUT) as peer:
+                peer.settimeout(FILE_ACK_TIMEOUT)
+                peer.sendall((token + "\n").encode('utf-8'))
+                buf = memoryview(bytearray(P2P_BUFFER_SIZE))
+                received = 0
+                reported = 0
+                while received < size:
+                    n = peer.recv_into(buf, min(len(buf), size - received))
+                    if not n:
+                        raise ConnectionError("sender closed the connection")
+                    f.write(buf[:n])
+                    received += n
+                    if time.time() - reported > 0.2:
+                        reported = time.time()
+                        show_status(f"Receiving '{filename}' from {sender} (direct): {received * 100 // max(size, 1)}%")
+                f.flush()
+                peer.sendall(b"OK\n")
+        except Exception:
+            os.remove(path)
+            show_status("")
+            # Let the sender know so it relays the file through the server instead
+            try:
+                send_text(f"/p2p_fail {sender} {token}")
+            except Exception:
+                pass
+            return
+        show_status("")
+        file_id = str(random.randint(10000, 99999))
+        pending_files[file_id] = (filename, sender, path)
+        show_line(f"Received file '{filename}' from {sender}. Use /rcvfile [{file_id}] /path/to/save", curses.color_pair(4) | curses.A_BOLD)
+
+    # --- Reconnect ---
+    # Receive until the connection drops, then reconnect with exponential
+    # backoff (with jitter, so a restarted server is not hit by everyone at
+    # once) and resume the session. Lines typed meanwhile are sent after.
+    def connection_loop(logged_in):
+        while logged_in:
+            with send_lock:
+                session_state['up'] = True
+                try:
+                    for text in session_state['outbox']:
+                        write_text(text)
+                    session_state['outbox'].clear()
+                except OSError:
+                    pass  # dropped again, receive() returns right away
+            receive(sock, stop_event)
+            with send_lock:
+                session_state['up'] = False
+            show_typing("")
+            roster['version'] = None  # the next connection starts with a snapshot
+            if stop_event.is_set():
+                return
+            sock.close()
+            show_line("Connection lost, reconnecting...", curses.color_pair(6))
+            delay = RECONNECT_MIN_DELAY
+            while not stop_event.is_set():
+                try:
+                    resuming = session_state['token'] is not None
+                    logged_in, lines = connect()
+                    break
+                except OSError as e:
+                    wait = delay * random.uniform(0.5, 1.0)
+                    show_status(f"Cannot reach {server_ip}:{server_port} ({e}), retrying in {wait:.1f} s")
+                    stop_event.wait(wait)
+                    delay = min(delay * 2, RECONNECT_MAX_DELAY)
+            if stop_event.is_set():
+                return
+            show_status("")
+            for line in lines:
+                show_line(line, user_color)
+            if not logged_in:
+                show_line("The server did not let us back in. Restart the client to try again.", curses.color_pair(6))
+            elif resuming and session_state['token'] is not None:
+                show_line("Reconnected, session resumed.", curses.color_pair(3))
+            else:
+                show_line("Reconnected as a new session.", curses.color_pair(3))
+    recv_thread = threading.Thread(target=connection_loop, args=(logged_in,), daemon=True)
     recv_thread.start()
 
+    def disconnect():
+        # Leaving for good: the server need not hold the session for us
+        stop_event.set()
+        if session_state['token']:
+            send_text("/quit")
+        sock.close()
+        if cache:
+            cache.close()
+
+    # --- Typing indicator ---
+    # While a chat line is being typed the server hears "/typing" every
+    # TYPING_REFRESH seconds (it forgets it a little later on its own), and
+    # "/notyping" once the line is emptied or turns into a command. Sending
+    # the line ends it on the server.
+    typing_sent = 0  # when we last sent /typing, 0 while we are not typing
+    def notify_typing(text):
+        nonlocal typing_sent
+        if proto_state['version'] < 3 or not session_state['up']:
+            return
+        typing = bool(text) and not text.startswith("/") and not dm_state['active']
+        now = time.time()
+        if typing and now - typing_sent >= TYPING_REFRESH:
+            typing_sent = now
+            send_text("/typing")
+        elif not typing and typing_sent:
+            typing_sent = 0
+            send_text("/notyping")
+
     # --- Main input loop ---
-    COMMANDS = ["/help", "/list", "/listip", "/clear", "/clearall", "/color", "/rename", "/ver", "/quit"]
+    COMMANDS = ["/help", "/list", "/listip", "/clear", "/clearall", "/color", "/rename", "/history", "/ver", "/quit"]
     input_history = []
     input_history_idx = 0
-    while True:
-        # Check for terminal resize
-        if curses.is_term_resized(max_y, max_x):
-            handle_resize()
+    def read_input():
+        # Line editor for the input row. PageUp/PageDown scroll the chat, End
+        # returns to the newest messages, F3 jumps to the previous mention and
+        # Up/Down recall earlier input.
+        nonlocal input_history_idx, typing_sent
+        curses.noecho()
+        text = ""
+        while True:
+            asking = password_request['prompt']
+            prompt = asking or f"{nickname}> "
+            with lock:
+                input_win.erase()
+                room = max(1, input_win.getmaxyx()[1] - len(prompt) - 1)
+                input_win.addstr(0, 0, prompt[:input_win.getmaxyx()[1] - 1], user_color)
+                input_win.addstr(("*" * len(text) if asking else text)[-room:])
+                input_win.refresh()
+            try:
+                key = input_win.get_wch()
+            except curses.error:
+                continue
+            if key in ("\n", "\r", curses.KEY_ENTER) and password_request['prompt']:
+                # The answer goes to the connection thread, not to the chat
+                password_request['answer'], password_request['prompt'] = text.strip(), None
+                password_request['ready'].set()
+                text = ""
+                continue
+            if key in ("\n", "\r", curses.KEY_ENTER):
+                if text.startswith("/") or dm_state['active'] or not text.strip():
+                    notify_typing("")
+                typing_sent = 0  # a chat line ends it on the server
+                return text
+            elif key in (curses.KEY_BACKSPACE, "\x7f", "\b"):
+                text = text[:-1]
+            elif key in (curses.KEY_PPAGE, curses.KEY_NPAGE, curses.KEY_END, curses.KEY_F3):
+                with lock:
+                    height, width = chat_win.getmaxyx()
+                    if key == curses.KEY_PPAGE:
+                        scrollback.page_up(height, width - 1)
+                    elif key == curses.KEY_NPAGE:
+                        scrollback.page_down(height, width - 1)
+                    elif key == curses.KEY_END:
+                        scrollback.follow()
+                    elif not scrollback.previous_mention():
+                        curses.beep()
+                render_wake.set()
+            elif key == curses.KEY_UP and input_history_idx > 0:
+                input_history_idx -= 1
+                text = input_history[input_history_idx]
+            elif key == curses.KEY_DOWN and input_history_idx < len(input_history):
+                input_history_idx += 1
+                text = input_history[input_history_idx] if input_history_idx < len(input_history) else ""
+            elif key == curses.KEY_RESIZE:
+                handle_resize()
+            elif isinstance(key, str) and key.isprintable():
+                text += key
+            notify_typing(text)
 
-        input_win.clear(); input_win.addstr(f"{nickname}> ", user_color); input_win.refresh(); curses.echo()
-        msg = input_win.getstr().decode().strip()
+    while True:
+        msg = read_input().strip()
         if msg:
             input_history.append(msg)
             input_history_idx = len(input_history)
@@ -458,107 +1592,95 @@ def main(stdscr):
         if msg.startswith("/dm "):
             peer = msg.split(" ",1)[1].strip()
             if not peer:
-                with lock:
-                    chat_win.addstr("Usage: /dm [username]\n", curses.color_pair(2))
-                    chat_win.refresh()
+                show_line("Usage: /dm [username]", curses.color_pair(2))
                 continue
             if peer == nickname:
-                with lock:
-                    chat_win.addstr("You cannot DM yourself.\n", curses.color_pair(6))
-                    chat_win.refresh()
+                show_line("You cannot DM yourself.", curses.color_pair(6))
                 continue
             dm_state['active'] = True
             dm_state['peer'] = peer
-            with lock:
-                chat_win.addstr(f"Now in direct message mode with {peer}. Type /edm to return to main chat.\n", curses.color_pair(5) | curses.A_BOLD)
-                chat_win.refresh()
+            show_line(f"Now in direct message mode with {peer}. Type /edm to return to main chat.", curses.color_pair(5) | curses.A_BOLD)
             continue
         if msg == "/edm":
             if dm_state['active']:
-                with lock:
-                    chat_win.addstr(f"Exited DM mode with {dm_state['peer']}.\n", curses.color_pair(2))
-                    chat_win.refresh()
+                show_line(f"Exited DM mode with {dm_state['peer']}.", curses.color_pair(2))
                 dm_state['active'] = False
                 dm_state['peer'] = None
             else:
-                with lock:
-                    chat_win.addstr("You are not in DM mode.\n", curses.color_pair(2))
-                    chat_win.refresh()
+                show_line("You are not in DM mode.", curses.color_pair(2))
             continue
         if msg == "/help":
-            with lock:
-                chat_win.addstr("Available commands:\n", curses.color_pair(3))
-                commands = [
-                    "/help    -    Show this help message",
-                    "/list    -    List connected users",
-                    "/dm [USER]    -    Enter direct message mode with a user",
-                    "/edm      -    Exit direct message mode (return to main chat)",
-                    "/clear    -    Clear chat window",
-                    "/color COLOR    -    Change chat color (green, white, cyan, yellow, magenta, red, pink)",
-                    "/rename NEWNICK    -    Change your nickname",
-                    "/ver    -    Show client version",
-                    "/update    -    Update client if available",
-                    "/sendfile [USER] [PATH/filename]    -    Send a file to a user",
-                    "/rcvfile [ID] [PATH/filename]    -    Receive a file by ID and save to PATH",
-                    "/quit    -    Exit the client"
-                ]
-                with admin_status_lock:
-                    if is_admin:
-                        admin_cmds = [
-                            "/listip    -    List users with IPs (admin only)",
-                            "/clearall    -    Clear chat for all users (admin only)"
-                        ]
-                        commands.insert(2, admin_cmds[0])
-                        commands.insert(4, admin_cmds[1])
-                for cmd in commands:
-                    chat_win.addstr(cmd + "\n", curses.color_pair(2))
-                chat_win.refresh()
+            show_line("Available commands:", curses.color_pair(3))
+            commands = [
+                "/help    -    Show this help message",
+                "/list    -    List connected users",
+                "/dm [USER]    -    Enter direct message mode with a user",
+                "/edm      -    Exit direct message mode (return to main chat)",
+                "/clear    -    Clear chat window",
+                "/color COLOR    -    Change chat color (green, white, cyan, yellow, magenta, red, pink)",
+                "/rename NEWNICK    -    Change your nickname",
+                "/history [ID]    -    Show older messages of this room (before message ID)",
+                "/ver    -    Show client version",
+                "/update    -    Update client if available",
+                "/sendfile [USER] [PATH/filename]    -    Send a file to a user",
+                "/rcvfile [ID] [PATH/filename]    -    Receive a file by ID and save to PATH",
+                "/quit    -    Exit the client",
+                "PageUp/PageDown    -    Scroll the chat (End: back to the newest, F3: previous mention)"
+            ]
+            with admin_status_lock:
+                if is_admin:
+                    admin_cmds = [
+                        "/listip    -    List users with IPs (admin only)",
+                        "/clearall    -    Clear chat for all users (admin only)"
+                    ]
+                    commands.insert(2, admin_cmds[0])
+                    commands.insert(4, admin_cmds[1])
+            for cmd in commands:
+                show_line(cmd, curses.color_pair(2))
             continue
         elif msg == "/clear":
-            with lock:
-                chat_win.clear(); chat_win.refresh()
+            show_line(None, None)  # scrolled-back history stays reachable
             continue
         elif msg == "/list":
-            try:
-                sock.sendall(b"/list")
-            except:
-                break
+            users = sorted(dict(roster['users']).items()) if roster['version'] is not None else None
+            if users is None:
+                try:
+                    send_text("/list")
+                except:
+                    break
+                continue
+            show_line(f"Connected users ({len(users)}):", curses.color_pair(3))
+            for user, status in users:
+                show_line(f"- {user} ({status})", curses.color_pair(2))
             continue
         elif msg == "/listip":
             with admin_status_lock:
                 if is_admin:
                     try:
-                        sock.sendall(b"/listip")
+                        send_text("/listip")
                     except:
                         break
                 else:
-                    with lock:
-                        chat_win.addstr("You are not admin.\n", curses.color_pair(6))
-                        chat_win.refresh()
+                    show_line("You are not admin.", curses.color_pair(6))
             continue
         elif msg == "/clearall":
             with admin_status_lock:
                 if is_admin:
                     try:
-                        sock.sendall(b"/clearall")
+                        send_text("/clearall")
                     except:
                         break
                 else:
-                    with lock:
-                        chat_win.addstr("You are not admin.\n", curses.color_pair(6))
-                        chat_win.refresh()
+                    show_line("You are not admin.", curses.color_pair(6))
             continue
         elif msg == "/update":
             # --- Update logic for .exe and .py ---
             try:
-                import shutil
                 is_frozen = getattr(sys, 'frozen', False)
                 if is_frozen:
                     # Running as .py
                     update_url = f"https://github.com/sirpatch/Lan-Communicator/blob/main/Client.py"
-                    with lock:
-                        chat_win.addstr(f"\nChecking for updates at {update_url}...\n", curses.A_BOLD)
-                        chat_win.refresh()
+                    show_line(f"\nChecking for updates at {update_url}...", curses.A_BOLD)
                     response = urllib.request.urlopen(update_url)
                     new_code = response.read()
                     first_lines = new_code.decode(errors="ignore").splitlines()[:5]
@@ -577,38 +1699,25 @@ def main(stdscr):
                         os.rename(script_path, bak_path)
                         with open(script_path, "wb") as f:
                             f.write(new_code)
-                        with lock:
-                            chat_win.addstr(f"Updated to version {new_version}. Launching new client...\n", curses.A_BOLD)
-                            chat_win.refresh()
-                        stop_event.set()
-                        sock.close()
+                        show_line(f"Updated to version {new_version}. Launching new client...", curses.A_BOLD)
+                        disconnect()
                         restart_client()
                         break
                     elif new_version == CLIENT_VERSION:
-                        with lock:
-                            chat_win.addstr("You already have the latest version.\n", curses.A_BOLD)
-                            chat_win.refresh()
+                        show_line("You already have the latest version.", curses.A_BOLD)
                     else:
-                        with lock:
-                            chat_win.addstr("Could not determine version of downloaded file.\n", curses.A_BOLD)
-                            chat_win.refresh()
+                        show_line("Could not determine version of downloaded file.", curses.A_BOLD)
             except Exception as e:
-                with lock:
-                    chat_win.addstr(f"Update failed: {e}\n", curses.A_BOLD)
-                    chat_win.refresh()
+                show_line(f"Update failed: {e}", curses.A_BOLD)
             continue
         elif msg.startswith("/color"):
             color_name = msg[6:].strip().lower()
             if color_name in color_map:
                 save_color(color_name)
                 user_color = color_map[color_name]
-                with lock:
-                    chat_win.addstr(f"Chat color changed to {color_name}.\n", user_color)
-                    chat_win.refresh()
+                show_line(f"Chat color changed to {color_name}.", user_color)
             else:
-                with lock:
-                    chat_win.addstr("Available colors: green, white, cyan, yellow, magenta, red, pink\n", curses.color_pair(2))
-                    chat_win.refresh()
+                show_line("Available colors: green, white, cyan, yellow, magenta, red, pink", curses.color_pair(2))
             continue
         elif msg == "/gui":
             import subprocess
@@ -618,9 +1727,7 @@ def main(stdscr):
             try:
                 subprocess.Popen([python, script_path, "--gui"])
             except Exception as e:
-                with lock:
-                    chat_win.addstr(f"Failed to launch GUI: {e}\n", curses.color_pair(6))
-                    chat_win.refresh()
+                show_line(f"Failed to launch GUI: {e}", curses.color_pair(6))
             break
         elif msg.startswith("/rename"):
             newnick = msg[7:].strip()
@@ -628,114 +1735,69 @@ def main(stdscr):
                 nickname = newnick
                 save_nickname(nickname)
                 try:
-                    sock.sendall(f"/rename {nickname}".encode('utf-8'))
+                    send_text(f"/rename {nickname}")
                 except:
                     break
-                with lock:
-                    chat_win.addstr(f"Nickname changed to: {nickname}\n", user_color)
-                    chat_win.refresh()
+                show_line(f"Nickname changed to: {nickname}", user_color)
             else:
-                with lock:
-                    chat_win.addstr("Usage: /rename NEWNICK\n", curses.color_pair(2))
-                    chat_win.refresh()
+                show_line("Usage: /rename NEWNICK", curses.color_pair(2))
             continue
         elif msg == "/ver":
-            with lock:
-                chat_win.addstr(f"Client version: {CLIENT_VERSION}\n", curses.color_pair(2))
-                chat_win.refresh()
+            show_line(f"Client version: {CLIENT_VERSION}", curses.color_pair(2))
             continue
         elif msg.startswith("/sendfile "):
             try:
                 # Allow spaces in target and filepath, and support any file extension
                 parts = msg.split(" ", 2)
                 if len(parts) != 3:
-                    with lock:
-                        chat_win.addstr("Usage: /sendfile USER FILEPATH\n", curses.color_pair(2))
-                        chat_win.refresh()
+                    show_line("Usage: /sendfile USER FILEPATH", curses.color_pair(2))
                     continue
                 target, filepath = parts[1], parts[2]
                 if not os.path.isfile(filepath):
-                    with lock:
-                        chat_win.addstr(f"File not found: {filepath}\n", curses.color_pair(6))
-                        chat_win.refresh()
-                    continue
-                filename = os.path.basename(filepath)
-                try:
-                    with open(filepath, "rb") as f:
-                        file_bytes = f.read()
-                    b64 = base64.b64encode(file_bytes)
-                    b64len = len(b64)
-                except Exception as e:
-                    with lock:
-                        chat_win.addstr(f"Failed to read file: {e}\n", curses.color_pair(6))
-                        chat_win.refresh()
+                    show_line(f"File not found: {filepath}", curses.color_pair(6))
                     continue
-                # Send as bytes, not as utf-8 string, to support all binary files
-                # Format: /sendfile <target> <filename> <b64len>:::<b64data>
-                header = f"/sendfile {target} {filename} {b64len}:::".encode('utf-8')
-                filemsg = header + b64
-                try:
-                    sock.sendall(filemsg)
-                except Exception as e:
-                    with lock:
-                        chat_win.addstr(f"Socket error: {e}\n", curses.color_pair(6))
-                        chat_win.refresh()
+                if proto_state['framed']:
+                    threading.Thread(target=send_file_p2p, args=(target, filepath), daemon=True).start()
+                elif not send_file_legacy(target, filepath):
                     break
-                with lock:
-                    chat_win.addstr(f"Sent file '{filename}' to {target}.\n", curses.color_pair(2))
-                    chat_win.refresh()
             except Exception as e:
-                with lock:
-                    chat_win.addstr(f"Failed to send file: {e}\n", curses.color_pair(6))
-                    chat_win.refresh()
+                show_line(f"Failed to send file: {e}", curses.color_pair(6))
             continue
         elif msg.startswith("/rcvfile "):
             try:
                 parts = msg.split()
                 if len(parts) < 3:
-                    with lock:
-                        chat_win.addstr("Usage: /rcvfile [ID] [PATH]\n", curses.color_pair(2))
-                        chat_win.refresh()
+                    show_line("Usage: /rcvfile [ID] [PATH]", curses.color_pair(2))
                     continue
                 file_id = parts[1].strip('[]')
                 save_path = " ".join(parts[2:])
                 if file_id not in pending_files:
-                    with lock:
-                        chat_win.addstr(f"No file with ID {file_id} pending.\n", curses.color_pair(6))
-                        chat_win.refresh()
+                    show_line(f"No file with ID {file_id} pending.", curses.color_pair(6))
                     continue
-                filename, sender, filedata = pending_files[file_id]
+                filename, sender, path = pending_files[file_id]
                 try:
-                    with open(save_path, "wb") as f:
-                        f.write(filedata)
-                    with lock:
-                        chat_win.addstr(f"Saved file '{filename}' from {sender} to {save_path}\n", curses.color_pair(4) | curses.A_BOLD)
-                        chat_win.refresh()
+                    shutil.move(path, save_path)
+                    show_line(f"Saved file '{filename}' from {sender} to {save_path}", curses.color_pair(4) | curses.A_BOLD)
                     del pending_files[file_id]
                 except Exception as e:
-                    with lock:
-                        chat_win.addstr(f"Failed to save file: {e}\n", curses.color_pair(6))
-                        chat_win.refresh()
+                    show_line(f"Failed to save file: {e}", curses.color_pair(6))
             except Exception as e:
-                with lock:
-                    chat_win.addstr(f"Error: {e}\n", curses.color_pair(6))
-                    chat_win.refresh()
+                show_line(f"Error: {e}", curses.color_pair(6))
             continue
         # --- Send to server if not a local command ---
         # If in a call, make chat private: both users DM each other (via /msg) while in call
         # If in DM mode, send all messages as /msg to peer
         if dm_state['active'] and dm_state['peer'] and not msg.startswith("/msg "):
             try:
-                sock.sendall(f"/msg {dm_state['peer']} {msg}".encode('utf-8'))
+                send_text(f"/msg {dm_state['peer']} {msg}")
             except:
                 break
         else:
             try:
-                sock.sendall(msg.encode('utf-8'))
+                send_text(msg)
             except:
                 break
-    stop_event.set()
-    sock.close()
+    disconnect()
 
 def restart_client():
     # After update, auto-relaunch the client script in a new process, then exit